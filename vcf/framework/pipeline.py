@@ -17,15 +17,18 @@ import importlib.util
 import inspect
 import datetime
 from importlib import import_module
+from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
-from framework.semantic_tools.template_manager import TemplateManager
-from framework.semantic_tools.lf_parser import TripsAPI
+from framework.semantic_tools.template_manager import TemplateManager, Command
+from framework.semantic_tools.lf_parser import TripsAPI, REPLY_ERRORS
 from framework.command_dispatch.command_dispatcher import CommandDispatcher, MappingType
 from framework.speech_recognition.speech_recognizer import SpeechTranscriber
 from framework.speech_recognition.until import Until
 
 import logging
-from logging import debug
+from logging import debug, warning
 
 LOG_FILENAME = 'pipeline.log'
 logging.basicConfig(filename=LOG_FILENAME, level=logging.DEBUG)
@@ -33,6 +36,11 @@ logging.basicConfig(filename=LOG_FILENAME, level=logging.DEBUG)
 CONFIGURATION = "pipeline_config.json"  # Expected name and location of the config file.
 CONF_TEMPLATES = "template_lib"
 CONF_DISPATCH = "dispatch_map"
+CONF_TRIPS = "trips"  # Optional TripsAPI options, e.g. {"url": ..., "read_timeout": ...}
+CONF_WARM_UP = "warm_up"  # Optional. true, or {"history": file of past utterances, "history_size": int}
+WARM_UP_OPTIONS = {'history', 'history_size'}
+DEFAULT_HISTORY_SIZE = 100
+CONF_FAST_PATH = "fast_path"  # Optional, true by default. Recognize utterances matched before without parsing them.
 
 USAGE = """pipeline.py [-h] [-v]
 
@@ -68,15 +76,147 @@ class Pipeline:
 
             # The framework is all set. Load the components.
             self._speech = SpeechTranscriber()
-            self._parser = TripsAPI()
+            self._parser = TripsAPI(**config.get(CONF_TRIPS, {}))
             self._tm = TemplateManager(config[CONF_TEMPLATES])
             self._cd = CommandDispatcher(config[CONF_DISPATCH])
+            self._fast_path = config.get(CONF_FAST_PATH, True)
+            # The alternative transcriptions of an utterance are parsed and matched side by side.
+            self._alternatives = ThreadPoolExecutor(max_workers=self._parser.pool_size,
+                                                    thread_name_prefix='pipeline-alternative')
 
             # Load all the required modules and store them for later reference.
             self._modules = {}
             for mod in self._cd.modules:
                 self._modules[mod] = import_module(mod)
 
+            # Utterances of recognized commands are remembered, so that the next start can warm up with them too.
+            warm_up = config.get(CONF_WARM_UP, False)
+            options = warm_up if isinstance(warm_up, dict) else {}
+            self._history = options.get('history')  # type: Optional[str]
+            self._history_size = options.get('history_size', DEFAULT_HISTORY_SIZE)
+            self._history_lock = RLock()
+
+            # Parse the example utterances in the background, so that the first command does not pay for opening
+            # connections to the parser and filling its cache.
+            self.warm_up_time = None  # type: Optional[float]  # Seconds the warm-up took, once it is done.
+            self._warm_up_thread = None  # type: Optional[Thread]
+            if warm_up:
+                self._warm_up_thread = Thread(target=self.warm_up, name='pipeline-warm-up', daemon=True)
+                self._warm_up_thread.start()
+
+        def warm_up(self, utterances: List[str] = None) -> float:
+            """
+            Parse and match a set of utterances to open the pooled parser connections, fill the parse cache, and
+            encode the template library. Nothing is dispatched.
+            :param utterances: Utterances to warm up with. Defaults to the examples of every command and the
+                remembered utterances of past commands.
+            :return: The number of seconds the warm-up took.
+            """
+            start = perf_counter()
+            if utterances is None:
+                utterances = list(dict.fromkeys(self._tm.examples + self._read_history()))
+
+            results = self._parser.parse_many(utterances)
+            # Batch matching returns separate Commands, so it cannot disturb a concurrent listen().
+            matched = self._tm.match_batch([r.lf for r in results])
+            for result, command in zip(results, matched):
+                if result.error is None:
+                    self._tm.learn(result.sentence, command)
+
+            self.warm_up_time = perf_counter() - start
+            debug(f'Warm-up: {len(utterances)} utterances in {self.warm_up_time:.2f}s, '
+                  f'{sum(r.error is not None for r in results)} failed to parse, '
+                  f'{sum(m is not None for m in matched)} matched.')
+            return self.warm_up_time
+
+        def wait_for_warm_up(self, timeout: float = None) -> bool:
+            """
+            Block until the background warm-up is done.
+            :param timeout: Seconds to wait at most. None waits for as long as it takes.
+            :return: True if there is no warm-up in progress.
+            """
+            if self._warm_up_thread is not None:
+                self._warm_up_thread.join(timeout)
+                return not self._warm_up_thread.is_alive()
+            return True
+
+        @property
+        def coalesce_stats(self) -> Dict[str, Dict[str, int]]:
+            """
+            :return: For the speech API and the parser, the number of requests sent and the number of requests that
+                waited for an identical one in flight instead.
+            """
+            return {'speech': self._speech.coalesce_stats, 'trips': self._parser.coalesce_stats}
+
+        def _read_history(self) -> List[str]:
+            """
+            :return: The remembered utterances of past commands, oldest first.
+            """
+            if self._history is None or not isfile(self._history):
+                return []
+            with self._history_lock, open(self._history, 'r') as fp:
+                try:
+                    return json.load(fp)
+                except json.decoder.JSONDecodeError as e:
+                    debug(f'Ignoring unreadable warm-up history {self._history}: {e}')
+                    return []
+
+        def _remember(self, utterance: str) -> NoReturn:
+            """
+            Add the utterance of a recognized command to the warm-up history, dropping the oldest ones beyond the
+            history size.
+            :param utterance: A transcribed utterance.
+            :return: None
+            """
+            if self._history is None:
+                return
+            with self._history_lock:
+                history = [u for u in self._read_history() if u != utterance] + [utterance]
+                with open(self._history, 'w') as fp:
+                    json.dump(history[-self._history_size:], fp, indent=2)
+
+        def _recognize(self, alternatives: List[str]) -> Tuple[str, Optional[Command]]:
+            """
+            Match the alternative transcriptions of an utterance all at once, and pick the likeliest one that matches.
+            The pick is made as soon as every likelier alternative is known not to match, so when the likeliest one
+            matches, the rest are not waited for.
+            :param alternatives: Transcriptions of an utterance, likeliest first.
+            :return: The chosen transcription and its command, or the likeliest transcription and None if none match.
+            """
+            if len(alternatives) == 1:
+                return alternatives[0], self._match_utterance(alternatives[0])
+
+            pending = [self._alternatives.submit(self._match_utterance, a) for a in alternatives]
+            for alternative, future in zip(alternatives, pending):
+                command = future.result()
+                if command is not None:
+                    return alternative, command
+            return alternatives[0], None
+
+        def _match_utterance(self, utterance: str) -> Optional[Command]:
+            """
+            Parse a transcription and match it against the template library, unless its command is already known.
+            Safe to call from several threads at once.
+            :param utterance: A transcription.
+            :return: A separate matched Command, or None, also if the parser did not reply with a Logical Form.
+            """
+            # Utterances whose command is already known skip the parser.
+            command = self._tm.match_text(utterance) if self._fast_path else None
+            if command is not None:
+                return command
+
+            # A reply that is not a Logical Form only rules out this transcription, not the other alternatives.
+            try:
+                lf = self._parser.parse(utterance)
+            except REPLY_ERRORS as e:
+                warning(f'The parser did not reply with a Logical Form for "{utterance}": {e}')
+                return None
+            # Batch matching returns a separate Command, so concurrent matches do not overwrite each other's bindings.
+            command = self._tm.match_batch([lf])[0]
+            if lf._root is not None:
+                self._tm.learn(utterance, command)
+            return command
+
         def listen(self, until: Until, for_command: str = None) -> \
                 Tuple[bool, str, Union[Dict[str, str], Optional[Any]]]:
             """
@@ -94,19 +234,16 @@ class Pipeline:
             utterance = None
             try:
                 # First, listen to the user's voice until the provided condition is met and transcribe it.
-                utterance = self._speech.listen(until)
-                debug(f'User utterance: {utterance}')
-
-                # Next, we parse the utterance into a logical form.
-                lf = self._parser.parse(utterance)
+                alternatives = self._speech.listen_alternatives(until)
+                debug(f'User utterance: {alternatives[0]}, alternatives: {alternatives[1:]}')
 
-                # Next, match it against the template library
-                command = self._tm.match(lf)
-                debug(f'Matched command: {command.name}')
+                # Next, find the likeliest transcription that matches a command.
+                utterance, command = self._recognize(alternatives)
 
                 # No command was matched.
                 if command is None:
                     return success, utterance, result
+                debug(f'Matched command: {command.name}')
 
                 # If the programmer expects a specific command to happen, verify.
                 if for_command is not None and command.name != for_command:
@@ -118,6 +255,7 @@ class Pipeline:
                 # 3) Raise an error indicating something bad happened.
                 result = self._cd.dispatch(command, self._modules)
                 success = True
+                self._remember(utterance)
             except Exception as e:
                 success = False
                 debug(f'Pipeline error: {e}')
@@ -170,6 +308,27 @@ def validate_framework_state(config: Dict[str, str], log_output=True) -> bool:
         raise ValueError(f'\tTemplate library file/directory {dispatch_lib} not found.')
     out_fn(f'+\tDispatch library {dispatch_lib}')
 
+    if CONF_TRIPS in config:
+        known = set(inspect.signature(TripsAPI.__init__).parameters.keys()) - {'self'}
+        unknown = set(config[CONF_TRIPS].keys()) - known
+        if unknown:
+            raise ValueError(f'\tUnknown {CONF_TRIPS} options {", ".join(sorted(unknown))}.')
+        out_fn(f'+\tTRIPS endpoint {config[CONF_TRIPS].get("url", TripsAPI.DEFAULT_URL)}')
+
+    if isinstance(config.get(CONF_WARM_UP), dict):
+        unknown = set(config[CONF_WARM_UP].keys()) - WARM_UP_OPTIONS
+        if unknown:
+            raise ValueError(f'\tUnknown {CONF_WARM_UP} options {", ".join(sorted(unknown))}.')
+    elif not isinstance(config.get(CONF_WARM_UP, False), bool):
+        raise ValueError(f'\t{CONF_WARM_UP} must be true, false, or an object of options.')
+    if config.get(CONF_WARM_UP):
+        out_fn(f'+\tWarm-up')
+
+    if not isinstance(config.get(CONF_FAST_PATH, True), bool):
+        raise ValueError(f'\t{CONF_FAST_PATH} must be true or false.')
+    if config.get(CONF_FAST_PATH, True):
+        out_fn(f'+\tFast path')
+
     try:
         section('PIPELINE STAGES')
         sr = SpeechTranscriber()  # The act of instantiating this validates everything related to the transcriber.
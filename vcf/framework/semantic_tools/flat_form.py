@@ -0,0 +1,615 @@
+"""
+An array-backed representation of Logical Forms for batch workloads.
+
+A FlatLogicalForm stores an entire LF graph in a handful of NumPy arrays. Strings are interned into a SymbolTable,
+every variable-length attribute is stored CSR-style as an offsets array and a values array, and roles are nested three
+levels deep: node -> rolegroups -> roles -> children. Shared components are stored once.
+"""
+
+import json
+import struct
+from collections import deque
+from typing import *
+
+import numpy as np
+
+from framework.semantic_tools.logical_form import LogicalForm, WILDCARD
+from framework.semantic_tools.symbols import SymbolTable
+from framework.semantic_tools.trips_xml import TripsXmlReader, Description
+
+# Node flags
+FLAG_NO_WORD = 1  # The word list is None rather than a (possibly empty) list.
+FLAG_FUZZY = 2
+FLAG_UNRESOLVED = 4  # The node is a from_id placeholder. Its comp_id is the referenced ID.
+
+NO_SYMBOL = -1  # Missing group, unknown depth or span.
+
+# Every array of a FlatLogicalForm, in storage order.
+ARRAYS = ('comp_ids', 'flags', 'depths', 'groups', 'starts', 'ends',
+          'ind_offsets', 'ind_values', 'type_offsets', 'type_values', 'word_offsets', 'word_values',
+          'param_offsets', 'param_values',
+          'rg_offsets', 'role_offsets', 'role_names', 'child_offsets', 'children',
+          'roots')
+
+# Container format
+MAGIC = b'VCFFLAT\0'
+FORMAT_VERSION = 2
+ALIGNMENT = 8
+
+
+def encode_string(sym_id: int) -> int:
+    """
+    Children are either node indices or plain strings. Strings are stored as negative numbers.
+    :param sym_id: Symbol ID of a string child.
+    :return: The child value.
+    """
+    return -sym_id - 1
+
+
+def decode_string(child: int) -> int:
+    """
+    The inverse of encode_string.
+    :param child: A negative child value.
+    :return: Symbol ID of the string.
+    """
+    return -child - 1
+
+
+class _FlatBuilder:
+    """
+    Accumulates nodes as Python lists and freezes them into arrays once everything is known.
+    """
+
+    def __init__(self, symbols: SymbolTable):
+        self.symbols = symbols
+        self.comp_ids = []  # type: List[int]
+        self.flags = []  # type: List[int]
+        self.depths = []  # type: List[int]
+        self.groups = []  # type: List[int]
+        self.starts = []  # type: List[int]
+        self.ends = []  # type: List[int]
+        self.indicators = []  # type: List[List[int]]
+        self.types = []  # type: List[List[int]]
+        self.words = []  # type: List[List[int]]
+        self.params = []  # type: List[List[int]]
+        self.roles = []  # type: List[List[List[Tuple[int, List[int]]]]]  # node -> rolegroup -> (name, children)
+        self.roots = []  # type: List[int]
+
+    def add_node(self, comp_id: str) -> int:
+        """
+        Append an empty node.
+        :param comp_id: Component ID.
+        :return: Index of the new node.
+        """
+        self.comp_ids.append(self.symbols.intern(comp_id))
+        self.flags.append(0)
+        self.depths.append(NO_SYMBOL)
+        self.groups.append(NO_SYMBOL)
+        self.starts.append(NO_SYMBOL)
+        self.ends.append(NO_SYMBOL)
+        self.indicators.append([])
+        self.types.append([])
+        self.words.append([])
+        self.params.append([])
+        self.roles.append([[]])
+        return len(self.comp_ids) - 1
+
+    def measure_depths(self, root: int):
+        """
+        Record the shortest distance from the root to every node, as LogicalForm does for parsed sentences.
+        :param root: Root node index.
+        """
+        self.depths[root] = 0
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            for rg in self.roles[node]:
+                for _, children in rg:
+                    for c in children:
+                        if c >= 0 and self.depths[c] == NO_SYMBOL:
+                            self.depths[c] = self.depths[node] + 1
+                            queue.append(c)
+
+    def freeze(self, from_xml: bool, text: str = None) -> 'FlatLogicalForm':
+        """
+        Convert the accumulated nodes into a FlatLogicalForm.
+        :param from_xml: Whether the nodes came from a TRIPS reply.
+        :param text: The utterance of a sentence, if known.
+        :return:
+        """
+        arrays = {
+            'comp_ids': np.array(self.comp_ids, dtype=np.int32),
+            'flags': np.array(self.flags, dtype=np.uint8),
+            'depths': np.array(self.depths, dtype=np.int32),
+            'groups': np.array(self.groups, dtype=np.int32),
+            'starts': np.array(self.starts, dtype=np.int32),
+            'ends': np.array(self.ends, dtype=np.int32),
+            'roots': np.array(self.roots, dtype=np.int32),
+        }
+        arrays['ind_offsets'], arrays['ind_values'] = _csr(self.indicators)
+        arrays['type_offsets'], arrays['type_values'] = _csr(self.types)
+        arrays['word_offsets'], arrays['word_values'] = _csr(self.words)
+        arrays['param_offsets'], arrays['param_values'] = _csr(self.params)
+
+        rolegroups = [rg for node_rgs in self.roles for rg in node_rgs]
+        roles = [role for rg in rolegroups for role in rg]
+        arrays['rg_offsets'], _ = _csr(self.roles, values=False)
+        arrays['role_offsets'], _ = _csr(rolegroups, values=False)
+        arrays['role_names'] = np.array([name for name, _ in roles], dtype=np.int32)
+        arrays['child_offsets'], arrays['children'] = _csr([children for _, children in roles])
+
+        return FlatLogicalForm(self.symbols, arrays, from_xml, text)
+
+
+def _csr(lists: List[List], values: bool = True) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Pack a list of lists into an offsets array and a flat values array.
+    :param lists: Lists to pack.
+    :param values: If false, only the offsets are built.
+    :return: (offsets, values)
+    """
+    offsets = np.zeros(len(lists) + 1, dtype=np.int32)
+    np.cumsum([len(lst) for lst in lists], out=offsets[1:])
+    if not values:
+        return offsets, None
+    return offsets, np.fromiter((v for lst in lists for v in lst), dtype=np.int32, count=int(offsets[-1]))
+
+
+class _FlatXmlBuilder:
+    """
+    Builds a FlatLogicalForm directly from the descriptions of a TRIPS reply, without creating Components.
+    """
+
+    def __init__(self, symbols: SymbolTable):
+        self._builder = _FlatBuilder(symbols)
+        self._nodes = {}  # type: Dict[str, int]
+        self._described = set()  # type: Set[str]
+        self._reader = TripsXmlReader(self._add)
+
+    def feed(self, data: Union[str, bytes]):
+        self._reader.feed(data)
+
+    def close(self) -> 'FlatLogicalForm':
+        self._reader.close()
+        if self._reader.root_id is None:
+            raise ValueError('TRIPS reply contains no components.')
+
+        missing = self._nodes.keys() - self._described
+        if missing:
+            raise ValueError(f'TRIPS reply refers to undefined components {", ".join(sorted(missing))}')
+
+        root = self._nodes[self._reader.root_id]
+        self._builder.roots.append(root)
+        self._builder.measure_depths(root)
+        return self._builder.freeze(from_xml=True, text=self._reader.text)
+
+    def _node(self, comp_id: str) -> int:
+        node = self._nodes.get(comp_id)
+        if node is None:
+            node = self._builder.add_node(comp_id)
+            self._nodes[comp_id] = node
+        return node
+
+    def _add(self, description: Description):
+        builder = self._builder
+        intern = builder.symbols.intern
+        node = self._node(description.comp_id)
+        self._described.add(description.comp_id)
+
+        builder.indicators[node].extend(intern(s) for s in description.indicator)
+        builder.types[node].extend(intern(s) for s in description.comp_type)
+        if description.word is None:
+            builder.flags[node] |= FLAG_NO_WORD
+        else:
+            builder.words[node].extend(intern(s) for s in description.word)
+        if description.start is not None and description.end is not None:
+            builder.starts[node], builder.ends[node] = description.start, description.end
+
+        roles = {}  # type: Dict[str, List[int]]
+        rolegroup = builder.roles[node][0]
+        for name, value, is_reference in description.roles:
+            children = roles.get(name)
+            if children is None:
+                children = roles[name] = []
+                rolegroup.append((intern(name), children))
+            children.append(self._node(value) if is_reference else encode_string(intern(value)))
+
+
+class FlatComponent(LogicalForm.Component):
+    """
+    A read-only Component backed by one node of a FlatLogicalForm. The fields are decoded from the arrays whenever
+    they are read, except for roles, which are built on first use. Nodes that are never looked at cost nothing, so a
+    library loaded from a memory-mapped file only has Python objects for the parts matching has actually visited.
+    Get instances through FlatLogicalForm.view, which returns the same view of a node every time.
+    """
+
+    def __init__(self, flat: 'FlatLogicalForm', node: int):
+        """
+        :param flat: The flat LF holding the node.
+        :param node: Node index.
+        """
+        # Component.__init__ is not called, since the fields are properties over the arrays.
+        self._flat = flat
+        self._node = node
+        self._roles = None  # type: Optional[List[Dict[str, List[Union[FlatComponent, str]]]]]
+        self._resolved = not int(flat.flags[node]) & FLAG_UNRESOLVED
+        self._fingerprint = None  # type: Optional[str]
+
+    def _strings(self, offsets: np.ndarray, values: np.ndarray) -> List[str]:
+        symbols = self._flat.symbols
+        return [symbols[v] for v in values[offsets[self._node]:offsets[self._node + 1]].tolist()]
+
+    @property
+    def comp_id(self) -> str:
+        return self._flat.symbols[int(self._flat.comp_ids[self._node])]
+
+    @property
+    def indicator(self) -> List[str]:
+        return self._strings(self._flat.ind_offsets, self._flat.ind_values)
+
+    @property
+    def comp_type(self) -> List[str]:
+        return self._strings(self._flat.type_offsets, self._flat.type_values)
+
+    @property
+    def word(self) -> Optional[List[str]]:
+        if int(self._flat.flags[self._node]) & FLAG_NO_WORD:
+            return None
+        return self._strings(self._flat.word_offsets, self._flat.word_values)
+
+    @property
+    def param_mapping(self) -> Dict[str, None]:
+        return {p: None for p in self._strings(self._flat.param_offsets, self._flat.param_values)}
+
+    @property
+    def group(self) -> str:
+        group = int(self._flat.groups[self._node])
+        return '' if group == NO_SYMBOL else self._flat.symbols[group]
+
+    @property
+    def fuzzy(self) -> bool:
+        return bool(int(self._flat.flags[self._node]) & FLAG_FUZZY)
+
+    @property
+    def depth(self) -> Optional[int]:
+        depth = int(self._flat.depths[self._node])
+        return None if depth == NO_SYMBOL else depth
+
+    @property
+    def start(self) -> Optional[int]:
+        start = int(self._flat.starts[self._node])
+        return None if start == NO_SYMBOL else start
+
+    @property
+    def end(self) -> Optional[int]:
+        end = int(self._flat.ends[self._node])
+        return None if end == NO_SYMBOL else end
+
+    @property
+    def _masks(self) -> Optional[Tuple[int, int, int]]:
+        surface = self._flat.surface
+        return None if surface is None else surface[self._node]
+
+    @property
+    def roles(self) -> List[Dict[str, List[Union['FlatComponent', str]]]]:
+        if self._roles is None:
+            flat = self._flat
+            symbols, view = flat.symbols, flat.view
+            roles = []
+            for rg in range(int(flat.rg_offsets[self._node]), int(flat.rg_offsets[self._node + 1])):
+                first, last = int(flat.role_offsets[rg]), int(flat.role_offsets[rg + 1])
+                rolegroup = {}
+                for role, name in zip(range(first, last), flat.role_names[first:last].tolist()):
+                    children = flat.children[flat.child_offsets[role]:flat.child_offsets[role + 1]].tolist()
+                    rolegroup[symbols[name]] = [symbols[decode_string(c)] if c < 0 else view(c) for c in children]
+                roles.append(rolegroup)
+            self._roles = roles
+        return self._roles
+
+
+class FlatLogicalForm:
+    """
+    One or more Logical Form graphs stored as flat arrays. Node 0 is not special; the roots array lists the entry
+    points, one per LF.
+    """
+
+    def __init__(self, symbols: SymbolTable, arrays: Dict[str, np.ndarray], from_xml: bool = False,
+                 text: str = None):
+        """
+        Wrap a set of arrays. Use one of the from_* factories to build a FlatLogicalForm.
+        :param symbols: The strings referenced by the arrays.
+        :param arrays: A value for every name in ARRAYS.
+        :param from_xml: Whether the LF came from a TRIPS reply.
+        :param text: The utterance of a sentence, which node spans refer to.
+        """
+        missing = [name for name in ARRAYS if name not in arrays]
+        if missing:
+            raise ValueError(f'Missing flat LF arrays: {", ".join(missing)}')
+
+        self.symbols = symbols
+        self.arrays = arrays
+        self.from_xml = from_xml
+        self.text = text
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self._views = {}  # type: Dict[int, FlatComponent]
+        # Surface masks of every node over the symbols of a template library, see encode_surface.
+        self.surface = None  # type: Optional[List[Tuple[int, int, int]]]
+
+    @property
+    def node_count(self) -> int:
+        return len(self.comp_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: The total size of the arrays, in bytes. The symbol table is not included.
+        """
+        return sum(a.nbytes for a in self.arrays.values())
+
+    """
+    Construction
+    """
+    @staticmethod
+    def from_xml(xml_string: Union[str, bytes], symbols: SymbolTable = None) -> 'FlatLogicalForm':
+        """
+        Build a flat LF straight from a TRIPS reply.
+        :param xml_string: The LF encoded string.
+        :param symbols: An optional table to intern strings into, allowing several flat LFs to share one.
+        :return:
+        """
+        builder = _FlatXmlBuilder(SymbolTable() if symbols is None else symbols)
+        builder.feed(xml_string)
+        return builder.close()
+
+    @staticmethod
+    def from_logical_form(lf: LogicalForm, symbols: SymbolTable = None) -> 'FlatLogicalForm':
+        """
+        Flatten a LogicalForm.
+        :param lf: A LogicalForm.
+        :param symbols: An optional table to intern strings into.
+        :return:
+        """
+        flat = FlatLogicalForm.from_components([lf._root], symbols)
+        flat.from_xml = lf.from_xml
+        flat.text = lf.text
+        return flat
+
+    @staticmethod
+    def from_components(roots: List[LogicalForm.Component], symbols: SymbolTable = None) -> 'FlatLogicalForm':
+        """
+        Flatten one or more component graphs into a single FlatLogicalForm. Components reachable from several
+        places, including from several roots, are stored once.
+        :param roots: Root components.
+        :param symbols: An optional table to intern strings into.
+        :return:
+        """
+        builder = _FlatBuilder(SymbolTable() if symbols is None else symbols)
+        intern = builder.symbols.intern
+        nodes = {}  # type: Dict[int, int]  # id(Component) -> node index
+
+        def node_of(cmp: LogicalForm.Component) -> int:
+            node = nodes.get(id(cmp))
+            if node is None:
+                node = builder.add_node(cmp.comp_id)
+                nodes[id(cmp)] = node
+                pending.append((cmp, node))
+            return node
+
+        pending = []  # type: List[Tuple[LogicalForm.Component, int]]
+        builder.roots.extend(node_of(root) for root in roots)
+        while pending:
+            cmp, node = pending.pop()
+            builder.flags[node] = (FLAG_NO_WORD if cmp.word is None else 0) | (FLAG_FUZZY if cmp.fuzzy else 0) | \
+                                  (0 if cmp._resolved else FLAG_UNRESOLVED)
+            builder.depths[node] = NO_SYMBOL if cmp.depth is None else cmp.depth
+            builder.groups[node] = intern(cmp.group) if cmp.group else NO_SYMBOL
+            if cmp.start is not None and cmp.end is not None:
+                builder.starts[node], builder.ends[node] = cmp.start, cmp.end
+            builder.indicators[node] = [intern(s) for s in cmp.indicator]
+            builder.types[node] = [intern(s) for s in cmp.comp_type]
+            builder.words[node] = [] if cmp.word is None else [intern(s) for s in cmp.word]
+            builder.params[node] = [intern(p) for p in cmp.param_mapping.keys()]
+            builder.roles[node] = [
+                [(intern(name), [encode_string(intern(c)) if isinstance(c, str) else node_of(c) for c in cs])
+                 for name, cs in rg.items()]
+                for rg in cmp.roles]
+
+        return builder.freeze(from_xml=False)
+
+    """
+    Conversion back to LogicalForm
+    """
+    def to_components(self) -> List[LogicalForm.Component]:
+        """
+        Rebuild the component graphs. Nodes shared in the flat form are shared by the components as well.
+        :return: The root components, in the order of the roots array.
+        """
+        symbols = self.symbols
+        strings = lambda offsets, values, i: [symbols[v] for v in values[offsets[i]:offsets[i + 1]].tolist()]
+
+        comps = []
+        for i in range(self.node_count):
+            flags = int(self.flags[i])
+            cmp = LogicalForm.Component(symbols[int(self.comp_ids[i])], resolved=not flags & FLAG_UNRESOLVED)
+            cmp.indicator = strings(self.ind_offsets, self.ind_values, i)
+            cmp.comp_type = strings(self.type_offsets, self.type_values, i)
+            cmp.word = None if flags & FLAG_NO_WORD else strings(self.word_offsets, self.word_values, i)
+            cmp.param_mapping = {p: None for p in strings(self.param_offsets, self.param_values, i)}
+            cmp.group = '' if self.groups[i] == NO_SYMBOL else symbols[int(self.groups[i])]
+            cmp.fuzzy = bool(flags & FLAG_FUZZY)
+            cmp.depth = None if self.depths[i] == NO_SYMBOL else int(self.depths[i])
+            if self.starts[i] != NO_SYMBOL:
+                cmp.start, cmp.end = int(self.starts[i]), int(self.ends[i])
+            comps.append(cmp)
+
+        rg_offsets, role_offsets = self.rg_offsets.tolist(), self.role_offsets.tolist()
+        child_offsets, children, role_names = self.child_offsets.tolist(), self.children.tolist(), \
+            self.role_names.tolist()
+        for i, cmp in enumerate(comps):
+            cmp.roles = []
+            for rg in range(rg_offsets[i], rg_offsets[i + 1]):
+                cmp.roles.append({
+                    symbols[role_names[role]]: [symbols[decode_string(c)] if c < 0 else comps[c]
+                                                for c in children[child_offsets[role]:child_offsets[role + 1]]]
+                    for role in range(role_offsets[rg], role_offsets[rg + 1])})
+
+        return [comps[r] for r in self.roots.tolist()]
+
+    def encode_surface(self, symbols: SymbolTable) -> NoReturn:
+        """
+        Encode the indicators, types, and words of every node as bitmasks over the symbol table of a template library,
+        like logical_form.surface_masks does for a Component. New values are added to the table. Only the arrays are
+        read, so no node is decoded.
+        :param symbols: The symbol table of the library.
+        :return: None
+        """
+        own, bits = self.symbols, {}  # type: SymbolTable, Dict[int, int]  # Own symbol ID -> mask bit
+
+        def masks(offsets: np.ndarray, values: np.ndarray) -> List[int]:
+            offsets, values = offsets.tolist(), values.tolist()
+            result = []
+            for first, last in zip(offsets, offsets[1:]):
+                if first == last:
+                    result.append(WILDCARD)
+                    continue
+                mask = 0
+                for v in values[first:last]:
+                    bit = bits.get(v)
+                    if bit is None:
+                        bit = bits[v] = 1 << symbols.intern(own[v])
+                    mask |= bit
+                result.append(mask)
+            return result
+
+        self.surface = list(zip(masks(self.ind_offsets, self.ind_values), masks(self.type_offsets, self.type_values),
+                                masks(self.word_offsets, self.word_values)))
+
+    def view(self, node: int) -> FlatComponent:
+        """
+        Get a Component view of a node, without converting anything else. A node always has the same view, so views
+        can be compared and memoized by identity like Components.
+        :param node: Node index.
+        :return:
+        """
+        result = self._views.get(node)
+        if result is None:
+            result = self._views[node] = FlatComponent(self, node)
+        return result
+
+    def to_logical_form(self, root: int = 0) -> LogicalForm:
+        """
+        Rebuild a LogicalForm.
+        :param root: Position of the LF in the roots array.
+        :return:
+        """
+        return LogicalForm._from_root(self.to_components()[root], self.from_xml, self.text)
+
+    """
+    Storage
+    """
+    def save(self, fp: BinaryIO) -> NoReturn:
+        """
+        Write this flat LF to a binary file handle.
+        :param fp: A file handle opened in binary mode.
+        :return: None
+        """
+        write_container(fp, {'kind': 'logical_form', 'from_xml': self.from_xml, 'text': self.text}, self.symbols,
+                        self.arrays)
+
+    @staticmethod
+    def load(path: str, mmap: bool = True) -> 'FlatLogicalForm':
+        """
+        Load a flat LF saved with save().
+        :param path: File path.
+        :param mmap: If true, the arrays are read-only views of a memory mapping of the file, which lets all
+            processes that load the same file share its pages.
+        :return:
+        """
+        header, symbols, arrays = read_container(path, mmap)
+        if header.get('kind') != 'logical_form':
+            raise ValueError(f'{path} does not contain a flat LogicalForm.')
+        return FlatLogicalForm(symbols, arrays, header['from_xml'], header.get('text'))
+
+
+"""
+Container format:
+    MAGIC, then little-endian uint32 format version and header length, then a UTF-8 JSON header, then the arrays.
+    The header records the dtype, offset, and length of every array, with offsets aligned to ALIGNMENT bytes.
+    The symbol table is stored as two arrays: the UTF-8 bytes of all symbols and their end offsets.
+"""
+
+
+def write_container(fp: BinaryIO, header: Dict[str, Any], symbols: SymbolTable,
+                    arrays: Dict[str, np.ndarray]) -> NoReturn:
+    """
+    Write a header and a set of named arrays.
+    :param fp: A file handle opened in binary mode.
+    :param header: JSON-serializable metadata.
+    :param symbols: The symbol table referenced by the arrays.
+    :param arrays: Arrays to store.
+    :return: None
+    """
+    encoded = [s.encode('utf-8') for s in symbols]
+    arrays = dict(arrays)
+    arrays['symbol_ends'] = np.cumsum([len(s) for s in encoded], dtype=np.int64)
+    arrays['symbol_data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    # Array offsets are relative to the start of the data section, so the header can be serialized before the data.
+    layout = {}
+    position = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        position = _align(position)
+        layout[name] = [array.dtype.newbyteorder('<').str, position, int(array.size)]
+        position += array.nbytes
+
+    header = dict(header, arrays=layout)
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    prefix = MAGIC + struct.pack('<II', FORMAT_VERSION, len(header_bytes)) + header_bytes
+    data_start = _align(len(prefix))
+
+    fp.write(prefix)
+    fp.write(b'\0' * (data_start - len(prefix)))
+    written = 0
+    for name, array in arrays.items():
+        offset = layout[name][1]
+        fp.write(b'\0' * (offset - written))
+        fp.write(array.astype(layout[name][0], copy=False).tobytes())
+        written = offset + array.nbytes
+
+
+def read_container(path: str, mmap: bool = True) -> Tuple[Dict[str, Any], SymbolTable, Dict[str, np.ndarray]]:
+    """
+    Read a file written by write_container.
+    :param path: File path.
+    :param mmap: If true, map the file into memory instead of reading it.
+    :return: The header, the symbol table, and the arrays.
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{path} is not a compiled LogicalForm file.')
+
+    version, header_len = struct.unpack('<II', bytes(buffer[len(MAGIC):len(MAGIC) + 8]))
+    if version != FORMAT_VERSION:
+        raise ValueError(f'{path} has format version {version}, expected {FORMAT_VERSION}.')
+
+    header_start = len(MAGIC) + 8
+    header = json.loads(bytes(buffer[header_start:header_start + header_len]).decode('utf-8'))
+    data_start = _align(header_start + header_len)
+
+    arrays = {}
+    for name, (dtype, offset, size) in header.pop('arrays').items():
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        arrays[name] = buffer[start:start + size * dtype.itemsize].view(dtype)
+
+    data = bytes(arrays.pop('symbol_data'))
+    ends = arrays.pop('symbol_ends').tolist()
+    symbols = SymbolTable(data[start:end].decode('utf-8') for start, end in zip([0] + ends, ends))
+    return header, symbols, arrays
+
+
+def _align(position: int) -> int:
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
@@ -7,47 +7,421 @@ An interface for TRIPS Web API.
 
 import requests
 import argparse
+from typing import *
+from logging import warning
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
+from threading import Lock
+from time import perf_counter
+from xml.parsers.expat import ExpatError
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from framework.semantic_tools.logical_form import LogicalForm
+from framework.semantic_tools.parse_cache import ParseCache, normalize
+from framework.semantic_tools.trips_cassette import Cassette
+from framework.single_flight import SingleFlight
+
+# The outcome of one parse of TripsAPI.parse_many. 'latency' is the number of seconds from sending the request to
+# having the LF, and 'error' describes the failure if the LF is empty because of one.
+ParseResult = namedtuple('ParseResult', ['sentence', 'lf', 'latency', 'error'])
+
+# What a reply that is not a Logical Form raises, e.g. an error page served with a success status.
+REPLY_ERRORS = (ValueError, ExpatError)
+
+HEDGE_WINDOW = 200  # Number of recent requests the hedge delay and the hedge rate are computed over.
+HEDGE_MIN_SAMPLES = 20  # Requests are not hedged until this many latencies are known.
+
+
+class _HedgePolicy:
+    """
+    Decides when a request to the parser is hedged with a duplicate: once it has been in flight for longer than a
+    percentile of the recent latencies, and only as long as few enough of the recent requests were hedged.
+    """
+
+    def __init__(self, percentile: float, rate: float, clock: Callable[[], float] = perf_counter):
+        """
+        :param percentile: The percentile of recent latencies after which a request is hedged, e.g. 95.
+        :param rate: The largest fraction of recent requests that may be hedged.
+        :param clock: Gives the current time in seconds. Latencies are measured with it.
+        """
+        self.percentile = percentile
+        self.rate = rate
+        self.clock = clock
+        self.hedged = 0  # Total hedged requests.
+        self.won = 0  # Total hedged requests answered by the duplicate first.
+        self._latencies = deque(maxlen=HEDGE_WINDOW)  # type: Deque[float]
+        self._decisions = deque(maxlen=HEDGE_WINDOW)  # type: Deque[bool]
+        self._lock = Lock()
+
+    def observe(self, started: float) -> NoReturn:
+        """
+        Record the latency of a request that just completed.
+        :param started: When the request was sent, as given by the clock.
+        :return: None
+        """
+        latency = self.clock() - started
+        with self._lock:
+            self._latencies.append(latency)
+
+    def delay(self) -> Optional[float]:
+        """
+        :return: Seconds to wait for a reply before hedging, or None if too few latencies are known yet.
+        """
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def decide(self, late: bool) -> bool:
+        """
+        Record whether a request was late, and decide whether it is hedged.
+        :param late: True if the request was still in flight after the hedge delay.
+        :return: True if the request should be hedged now.
+        """
+        with self._lock:
+            hedge = late and sum(self._decisions) + 1 <= self.rate * HEDGE_WINDOW
+            self._decisions.append(hedge)
+            if hedge:
+                self.hedged += 1
+            return hedge
+
+    def record_win(self) -> NoReturn:
+        """
+        Record that the duplicate of a hedged request was answered first.
+        :return: None
+        """
+        with self._lock:
+            self.won += 1
 
 
 class TripsAPI:
     """
-    A wrapper interface to communicate with the web TRIPS API.
+    A client of the web TRIPS API. Requests go through a pooled session, so consecutive parses reuse a kept-alive
+    connection instead of opening a new one for every utterance.
     """
 
-    _URL = "http://trips.ihmc.us/parser/cgi/parse"
+    DEFAULT_URL = "http://trips.ihmc.us/parser/cgi/parse"
+
+    # Statuses worth retrying: the parser or a proxy in front of it is temporarily unavailable.
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    # Bytes of a streamed reply read at a time. Small enough for parsing to keep up with the transfer.
+    CHUNK_SIZE = 1024
+
+    def __init__(self, url: str = None, connect_timeout: float = 3.05, read_timeout: float = 30.0,
+                 retries: int = 3, backoff: float = 0.5, pool_size: int = 4,
+                 cache: Union[ParseCache, str, None] = None, record: Union[Cassette, str, None] = None,
+                 hedge_percentile: float = None, hedge_url: str = None, hedge_rate: float = 0.05,
+                 coalesce: bool = True, stream: bool = True):
+        """
+        Create a new client.
+        :param url: The parse endpoint. Defaults to the public TRIPS parser; point it at a replica to use that instead.
+        :param connect_timeout: Seconds to wait for a connection to the parser.
+        :param read_timeout: Seconds to wait for the parser to reply once connected. Parsing long sentences is slow.
+        :param retries: How many times a failed request is retried. 0 disables retries.
+        :param backoff: Backoff factor between retries. The n-th retry waits backoff * 2^(n-1) seconds.
+        :param pool_size: Number of connections kept alive, which bounds the number of parses run at once.
+        :param cache: A ParseCache, or the path of one, to reuse the replies of earlier parses. None disables caching.
+        :param record: A Cassette, or the path of one, to record every reply into. trips_cassette.ReplayServer can
+            then stand in for the parser.
+        :param hedge_percentile: If set, a request still unanswered after this percentile of the recent latencies is
+            hedged: a duplicate is sent, and whichever reply comes first is used. None disables hedging.
+        :param hedge_url: Where duplicate requests go. Defaults to the parse endpoint itself.
+        :param hedge_rate: The largest fraction of recent requests that may be hedged, which bounds the extra load
+            on the parser.
+        :param coalesce: If True, a parse of a sentence that is already being parsed waits for the reply to the
+            first one instead of sending its own request.
+        :param stream: If True, a reply is parsed into a LogicalForm as it arrives, instead of once it is complete.
+            Hedged requests are never streamed, since only the first complete reply is used.
+        """
+        self.url = url or TripsAPI.DEFAULT_URL
+        self.timeout = (connect_timeout, read_timeout)
+        # A cache opened from a path belongs to this client and is closed with it.
+        self._owns_cache = isinstance(cache, str)
+        self.cache = ParseCache(cache) if self._owns_cache else cache  # type: Optional[ParseCache]
+        self.cassette = Cassette(record) if isinstance(record, str) else record  # type: Optional[Cassette]
+        self.hedge_url = hedge_url
+        self._hedge = None if hedge_percentile is None else _HedgePolicy(hedge_percentile, hedge_rate)
+        self._flights = SingleFlight() if coalesce else None  # type: Optional[SingleFlight]
+        self.stream = stream
+
+        # Parsing has no side effects, so POST requests are safe to retry.
+        self._retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                            status_forcelist=TripsAPI.RETRY_STATUSES, allowed_methods=frozenset(['POST']),
+                            raise_on_status=False)
+        self._session = requests.Session()
+        # The pools are sized once, since requests may be in flight on them from any thread at any time. A hedged
+        # parse may have two requests in flight, possibly to two hosts.
+        self.pool_size = pool_size
+        hosts = 2 if self._hedge and self.hedge_url else 1
+        connections = 2 * pool_size if self._hedge else pool_size
+        adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=connections, max_retries=self._retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._hedge_pool = None  # type: Optional[ThreadPoolExecutor]
+        if self._hedge is not None:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='trips-hedge')
+
+    def parse(self, sentence: str) -> LogicalForm:
+        """
+        Convert a sentence to Logical Form.
+        :param sentence: A recognized sentence string.
+        :return: A LogicalForm instance. The LogicalForm is empty if the parser could not be reached, or kept failing
+            after all retries.
+        :raises ValueError, ExpatError: If the reply is not a Logical Form.
+        """
+        try:
+            return self._parse(sentence)
+        except requests.RequestException as e:
+            warning(f'There was an error processing a web request: {e}')
+            # LogicalForm(None) rejects the missing reply, so build the empty LF directly. It matches no template.
+            return LogicalForm._from_root(None, True)
 
-    @staticmethod
-    def parse(sentence: str) -> LogicalForm:
+    def _parse(self, sentence: str) -> LogicalForm:
         """
         Convert a sentence to Logical Form.
         :param sentence: A recognized sentence string.
         :return: A LogicalForm instance.
+        :raises requests.RequestException: If the parser could not be reached, or kept failing after all retries.
+        :raises ValueError, ExpatError: If the reply is not a Logical Form.
+        """
+        xml_str, lf = self._lookup(sentence, True)
+        return LogicalForm(xml_str) if lf is None else lf
+
+    def fetch(self, sentence: str) -> Optional[str]:
+        """
+        Get the raw reply of the parser to a sentence, from the cache if possible.
+        :param sentence: A recognized sentence string.
+        :return: The reply XML, or None if the parser could not be reached, kept failing after all retries, or did not
+            reply with a Logical Form.
+        """
+        try:
+            return self._request(sentence)
+        except requests.RequestException as e:
+            warning(f'There was an error processing a web request: {e}')
+            return None
+        except REPLY_ERRORS as e:
+            warning(f'The parser did not reply with a Logical Form: {e}')
+            return None
+
+    def _request(self, sentence: str) -> str:
+        """
+        Get the raw reply of the parser to a sentence, from the cache if possible.
+        :param sentence: A recognized sentence string.
+        :return: The reply XML.
+        :raises requests.RequestException: If the parser could not be reached, or kept failing after all retries.
+        :raises ValueError, ExpatError: If the reply is not a Logical Form.
+        """
+        return self._lookup(sentence, False)[0]
+
+    def _lookup(self, sentence: str, build: bool) -> Tuple[str, Optional[LogicalForm]]:
+        """
+        Get the raw reply of the parser to a sentence, from the cache if possible.
+        :param sentence: A recognized sentence string.
+        :param build: Whether the LogicalForm of the reply is wanted, so that it is worth building while the reply
+            streams in.
+        :return: The reply XML, and its LogicalForm unless the reply was cached.
+        :raises requests.RequestException: If the parser could not be reached, or kept failing after all retries.
+        :raises ValueError, ExpatError: If the reply is not a Logical Form.
+        """
+        if self.cache is not None:
+            xml_str = self.cache.get(sentence, self.url)
+            if xml_str is not None:
+                if self.cassette is not None:
+                    self.cassette.record(sentence, xml_str)
+                return xml_str, None
+
+        # Sentences are coalesced the way they are cached. The LogicalForm of a sentence is never modified, so
+        # coalesced parses share it.
+        if self._flights is None:
+            return self._upstream(sentence, build)
+        return self._flights.do(normalize(sentence), self._upstream, sentence, build)
+
+    def _upstream(self, sentence: str, build: bool) -> Tuple[str, Optional[LogicalForm]]:
+        """
+        Get the raw reply of the parser to a sentence from the parser itself, and keep it.
+        :param sentence: A recognized sentence string.
+        :param build: Whether to build the LogicalForm of the reply while it streams in.
+        :return: The reply XML, and its LogicalForm.
+        :raises requests.RequestException: If the parser could not be reached, or kept failing after all retries.
+        :raises ValueError, ExpatError: If the reply is not a Logical Form.
+        """
+        lf = None
+        if build and self.stream and self._hedge is None:
+            xml_str, lf = self._stream_post(sentence)
+        elif self._hedge is None:
+            xml_str = self._post(self.url, sentence).text
+        else:
+            xml_str = self._hedged_post(sentence).text
+
+        # Only replies that are Logical Forms are kept, so a failure, or a page from a proxy that stands in for the
+        # parser, is retried by the next parse.
+        if lf is None:
+            lf = LogicalForm(xml_str)
+        if self.cache is not None:
+            self.cache.put(sentence, self.url, xml_str)
+        if self.cassette is not None:
+            self.cassette.record(sentence, xml_str)
+        return xml_str, lf
+
+    def _stream_post(self, sentence: str) -> Tuple[str, LogicalForm]:
+        """
+        Send a sentence to the parser, and build its LogicalForm while the reply is being received.
+        :param sentence: A recognized sentence string.
+        :return: The reply XML and its LogicalForm.
+        :raises requests.RequestException: If the parser could not be reached, or kept failing after all retries.
+        """
+        chunks = []  # type: List[bytes]
+
+        def received(reply: requests.Response) -> Iterator[bytes]:
+            for chunk in reply.iter_content(TripsAPI.CHUNK_SIZE):
+                chunks.append(chunk)
+                yield chunk
+
+        with self._session.post(self.url, data={"input": sentence}, timeout=self.timeout, stream=True) as reply:
+            reply.raise_for_status()
+            # The whole body is read, so that the cached reply is exactly the one received.
+            lf = LogicalForm.from_chunks(received(reply))
+        return b''.join(chunks).decode(reply.encoding or 'utf-8', errors='replace'), lf
+
+    def _post(self, url: str, sentence: str) -> requests.Response:
+        """
+        Send a sentence to the parser.
+        :param url: The parse endpoint.
+        :param sentence: A recognized sentence string.
+        :return: The successful reply.
+        :raises requests.RequestException: If the parser could not be reached, or kept failing after all retries.
         """
         # TODO: This is a decision point. Sometime later I need to determine if I'll be doing any cleaning to the
         # sentence (which just came out of Google Speech), or if I'm using it "as is".
         post_data = {"input": sentence}
-        reply = None
 
+        started = None if self._hedge is None else self._hedge.clock()
+        reply = self._session.post(url, data=post_data, timeout=self.timeout)
+        reply.raise_for_status()
+        if self._hedge is not None and url == self.url:
+            self._hedge.observe(started)
+        return reply
+
+    def _hedged_post(self, sentence: str) -> requests.Response:
+        """
+        Send a sentence to the parser, and hedge the request with a duplicate if it is late.
+        A request cannot be interrupted once sent, so the slower of the two is left to finish on its own, and its
+        reply is dropped.
+        :param sentence: A recognized sentence string.
+        :return: The first successful reply.
+        :raises requests.RequestException: If both requests failed.
+        """
+        delay = self._hedge.delay()
+        primary = self._hedge_pool.submit(self._post, self.url, sentence)
+        if delay is None:
+            return primary.result()
+        try:
+            reply = primary.result(timeout=delay)
+            self._hedge.decide(False)
+            return reply
+        except TimeoutError:
+            if not self._hedge.decide(True):
+                return primary.result()
+
+        duplicate = self._hedge_pool.submit(self._post, self.hedge_url or self.url, sentence)
+        pending, error = {primary, duplicate}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is duplicate:
+                        self._hedge.record_win()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    @property
+    def hedge_stats(self) -> Dict[str, Any]:
+        """
+        :return: The current hedge delay in seconds (None until enough latencies are known), the number of hedged
+            requests, and how many of them the duplicate answered first.
+        """
+        if self._hedge is None:
+            return {'delay': None, 'hedged': 0, 'won': 0}
+        return {'delay': self._hedge.delay(), 'hedged': self._hedge.hedged, 'won': self._hedge.won}
+
+    @property
+    def coalesce_stats(self) -> Dict[str, int]:
+        """
+        :return: The number of requests sent to the parser, the number of parses that waited for the reply to
+            another parse of the same sentence instead, and the number of requests in flight.
+        """
+        if self._flights is None:
+            return {'calls': 0, 'coalesced': 0, 'in_flight': 0}
+        return self._flights.stats
+
+    def parse_many(self, sentences: Iterable[str], on_result: Callable[[ParseResult], Any] = None) -> List[ParseResult]:
+        """
+        Parse many sentences, keeping several requests in flight at once. Parsing is dominated by waiting for the
+        parser, so a pool of threads is enough to overlap the requests. As many requests are in flight as the
+        connection pool holds.
+        :param sentences: Sentences to parse.
+        :param on_result: Called with every result as soon as it and all the results before it are done, e.g. to
+            report progress.
+        :return: A ParseResult for every sentence, in the order of the sentences. Failed parses, including ones whose
+            reply is not a Logical Form, have an empty LF and a description of the error instead of raising it.
+        """
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            results = []
+            for result in pool.map(self._timed_parse, sentences):
+                if on_result is not None:
+                    on_result(result)
+                results.append(result)
+        return results
+
+    def _timed_parse(self, sentence: str) -> ParseResult:
+        """
+        Parse a sentence for parse_many.
+        :param sentence: A recognized sentence string.
+        :return:
+        """
+        start = perf_counter()
         try:
-            reply = requests.post(TripsAPI._URL, post_data)
-        except Exception as e:
-            print(f'There was an error processing a web request: {e}')
-            return LogicalForm(None)
+            lf = self._parse(sentence)
+        except (requests.RequestException,) + REPLY_ERRORS as e:
+            return ParseResult(sentence, LogicalForm._from_root(None, True), perf_counter() - start, str(e))
+        return ParseResult(sentence, lf, perf_counter() - start, None)
 
-        xml_str = reply.text
-        return LogicalForm(xml_str)
+    def close(self) -> NoReturn:
+        """
+        Close the connections kept alive by this client, and its cache if it opened one.
+        :return: None
+        """
+        self._session.close()
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False)
+        if self._owns_cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("text", help="Text to be semantically parsed.")
+    arg_parser.add_argument("-u", "--url", type=str, default=TripsAPI.DEFAULT_URL,
+                            help="The TRIPS parse endpoint.")
+    arg_parser.add_argument("-c", "--cache", type=str, default=None,
+                            help="A parse cache file to reuse earlier replies from.")
+    arg_parser.add_argument("-r", "--record", type=str, default=None,
+                            help="A cassette directory to record the reply into.")
     args = arg_parser.parse_args()
 
     print(f'Parsing into AMR:\t{args.text}')
-    api = TripsAPI()
-    lf = api.parse(args.text)
+    with TripsAPI(args.url, cache=args.cache, record=args.record) as api:
+        lf = api.parse(args.text)
 
     print(lf.pretty_format())
-
@@ -7,8 +7,14 @@ A class hierarchy for a compact and simplified AMR Logical Form representation.
 CS 788.01 MS Capstone Project
 """
 from typing import *
+from collections import deque
+from itertools import islice
+from hashlib import blake2b
 from bs4 import BeautifulSoup, NavigableString, Tag, Comment
 
+from framework.semantic_tools.trips_xml import TripsXmlReader, Description
+from framework.semantic_tools.symbols import SymbolTable
+
 
 class CommandTemplateError(Exception):
     """
@@ -17,6 +23,63 @@ class CommandTemplateError(Exception):
     pass
 
 
+# Component surface features are encoded as bitmasks over the SymbolTable of a template library, which starts with
+# UNKNOWN_SYMBOL. Sentence values that no template of the library uses all map to the UNKNOWN bit, and an empty list is
+# encoded as WILDCARD, which overlaps with everything.
+UNKNOWN_SYMBOL = '\0unknown'
+UNKNOWN = 1  # The bit of symbol 0.
+WILDCARD = -1  # All bits set.
+
+
+def surface_mask(values: Optional[List[str]], symbols: SymbolTable, intern: bool = False) -> int:
+    """
+    Encode a list of indicators, types, or words as a bitmask over the symbols of a template library.
+    :param values: The list. An empty list or None is a wildcard.
+    :param symbols: The symbol table of the library.
+    :param intern: Templates add their values to the table while the library is loaded. Sentences only look them up,
+        since a value no template uses can only ever overlap with a wildcard.
+    :return: The mask.
+    """
+    if not values:
+        return WILDCARD
+
+    lookup = symbols.intern if intern else symbols.get
+    mask = 0
+    for v in values:
+        sym_id = lookup(v)
+        mask |= UNKNOWN if sym_id is None else 1 << sym_id
+    return mask
+
+
+def surface_masks(cmp, symbols: SymbolTable, intern: bool = False) -> Tuple[int, int, int]:
+    """
+    Encode the indicators, types, and words of a component, see surface_mask.
+    :param cmp: A LogicalForm.Component.
+    :param symbols: The symbol table of a template library.
+    :param intern: Whether to add new values to the table.
+    :return: The (indicator, type, word) masks.
+    """
+    return (surface_mask(cmp.indicator, symbols, intern), surface_mask(cmp.comp_type, symbols, intern),
+            surface_mask(cmp.word, symbols, intern))
+
+
+def write_lines(fp: TextIO, lines: Iterable[str], chunk_size: int = 1024) -> NoReturn:
+    """
+    Write a stream of short strings to a text file handle. They are joined in chunks first, since a write call per
+    line costs more than the lines themselves.
+    :param fp: A file handle opened in text mode.
+    :param lines: The strings to write.
+    :param chunk_size: Number of strings joined per write.
+    :return: None
+    """
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            break
+        fp.write(''.join(chunk))
+
+
 # TODO: Move to utilities?
 def compose(f: Callable, g: Callable) -> Callable:
     """
@@ -29,6 +92,117 @@ def compose(f: Callable, g: Callable) -> Callable:
     return lambda x: f(g(x))
 
 
+# The outcome of a successful comparison: (sentence component or string, template component, bindings of the
+# matched roles in order). Nothing is bound while searching; LogicalForm._bind reads the dictionaries off the
+# bindings of the final match.
+Binding = Tuple[Any, Any, Sequence]
+NO_ROLES = ()
+
+
+class MatchMemo(dict):
+    """
+    The memo of a sentence matched against the templates of one library: the outcomes of decided comparisons, keyed
+    by the identities of both components, and the surface masks of the sentence components over the symbol table of
+    the library. It belongs to a single matching call, so the sentence itself is never modified.
+    """
+
+    def __init__(self, symbols: SymbolTable):
+        """
+        :param symbols: The frozen symbol table of the library.
+        """
+        super().__init__()
+        self.symbols = symbols
+        self.masks = {}  # type: Dict[int, Tuple[int, int, int]]  # id(sentence component) -> masks
+
+
+class _MatchFrame:
+    """
+    A pending (sentence component, template component) comparison on the explicit matching stack.
+    Frames are only created once the surface features of both components agree.
+    """
+    __slots__ = ('this', 'other', 'memo', 'pairs', 'this_rg', 'other_rg', 'names', 'name', 'cand', 'matched')
+
+    def __init__(self, this, other, memo: Optional[Dict]):
+        self.this = this
+        self.other = other
+        self.memo = memo  # Outcomes of the comparisons already decided while matching this sentence.
+        # Lazily pair up every sentence rolegroup with each template rolegroup whose roles are a subset of it.
+        self.pairs = ((rg, rg_other) for rg in this.roles for rg_other in other.roles if rg_other.keys() <= rg.keys())
+        self.this_rg = None
+        self.other_rg = None
+        self.names = None  # Iterator over the role names of the current sentence rolegroup.
+        self.name = None  # The role currently being matched.
+        self.cand = 0  # Index of the template candidate currently being tried for the role.
+        self.matched = []  # Results of the roles matched so far within the current rolegroup pair.
+
+    def next_pair(self) -> bool:
+        """
+        Move on to the next candidate rolegroup pair, discarding anything matched under the previous one.
+        :return: False if there are no more rolegroup pairs to try.
+        """
+        pair = next(self.pairs, None)
+        if pair is None:
+            return False
+
+        self.this_rg, self.other_rg = pair
+        self.names = iter(self.this_rg)
+        self.name = None
+        self.matched = []
+        return True
+
+    def step(self):
+        """
+        Advance the comparison until it either needs to descend into a child or is decided.
+        :return: A child _MatchFrame to descend into, None if this frame failed, or a Binding.
+        """
+        while True:
+            if self.name is None:
+                # Pick the next sentence role the template cares about. Roles the template does not mention are
+                # a match by default and bind nothing.
+                for name in self.names:
+                    if name in self.other_rg:
+                        self.name = name
+                        self.cand = 0
+                        break
+                else:
+                    # Every role of this rolegroup pair matched.
+                    return self.finish()
+
+            candidates = self.other_rg[self.name]
+            if self.cand == len(candidates):
+                # No template option matched the role, so the whole rolegroup pair fails.
+                if not self.next_pair():
+                    return None
+                continue
+
+            child = LogicalForm._open(self.this_rg[self.name][0], candidates[self.cand], self.memo)
+            if child is None:
+                self.cand += 1
+            elif isinstance(child, _MatchFrame):
+                return child
+            else:
+                self.resume(child)
+
+    def resume(self, outcome):
+        """
+        Record the outcome of the candidate that was being tried for the current role.
+        :param outcome: None for a failed candidate, a Binding otherwise.
+        :return: None
+        """
+        if outcome is None:
+            self.cand += 1  # Try the next template option.
+        else:
+            self.matched.append(outcome)
+            self.name = None  # Short-circuit: the remaining options for this role are never evaluated.
+
+    def finish(self) -> Binding:
+        """
+        Record a successfully matched frame. The list of matched roles is not touched again, so it is kept as is.
+        :return: The Binding of this frame.
+        """
+        return self.this, self.other, self.matched
+
+
 class LogicalForm:
     """
     A simplified programmatic representation of the TRIPS Logical Form
@@ -38,7 +212,6 @@ class LogicalForm:
         """
         A component of the LF tree structure.
         """
-
         def __init__(self, comp_id: str, indicator: str = None, comp_type: str = None, word: str = None,
                      resolved: bool = True):
             """
@@ -58,7 +231,14 @@ class LogicalForm:
             self._resolved = resolved
             self.group = ""  # Each component may have exactly one group associated.
             self.fuzzy = False
-            self.tagged = False
+            self.depth = None  # type: Optional[int]  # Distance from the root. Only known for parsed sentences.
+            # Character offsets of the span of the utterance this component covers. Only known for parsed sentences.
+            self.start = None  # type: Optional[int]
+            self.end = None  # type: Optional[int]
+            self._fingerprint = None  # type: Optional[str]
+            # Bitmasks of the indicators, types, and words of a template component over the symbols of its library.
+            # Set by the TemplateManager as the library is loaded. Sentence components never have any.
+            self._masks = None  # type: Optional[Tuple[int, int, int]]
 
             # Optionally, the component may have a set of roles.
             # SPEECHACTs have a CONTENT role, a PUT has AGENT, AFFECTED, and some more.
@@ -112,6 +292,8 @@ class LogicalForm:
             self._resolved = other._resolved
             self.roles = other.roles
             self.fuzzy = other.fuzzy
+            self._fingerprint = None
+            self._masks = None
 
         def __str__(self):
             """
@@ -134,6 +316,7 @@ class LogicalForm:
         def __hash__(self):
             """
             For simplicity, components are issued with unique IDs for hashing.
+            Use fingerprint or same_structure to compare components by content instead.
             :return:
             """
             return hash(self.comp_id)
@@ -141,6 +324,27 @@ class LogicalForm:
         def __eq__(self, other):
             return isinstance(other, LogicalForm.Component) and self.comp_id == other.comp_id
 
+        @property
+        def fingerprint(self) -> str:
+            """
+            A stable structural hash of this component and everything nested under it. It covers indicators, types,
+            words, parameter mappings, groups, fuzziness, and roles, but not component IDs, so identical structures
+            get the same fingerprint regardless of where they came from. The fingerprints of a subtree are computed
+            once and cached, so the subtree must not be modified afterwards.
+            :return: A hexadecimal digest.
+            """
+            if self._fingerprint is None:
+                LogicalForm._fingerprint(self)
+            return self._fingerprint
+
+        def same_structure(self, other) -> bool:
+            """
+            Compare two components by their fingerprints.
+            :param other: Another Component.
+            :return:
+            """
+            return isinstance(other, LogicalForm.Component) and self.fingerprint == other.fingerprint
+
         @property
         def resolved(self):
             """
@@ -196,20 +400,71 @@ class LogicalForm:
         self._root = None  # type: Union[LogicalForm.Component, None]
         self._require_id = require_id
         self._resolved = False  # Are there any components with a pending from_id?
+        self.text = None  # type: Optional[str]  # The parsed utterance. Only known for sentences.
 
         if xml_str:
-            self._root = LogicalForm._process_xml(xml_str)
+            self._root, self.text = LogicalForm._read_xml(xml_str)
+            # Sentence LFs are never modified after parsing, so their depths can be measured once up front.
+            LogicalForm._measure_depths(self._root)
             self.from_xml = True
         else:
             self._root = self._process_template(template)
             self.from_xml = False
 
+    @staticmethod
+    def _from_root(root: Component, from_xml: bool, text: str = None) -> 'LogicalForm':
+        """
+        Wrap an already built component hierarchy, i.e. one converted from another representation.
+        :param root: The root component.
+        :param from_xml: Whether the hierarchy came from a TRIPS reply.
+        :param text: The utterance of a sentence, if known.
+        :return:
+        """
+        lf = LogicalForm.__new__(LogicalForm)
+        lf._root = root
+        lf._require_id = False
+        lf._resolved = False
+        lf.from_xml = from_xml
+        lf.text = text
+        return lf
+
+    @staticmethod
+    def from_chunks(chunks: Iterable[Union[str, bytes]]) -> 'LogicalForm':
+        """
+        Build a LogicalForm from a TRIPS reply that arrives in pieces, e.g. from a network stream. Every component is
+        built as soon as its description has been read, so only the depths are left for the end of the reply.
+        :param chunks: Consecutive pieces of the TRIPS parser output.
+        :return: The same LogicalForm as LogicalForm(xml_str) would give for the whole reply.
+        """
+        linker = _XmlLinker()
+        for chunk in chunks:
+            linker.feed(chunk)
+        root = linker.close()
+        LogicalForm._measure_depths(root)
+        return LogicalForm._from_root(root, True, linker.text)
+
     def __str__(self):
         return f'LogicalForm {self.my_id}'
 
     def __repr__(self):
         return self.__str__()
 
+    @property
+    def fingerprint(self) -> Optional[str]:
+        """
+        A stable structural hash of this LogicalForm. Structurally identical LFs have equal fingerprints.
+        :return: A hexadecimal digest, or None for an empty LF.
+        """
+        return None if self._root is None else self._root.fingerprint
+
+    def same_structure(self, other) -> bool:
+        """
+        Compare two LogicalForms by their fingerprints.
+        :param other: Another LogicalForm.
+        :return:
+        """
+        return isinstance(other, LogicalForm) and self.fingerprint == other.fingerprint
+
     @property
     def bindings(self) -> Set[str]:
         """
@@ -227,42 +482,193 @@ class LogicalForm:
         return self._root.groups
 
     @staticmethod
-    def _iterate(cmp: Component):
+    def _iterate(cmp: Component, forward: bool = False):
         """
         Iterator over the nested structure of a given component.
+        :param forward: If true, only roles leading further away from the sentence root are followed.
         :return:
         """
-        yield from LogicalForm._iterate_help(cmp, set())
+        yield from LogicalForm._iterate_help(cmp, set(), forward)
 
     @staticmethod
-    def _iterate_help(cmp: Component, seen: Set[Component]):
+    def _iterate_help(cmp: Component, seen: Set[Component], forward: bool = False):
         """
         Helper function for the iterator that prevents infinite loops through the tree.
+        Components are yielded depth-first in role order, using an explicit stack rather than recursion.
         :param cmp: Current component.
         :param seen: Set of seen components
-        :param parent: The immediate parent of this component. Prevents improper up-search.
+        :param forward: Prevents improper up-search through roles that point back towards the root, such as the
+            FIGURE of a modifier. Only applies to components with a known depth.
         :return:
         """
         yield cmp
         seen.add(cmp)
 
-        for rg in cmp.roles:
-            for or_cmps in rg.values():
-                for c in or_cmps:
-                    # Avoid modifier loops.
-                    if c in seen or isinstance(c, str) or c.tagged:
+        stack = [(cmp, LogicalForm._children(cmp))]
+        while stack:
+            parent, children = stack[-1]
+            c = next(children, None)
+            if c is None:
+                stack.pop()
+                continue
+
+            # Avoid modifier loops.
+            if c in seen or isinstance(c, str):
+                continue
+            if forward and not LogicalForm._leads_down(parent, c):
+                continue
+
+            # Only descend into non-string components
+            yield c
+            seen.add(c)
+            stack.append((c, LogicalForm._children(c)))
+
+    @staticmethod
+    def _children(cmp: Component) -> Iterator[Union[Component, str]]:
+        """
+        Iterate over the immediate role children of a component, in rolegroup and role order.
+        :param cmp: A Component.
+        :return:
+        """
+        return (c for rg in cmp.roles for or_cmps in rg.values() for c in or_cmps)
+
+    @staticmethod
+    def _measure_depths(root: Component) -> NoReturn:
+        """
+        Record the shortest distance from the root to every component reachable from it.
+        :param root: The root component of a sentence.
+        :return: None
+        """
+        root.depth = 0
+        queue = deque([root])
+        while queue:
+            cmp = queue.popleft()
+            for c in LogicalForm._children(cmp):
+                if not isinstance(c, str) and c.depth is None:
+                    c.depth = cmp.depth + 1
+                    queue.append(c)
+
+    @staticmethod
+    def _leads_down(parent: Component, child: Component) -> bool:
+        """
+        A role leads down the tree unless its target is known to be no deeper than its owner.
+        Template components have no depth, so all of their roles lead down.
+        :return:
+        """
+        return parent.depth is None or child.depth is None or child.depth > parent.depth
+
+    @staticmethod
+    def _fingerprint(root: Component) -> NoReturn:
+        """
+        Compute and cache the fingerprints of a component and every component nested under it, children first.
+        Roles that lead back up the tree of a sentence are hashed as back references instead of being followed,
+        which keeps the fingerprint of every component independent of where the traversal started.
+        :param root: Component to fingerprint.
+        :return: None
+        """
+        stack = [root]
+        on_path = set()  # type: Set[int]  # IDs of expanded components whose children are still being processed.
+        while stack:
+            cmp = stack[-1]
+            if cmp._fingerprint is not None:
+                stack.pop()
+                continue
+
+            if id(cmp) not in on_path:
+                # First visit: the children need their fingerprints first.
+                on_path.add(id(cmp))
+                for c in LogicalForm._children(cmp):
+                    if not isinstance(c, str) and c._fingerprint is None and id(c) not in on_path \
+                            and LogicalForm._leads_down(cmp, c):
+                        stack.append(c)
+                continue
+
+            # Second visit: all children are done.
+            roles = []
+            for rg in cmp.roles:
+                rg_data = []
+                for name, cs in rg.items():
+                    values = []
+                    for c in cs:
+                        if isinstance(c, str):
+                            values.append(c)
+                        elif id(c) in on_path or not LogicalForm._leads_down(cmp, c):
+                            # A back reference, described by how far up the tree it points.
+                            values.append(('^', None if None in (c.depth, cmp.depth) else cmp.depth - c.depth))
+                        else:
+                            values.append(('#', c._fingerprint))
+                    rg_data.append((name, tuple(values)))
+                roles.append(tuple(rg_data))
+
+            data = (tuple(cmp.indicator), tuple(cmp.comp_type), None if cmp.word is None else tuple(cmp.word),
+                    tuple(cmp.param_mapping.keys()), cmp.group, cmp.fuzzy,
+                    None if cmp._resolved else cmp.comp_id,  # Unresolved components are identified by reference.
+                    tuple(roles))
+            cmp._fingerprint = blake2b(repr(data).encode('utf-8'), digest_size=16).hexdigest()
+            on_path.discard(id(cmp))
+            stack.pop()
+
+    def pruned(self, roles: Set[str], keep: Callable[[Component, Optional[str]], bool],
+               collapse: Callable[[Component, Optional[str]], bool] = None) -> 'LogicalForm':
+        """
+        Get a copy of this sentence LF reduced to what the matcher can see. The matcher only follows roles that some
+        template names, and only ever looks at the first value of a role, so everything else is dropped. Components
+        whose whole subtree may still matter, i.e. ones that could bind a group, are kept intact along with
+        everything nested under them. Components that cannot match any template they could be compared with are
+        collapsed: they keep their surface features, which fail every comparison, but lose their roles.
+        Matching the copy gives the same results as matching this LF. Neither LF is modified.
+        :param roles: Names of all the roles used by the templates.
+        :param keep: Tells if a component reached through the given role must be kept intact. The role is None for
+            the root.
+        :param collapse: Optionally tells if a component reached through the given role can never match.
+        :return: The pruned LogicalForm.
+        """
+        if self._root is None or keep(self._root, None):
+            return self
+
+        copies = {}  # type: Dict[int, LogicalForm.Component]  # id(original) -> pruned copy
+        stubs = {}  # type: Dict[int, LogicalForm.Component]  # id(original) -> collapsed copy
+        stack = []  # type: List[Tuple[LogicalForm.Component, LogicalForm.Component]]
+
+        def copy_of(cmp: LogicalForm.Component, via: Optional[str]) -> LogicalForm.Component:
+            # A component reached through several roles may be collapsed under some of them only.
+            collapsed = collapse is not None and collapse(cmp, via)
+            table = stubs if collapsed else copies
+            result = table.get(id(cmp))
+            if result is None:
+                result = table[id(cmp)] = LogicalForm.Component(cmp.comp_id)
+                result.indicator, result.comp_type, result.word = cmp.indicator, cmp.comp_type, cmp.word
+                result.depth, result.start, result.end = cmp.depth, cmp.start, cmp.end
+                if not collapsed:
+                    stack.append((cmp, result))
+            return result
+
+        root = copy_of(self._root, None)
+        while stack:
+            original, cmp = stack.pop()
+            cmp.roles = []
+            for rg in original.roles:
+                pruned_rg = {}
+                for name, values in rg.items():
+                    if name not in roles:
                         continue
+                    # Strings and intact components are shared with the original.
+                    pruned_rg[name] = [v if isinstance(v, str) or keep(v, name) else copy_of(v, name)
+                                       for v in values[:1]]
+                cmp.roles.append(pruned_rg)
 
-                    # Only recurse on non-string components
-                    yield from LogicalForm._iterate_help(c, seen)
+        return LogicalForm._from_root(root, self.from_xml, self.text)
 
     """
     Matching
     """
-    def match_template(self, lf) -> Tuple[bool, Dict[str, str], Dict[str, str]]:
+    def match_template(self, lf, memo: Dict = None) -> Tuple[bool, Dict[str, str], Dict[str, str]]:
         """
         Compare this LogicalForm to another one for structural equality.
         :param lf: Other LogicalForm
+        :param memo: An optional dictionary shared by consecutive calls on this LogicalForm. Template components
+            shared by several templates are then only compared to each sentence component once. A MatchMemo of the
+            library the template belongs to also lets surface features be compared as bitmasks.
         :return: True if the structure and patterns within the other LogicalForm match this one. False otherwise.
             Additionally, return the dictionaries of parameters and groups bound by the compared LF.
         """
@@ -279,140 +685,253 @@ class LogicalForm:
         if self._root is None and lf._root is None:
             return True, {}, {}
 
-        return LogicalForm._compare_help(self._root, lf._root)
+        # Matching never modifies either LF, so one parsed sentence may be matched any number of times, against
+        # several libraries, and from several threads at once.
+        is_match, params, groups = LogicalForm._compare(self._root, lf._root, memo)
+        return is_match, params, self.group_values(groups)
+
+    def match_ranked(self, lf, memo: Dict = None) -> Tuple[bool, Dict[str, str], Dict[str, str], int]:
+        """
+        Same as match_template, but also score how specific the matched part of the template is; see _specificity.
+        :param lf: Other LogicalForm
+        :param memo: An optional dictionary shared by consecutive calls on this LogicalForm.
+        :return: Match success/failure, bound params, bound groups, and the specificity of a match (0 otherwise).
+        """
+        if not isinstance(lf, LogicalForm):
+            raise ValueError(f'Expected {LogicalForm} argument, got {type(lf)}.')
+
+        if self._root is None or lf._root is None:
+            is_match, params, groups = self.match_template(lf, memo)
+            return is_match, params, groups, 0
+
+        outcome = LogicalForm._search(self._root, lf._root, memo)
+        if outcome is None:
+            return False, {}, {}, 0
+        params, groups = LogicalForm._bind(outcome)
+        return True, params, self.group_values(groups), LogicalForm._specificity(outcome)
+
+    def group_values(self, groups: Dict[str, Component]) -> Dict[str, str]:
+        """
+        Turn the groups bound by a successful match into strings. The matcher only records which sentence component
+        each group was bound at, so the text is only extracted for the match that is reported.
+        :param groups: Group name -> sentence component of this LF.
+        :return: Group name -> group value.
+        """
+        return {name: LogicalForm._group_text(self.text, cmp) for name, cmp in groups.items()}
 
     @staticmethod
-    def _compare_help(this, other) -> Tuple[bool, Dict[str, str], Dict[str, str]]:
+    def _compare(this, other, memo: Dict = None) -> Tuple[bool, Dict[str, str], Dict[str, str]]:
         """
-        Recursive helper function for LF comparison.
+        Iterative LF comparison. Walks the search of a recursive matcher using an explicit stack of _MatchFrames, so
+        the depth of the LF is not bounded by the recursion limit. The first matching template option of every role
+        is taken without evaluating the rest, and bindings are only built once, for the final match.
         Parameters will be extracted from 'this' using the mappings of 'other'
         :param this: Compared instance.
         :param other: Instance compared to.
-        :return: Tuple[Match success/failure, bound params, bound groups]
+        :param memo: Optional memo of decided comparisons, keyed by the identities of both components.
+        :return: Tuple[Match success/failure, bound params, bound groups]. Groups map to the sentence components
+            they were bound at; see group_values.
+        """
+        outcome = LogicalForm._search(this, other, memo)
+        if outcome is None:
+            return False, {}, {}
+        params, groups = LogicalForm._bind(outcome)
+        return True, params, groups
+
+    @staticmethod
+    def _search(this, other, memo: Dict = None) -> Optional[Binding]:
+        """
+        The search behind _compare.
+        :param this: Compared instance.
+        :param other: Instance compared to.
+        :param memo: Optional memo of decided comparisons, keyed by the identities of both components.
+        :return: The Binding of the match, or None if there is no match.
+        """
+        outcome = LogicalForm._open(this, other, memo)
+        if isinstance(outcome, _MatchFrame):
+            stack = [outcome]
+            outcome = stack[0].step()
+            while True:
+                if isinstance(outcome, _MatchFrame):
+                    stack.append(outcome)  # Descend into a child comparison.
+                else:
+                    frame = stack.pop()  # The frame on top of the stack is decided.
+                    if memo is not None:
+                        memo[id(frame.this), id(frame.other)] = outcome
+                    if not stack:
+                        break
+                    stack[-1].resume(outcome)
+                outcome = stack[-1].step()
+
+        return outcome
+
+    @staticmethod
+    def _bind(binding: Binding) -> Tuple[Dict[str, str], Dict[str, Component]]:
+        """
+        Build the dictionaries of bound parameters and groups of a successful match.
+        A component's own bindings take precedence over the ones made by its roles, and earlier roles over later
+        ones, so a pre-order walk that keeps the first value bound to every name does it in a single pass.
+        :param binding: The Binding of the matched root.
+        :return: (params, groups). Groups map to the sentence components they were bound at.
+        """
+        params, groups = {}, {}
+        stack = [binding]
+        while stack:
+            this, other, roles = stack.pop()
+            if isinstance(this, str):
+                for name in other.param_mapping:
+                    params.setdefault(name, this)
+                continue
+
+            # A fuzzy component without a word binds no parameters.
+            if this.word or not other.fuzzy:
+                mapped_val = this.word[0] if this.word else None
+                for name in other.param_mapping:
+                    params.setdefault(name, mapped_val)
+            if other.group:
+                groups.setdefault(other.group, this)
+            stack.extend(reversed(roles))
+
+        return params, groups
+
+    @staticmethod
+    def _specificity(binding: Binding) -> int:
+        """
+        Score how specific the part of a template that took part in a match is. Every matched template component
+        counts once, plus once for each of its indicator, type and word lists that is not a wildcard. Only the
+        template option actually taken for a role counts, and nothing below a fuzzy component, since the template does
+        not constrain it. A template that matches a sentence with a higher score says more about it.
+        :param binding: The Binding of the matched root.
+        :return:
         """
-        # this and other are expected to be Components at the same level of the tree.
-        # Components match if all the following are true:
-        # 1) There is overlap between indicator sets
-        # 2) There is overlap between type sets
-        # 3) There is overlap between word sets
-        # 4) There is an exact match within a rolegroup by name
-        # 5) There is matching overlap between child components within the matched rolegroup.
+        score = 0
+        stack = [binding]
+        while stack:
+            _, other, roles = stack.pop()
+            score += 1 + bool(other.indicator) + bool(other.comp_type) + bool(other.word)
+            stack.extend(roles)
+        return score
 
+    @staticmethod
+    def _open(this, other, memo: Dict = None):
+        """
+        Start comparing a sentence component against a template component by checking their surface features.
+        :param this: Sentence component or plain string role value.
+        :param other: Template component.
+        :param memo: Optional memo of decided comparisons.
+        :return: None if there is no match, a Binding for comparisons decided on the spot, or a _MatchFrame whose
+            roles are still to be compared.
+        """
         # A role parsed form XML might be a simple string.
-        # An equivalent element parsed from a template is a component, since there could be multiple string options
         if isinstance(this, str):
-            match = this in other.word
-            return match, {p_name: this for p_name in other.param_mapping.keys()}, {}
-
-        # Lists share a common element if their intersection iss a nonempty set.
-        lst_common = lambda lst_t: bool(set(lst_t[0]).intersection(set(lst_t[1])))
-
-        # Indicators match if any of them are wildcards (empty lists) or if the intersection of sets is nonempty
-        match = not (this.indicator and other.indicator) or lst_common((this.indicator, other.indicator))
-        # Same for types
-        match = match and (not (this.comp_type and other.comp_type) or lst_common((this.comp_type, other.comp_type)))
-        # Same for words
-        match = match and (not (this.word and other.word) or lst_common((this.word, other.word)))
-
-        if not match:
-            # No surface-level match means no need to recurse further.
-            # Also no need to return any parameters from this branch.
-            return False, {}, {}
-        this.tagged = True
-
-        # If the template specifies a group at this component, gather all explicit words from the sentence subtree.
-        group_data = {}
-        extractor = lambda cmp: cmp if isinstance(cmp, str) else (None if not cmp.word else cmp.word[0])
-        if other.group:
-            group_list = [extractor(cmp) for cmp in LogicalForm._iterate(this)]
-            group_str = ' '.join(list(filter(lambda x: x is not None, group_list)))
-            group_data[other.group] = group_str
-
-        # If the components match and the template one is marked 'fuzzy', then everything nested under this component
-        # is to be accepted 'as-is'.
+            if this not in other.word:
+                return None
+            return this, other, NO_ROLES
+
+        if memo is not None:
+            key = (id(this), id(other))
+            if key in memo:
+                return memo[key]
+            outcome = LogicalForm._open_component(this, other, memo)
+            if not isinstance(outcome, _MatchFrame):
+                memo[key] = outcome
+            return outcome
+
+        return LogicalForm._open_component(this, other, memo)
+
+    @staticmethod
+    def _open_component(this, other, memo: Optional[Dict]):
+        """
+        The part of _open that deals with sentence components, as opposed to plain strings.
+        """
+        if not LogicalForm._surface_match(this, other, memo):
+            return None
+
+        # A fuzzy template component accepts everything nested under the sentence component as-is.
         if other.fuzzy:
-            # Return only the parameters bound by this component, if applicable.
-            # Since there can be no structure below, no bindings could be made.
-            binding = {} if not this.word else {k: this.word[0] for k in other.param_mapping.keys()}
-            groups = {} if not other.group else group_data
-            return True, binding, groups
-
-        # TODO: Do we need a warning if there were multiple candidate words? Shouldn't be possible.
-        # Map the word value stored in this component to parameter names specified by the template.
-        mapped_val = this.word[0] if this.word else None
-        param_map = {k: mapped_val for k in other.param_mapping.keys()}
-
-        # Find all the rolegroups that match between this and other.
-        check_q = []
-        for rg in this.roles:
-            for rg_other in other.roles:
-                command_roles = set(rg.keys())
-                template_roles = set(rg_other.keys())
-
-                # The roles of the template must be a subset of the roles of the command.
-                # i.e. If the command has roles A, B, and C, and the template has role B, then the template matches.
-                # However, template with B and D is NOT a match to command A, B, C
-                if all(r in command_roles for r in template_roles):
-                    # The rolegroups match roles
-                    check_q.append((rg, rg_other))
-
-        # For each pair of matching rolegroups, recurse on all corresponding components.
-        # At least one rolegroup has to match in order for the whole template to match.
-        param_set = {}
-        group_set = {}
-        one_rg_match = False
-        for this_rg, other_rg in check_q:
-
-            # Every role must fully match within a rolegroup
-            all_match = True
-            rg_set = {}  # set of parameters from this set of roles
-            rg_groups = {}  # Set of groups from this set of roles
-            for name in this_rg.keys():
-                # Since this RG has been established as a superset of other RG, there may be roles not present
-                # in other. That simply means that the role is a match and no parameters are bound.
-                if name not in other_rg:
-                    continue
-
-                to_match = this_rg[name][0]  # This is the component the template needs to match.
-                candidates = other_rg[name]  # This is the candidate components
-
-                # Recurse on all options from the template. At least one must match.
-                results = map(lambda x: LogicalForm._compare_help(to_match, x), candidates)
-                results = list(filter(lambda x: x[0], results))
-                if not results:
-                    all_match = False
-                    break
-                for k, v in results[0][1].items():
-                    if k not in rg_set:
-                        rg_set[k] = v
-                for k, v in results[0][2].items():
-                    if k not in rg_groups:
-                        rg_groups[k] = v
-
-            # Stop comparing if we found a matching rolegroup.
-            if all_match:
-                one_rg_match = True
-                param_set = rg_set
-                group_set = rg_groups
-                break
-
-        # Not a single rolegroup matched from the template.
-        # This component is not a match
-        if not one_rg_match:
-            return False, {}, {}
+            return this, other, NO_ROLES
 
-        # At least one rolegroup matched.
-        # Add the parameters extracted from the matched rolegroup to the set.
-        for k, v in param_set.items():
-            if k not in param_map:
-                param_map[k] = v
+        frame = _MatchFrame(this, other, memo)
+        return frame if frame.next_pair() else None
 
-        # Add the groups extracted from the matched rolegroup to the set.
-        for k, v in group_set.items():
-            if k not in group_data:
-                group_data[k] = v
+    @staticmethod
+    def _surface_match(this, other, memo: Dict = None) -> bool:
+        """
+        Indicators, types, and words each match if either side is a wildcard (empty) or the two lists share an element.
+        Each check is a single AND of bitmasks, given the masks of the template and a MatchMemo to keep the masks of
+        the sentence in. Otherwise, the lists are compared.
+        :param this: Sentence component.
+        :param other: Template component.
+        :param memo: Optional memo of the matching call.
+        :return:
+        """
+        other_masks = other._masks
+        if other_masks is None or type(memo) is not MatchMemo:
+            return LogicalForm._surface_match_lists(this, other)
+        return LogicalForm._surface_overlap(this, other_masks, memo)
 
-        return True, param_map, group_data
+    @staticmethod
+    def _surface_overlap(this, masks: Tuple[int, int, int], memo: MatchMemo) -> bool:
+        """
+        The bitmask check of _surface_match.
+        :param this: Sentence component.
+        :param masks: Template masks over the symbol table of the memo, or their union over several templates.
+        :param memo: The memo of the matching call.
+        :return:
+        """
+        this_masks = memo.masks.get(id(this))
+        if this_masks is None:
+            this_masks = memo.masks[id(this)] = surface_masks(this, memo.symbols)
+        return (this_masks[0] & masks[0] and this_masks[1] & masks[1] and this_masks[2] & masks[2]) != 0
+
+    @staticmethod
+    def _surface_match_lists(this, other) -> bool:
+        """
+        The list-based check of _surface_match, for when there are no bitmasks to compare: the template component
+        was not encoded by a TemplateManager, e.g. it belongs to a standalone template LF, or the caller passed no
+        MatchMemo, as in a plain match_template call. Gives the same result as the bitmask check.
+        :param this: Sentence component.
+        :param other: Template component.
+        :return:
+        """
+        if this.indicator and other.indicator and not LogicalForm._overlap(this.indicator, other.indicator):
+            return False
+        if this.comp_type and other.comp_type and not LogicalForm._overlap(this.comp_type, other.comp_type):
+            return False
+        return not (this.word and other.word) or LogicalForm._overlap(this.word, other.word)
+
+    @staticmethod
+    def _overlap(lst_a: List[str], lst_b: List[str]) -> bool:
+        """
+        Check if two short lists share a common element without building sets.
+        :return:
+        """
+        for x in lst_a:
+            if x in lst_b:
+                return True
+        return False
+
+    @staticmethod
+    def _group_text(text: Optional[str], cmp: Component) -> str:
+        """
+        Get the value of a group bound at a sentence component: the span of the utterance it covers, with the
+        original word order and casing. Without a span, fall back to the words of the subtree.
+        :param text: The utterance, if known.
+        :param cmp: The sentence component the group was bound at.
+        :return:
+        """
+        if text is not None and cmp.start is not None and cmp.end is not None:
+            return text[cmp.start:cmp.end]
+        return LogicalForm._group_words(cmp)
+
+    @staticmethod
+    def _group_words(cmp: Component) -> str:
+        """
+        Join the explicit words of a sentence subtree into a group value.
+        :param cmp: Root of the grouped subtree.
+        :return:
+        """
+        return ' '.join(c.word[0] for c in LogicalForm._iterate(cmp, forward=True) if c.word)
 
     """
     ID resolution
@@ -454,58 +973,63 @@ class LogicalForm:
         Even small trees can get a bit verbose, but this is still a helpful representation.
         :return:
         """
-        return LogicalForm.__format_component(self._root, 0, set())
+        return ''.join(self.format_lines())
 
-    @staticmethod
-    def __format_role(role: Tuple[str, List[Union[Component, str]]], depth: int, seen: Set[Component]) -> str:
-        """
-        A helper function for pretty_format, mutually recursive with __format_component.
-        :param role: The role tuple being formatted.
-        :param depth: Nested depth level.
-        :param seen: Set of seen Components used to break potential infinite loops.
-        :return: String representation of the role.
-        """
-        role_name, role_comps = role
-        result = ('|  ' * depth) + f'<role {role_name}>\n'
-        for c in role_comps:
-            # Display all of the role's components
-            if isinstance(c, str):
-                result += ('|  ' * (depth + 1)) + c + '\n'
-            else:
-                result += LogicalForm.__format_component(c, depth + 1, seen)
-
-        return result
+    def write_pretty(self, fp: TextIO) -> NoReturn:
+        """
+        Write the pretty_format representation to a text file handle, one line at a time.
+        :param fp: A file handle opened in text mode.
+        :return: None
+        """
+        write_lines(fp, self.format_lines())
 
-    @staticmethod
-    def __format_component(comp: Component, depth: int, seen: Set[Component]) -> str:
-        """
-        A helper function for pretty_format, mutually recursive with __format_role.
-        :param comp: The component being formatted.
-        :param depth: Nested depth level.
-        :param seen: Set of seen Components used to break potential infinite loops.
-        :return: String representation of the component.
-        """
-        if comp in seen:
-            return ''
-        seen.add(comp)
-
-        # First, get the base of the component.
-        result = ('|  ' * depth) + str(comp) + '\n'
-        # Special case for 'closed' components with no child roles.
-        if len(comp.roles) == 1 and not comp.roles[0]:
-            return result
+    def format_lines(self) -> Iterator[str]:
+        """
+        Generate the lines of pretty_format, newlines included. The LF is walked with an explicit stack, so neither
+        the size nor the depth of the LF is limited by the recursion limit, and no string is ever copied.
+        :return:
+        """
+        # A sentence component is written once, and every later occurrence is a reference to its ID. Templates share
+        # structurally identical subtrees once loaded, so a template component is only skipped on a cycle, and shared
+        # subtrees are written out wherever the template author wrote them.
+        back_refs = self.from_xml
+        # Stack entries are ready-made lines, (component, depth) pairs still to be written, and template components
+        # whose roles have all been written.
+        stack = [(self._root, 0)]  # type: List[Union[str, Tuple[LogicalForm.Component, int], LogicalForm.Component]]
+        seen = set()  # type: Set[LogicalForm.Component]  # Components written, or on the path from the root.
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                yield item
+                continue
+            if type(item) is not tuple:
+                seen.discard(item)  # Every role of the template component has been written.
+                continue
 
-        for rg in comp.roles:
-            # Mark the beginning of a rolegroup
-            result += ('|  ' * (depth + 1)) + '<rolegroup>\n'
-            # Now show all the roles.
-            for rtup in rg.items():
-                result += LogicalForm.__format_role(rtup, depth + 2, seen)
+            comp, depth = item
+            if comp in seen:
+                if back_refs:
+                    yield ('|  ' * depth) + f'<ref {comp.comp_id}>\n'
+                continue
 
-            # Mark the end of a rolegroup
-            result += ('|  ' * (depth + 1)) + '</rolegroup>\n'
+            yield ('|  ' * depth) + str(comp) + '\n'
+            if back_refs:
+                seen.add(comp)
+            # Special case for 'closed' components with no child roles.
+            if len(comp.roles) == 1 and not comp.roles[0]:
+                continue
 
-        return result
+            if not back_refs:
+                seen.add(comp)
+                stack.append(comp)
+            rg_indent, role_indent, child_indent = '|  ' * (depth + 1), '|  ' * (depth + 2), '|  ' * (depth + 3)
+            for rg in reversed(comp.roles):
+                stack.append(rg_indent + '</rolegroup>\n')
+                for role_name, role_comps in reversed(list(rg.items())):
+                    for c in reversed(role_comps):
+                        stack.append(child_indent + c + '\n' if isinstance(c, str) else (c, depth + 3))
+                    stack.append(role_indent + f'<role {role_name}>\n')
+                stack.append(rg_indent + '<rolegroup>\n')
 
     """
     String Parsing
@@ -688,64 +1212,91 @@ class LogicalForm:
     def _process_xml(xml_string) -> Component:
         """
         Convert an XML string to a Logical Form.
+        The reply is read in a single streaming pass, and role references are linked as soon as they are seen.
         :param xml_string: The LF encoded string.
         :return: A root component of the hierarchy.
         """
-        bs = BeautifulSoup(xml_string, 'xml')
-        components = {}  # type: Dict[str, LogicalForm.Component]
-
-        comp_data = bs.findAll('rdf:Description')
-
-        # First, we need to build up a set of standalone elements with pending ID references.
-        # Then, a second pass "marries" the elements into a tree.
-        root_id = comp_data[0]['rdf:ID']
-
-        # For each component, extract its indicator, type, and -- if applicable -- word and roles.
-        for tags in comp_data:
-            component = LogicalForm.Component(tags['rdf:ID'])
-            for c in tags.children:
-                # Skip meaningless entries.
-                if isinstance(c, NavigableString):
-                    continue
-                if c.name == 'indicator':
-                    component.indicator.append(c.text)
-                elif c.name == 'type':
-                    component.comp_type.append(c.text)
-                elif c.name == 'word':
-                    if component.word is None:
-                        component.word = [c.text]
-                    else:
-                        component.word.append(c.text)
-                elif c.prefix == 'role':
-                    # Initialize the list if necessary
-                    if c.name not in component.roles[0]:
-                        component.roles[0][c.name] = []
-
-                    if 'rdf:resource' in c.attrs:
-                        role_comp_id = c['rdf:resource']  # Skip the 'V' prefix if needed
-                        # Wrap in a list to allow isinstance() differentiation
-                        component.roles[0][c.name].append([role_comp_id])
-                    else:
-                        # Some roles are basic strings and can be resolved on first pass.
-                        component.roles[0][c.name].append(c.text)
-            components[component.comp_id] = component
-
-        # All components have been processed. Now, they need to be connected into a tree.
-        for comp in components.values():
-            for rname, rval in comp.roles[0].items():
-                # Only resolve the roles that were left as references.
-                resolved_targets = []
-                for r_target in rval:
-                    if isinstance(r_target, list):
-                        resolved_targets.append(components[r_target[0][1:]])
-                    else:
-                        resolved_targets.append(r_target)
-                comp.roles[0][rname] = resolved_targets
-
-        # All components are now connected into a tree structure in memory.
-        # Returning a reference to the root component therefore extracts the whole structure.
-        return components[root_id]
+        return LogicalForm._read_xml(xml_string)[0]
+
+    @staticmethod
+    def _read_xml(xml_string) -> Tuple[Component, Optional[str]]:
+        """
+        Like _process_xml, but also get the utterance the reply was parsed from.
+        :param xml_string: The LF encoded string.
+        :return: The root component of the hierarchy and the utterance, if the reply has one.
+        """
+        linker = _XmlLinker()
+        linker.feed(xml_string)
+        return linker.close(), linker.text
+
+
+class _XmlLinker:
+    """
+    Turns the descriptions of a TRIPS reply into linked Components as they are read.
+    A role may refer to a component that has not been described yet. Such references get an empty placeholder
+    Component, which is filled in once its description arrives, so no second linking pass is needed.
+    """
+
+    def __init__(self):
+        self._components = {}  # type: Dict[str, LogicalForm.Component]
+        self._described = set()  # type: Set[str]
+        self._reader = TripsXmlReader(self._add)
+
+    def feed(self, data: Union[str, bytes]) -> NoReturn:
+        """
+        Read the next chunk of a TRIPS reply.
+        :param data: A piece of the XML document.
+        :return: None
+        """
+        self._reader.feed(data)
 
+    @property
+    def text(self) -> Optional[str]:
+        """
+        :return: The utterance, once it has been read.
+        """
+        return self._reader.text
 
+    def close(self) -> LogicalForm.Component:
+        """
+        Finish reading the reply.
+        :return: The root component of the hierarchy.
+        """
+        self._reader.close()
+        if self._reader.root_id is None:
+            raise ValueError('TRIPS reply contains no components.')
 
+        missing = self._components.keys() - self._described
+        if missing:
+            raise ValueError(f'TRIPS reply refers to undefined components {", ".join(sorted(missing))}')
 
+        return self._components[self._reader.root_id]
+
+    def _component(self, comp_id: str) -> LogicalForm.Component:
+        """
+        Get the component with the given ID, creating a placeholder for it if necessary.
+        """
+        component = self._components.get(comp_id)
+        if component is None:
+            component = LogicalForm.Component(comp_id)
+            self._components[comp_id] = component
+        return component
+
+    def _add(self, description: Description):
+        """
+        Fill in the component for a completed description.
+        """
+        component = self._component(description.comp_id)
+        self._described.add(description.comp_id)
+
+        component.indicator.extend(description.indicator)
+        component.comp_type.extend(description.comp_type)
+        if description.word is not None:
+            component.word = description.word
+        component.start, component.end = description.start, description.end
+
+        roles = component.roles[0]
+        for name, value, is_reference in description.roles:
+            if name not in roles:
+                roles[name] = []
+            roles[name].append(self._component(value) if is_reference else value)
@@ -0,0 +1,327 @@
+"""
+Generates a dedicated Python match function for every component of a template library.
+"""
+
+from typing import *
+from hashlib import blake2b
+from logging import debug
+from os import makedirs, replace
+from os.path import join, dirname, basename, isdir
+
+from framework.semantic_tools.logical_form import LogicalForm
+from framework.semantic_tools.parse_cache import CACHE_ROOT
+
+GENERATOR_VERSION = 3  # Bump whenever the generated code changes, to invalidate cached modules.
+# The per-user cache directory, as opposed to one next to the templates, where other users could plant code. It is
+# created accessible to its owner only, which is what keeps others from changing the cached modules.
+CACHE_DIR = join(CACHE_ROOT, 'matchers')
+DIGEST_SUFFIX = '.digest'
+
+Bindings = Tuple[Dict[str, str], Dict[str, Any]]
+Matcher = Callable[[Union[LogicalForm.Component, str]], Optional[Bindings]]
+
+
+def merge_bindings(params: Dict[str, str], groups: Dict[str, str], rg: Dict[str, List],
+                   results: Dict[str, Bindings]) -> Bindings:
+    """
+    Merge the bindings of matched roles into the bindings of their parent, giving precedence to the parent's own
+    bindings and then to earlier roles of the sentence rolegroup, like LogicalForm._bind does.
+    Generated code only calls this when two roles may bind the same name. Otherwise the order does not matter.
+    :param params: The parent's own parameters. Updated in place.
+    :param groups: The parent's own groups. Updated in place.
+    :param rg: The matched sentence rolegroup.
+    :param results: The bindings of each matched role.
+    :return: (params, groups)
+    """
+    for name in rg:
+        result = results.get(name)
+        if result is not None:
+            for k, v in result[0].items():
+                params.setdefault(k, v)
+            for k, v in result[1].items():
+                groups.setdefault(k, v)
+    return params, groups
+
+
+# Names available to generated code.
+RUNTIME = {
+    'merge_bindings': merge_bindings,
+}
+
+
+class _Generator:
+    """
+    Writes the source of a module with one function per distinct template component. Shared components get a single
+    function, so the module mirrors the hash-consed structure of the library.
+    """
+
+    def __init__(self):
+        self._names = {}  # type: Dict[int, str]  # id(Component) -> function name
+        self._pending = []  # type: List[LogicalForm.Component]
+        self._constants = []  # type: List[str]
+        self._functions = []  # type: List[str]
+
+    def generate(self, templates: List[LogicalForm]) -> str:
+        """
+        :param templates: Resolved templates, in matching order.
+        :return: Module source. The module defines TEMPLATES, the matcher of each template root in the same order.
+        """
+        roots = [self._name(t._root) for t in templates]
+        while self._pending:
+            self._component(self._pending.pop(0))
+
+        lines = [f'# Generated by matcher_codegen version {GENERATOR_VERSION}. Do not edit.', '']
+        lines.extend(self._constants)
+        lines.append('')
+        for function in self._functions:
+            lines.extend(['', '', function])
+        lines.extend(['', '', f'TEMPLATES = [{", ".join(roots)}]', ''])
+        return '\n'.join(lines)
+
+    def _name(self, cmp: LogicalForm.Component) -> str:
+        name = self._names.get(id(cmp))
+        if name is None:
+            name = self._names[id(cmp)] = f'm_{len(self._names)}'
+            self._pending.append(cmp)
+        return name
+
+    def _component(self, cmp: LogicalForm.Component):
+        """
+        Write the matcher of a single template component, following _LogicalForm._open_component.
+        """
+        name = self._names[id(cmp)]
+        params = list(cmp.param_mapping.keys())
+        body = [f'def {name}(this):']
+
+        # A role value parsed from XML might be a plain string, matched by the template words alone.
+        words = 'None' if cmp.word is None else _frozenset(cmp.word)
+        self._constants.append(f'{name.upper()}_WORDS = {words}')
+        body += ['    if isinstance(this, str):',
+                 f'        return ({_dict(params, "this")}, {{}}) if this in {name.upper()}_WORDS else None']
+
+        # Surface checks against the sets of template values. Wildcards on either side overlap with everything, and
+        # template wildcards are left out.
+        for field, attr, values in (('IND', 'indicator', cmp.indicator), ('TYPE', 'comp_type', cmp.comp_type),
+                                    ('WORDS', 'word', cmp.word)):
+            if values:
+                if field != 'WORDS':
+                    self._constants.append(f'{name.upper()}_{field} = {_frozenset(values)}')
+                body += [f'    if this.{attr} and {name.upper()}_{field}.isdisjoint(this.{attr}):',
+                         '        return None']
+
+        # Groups are bound to the sentence component, and LogicalForm.group_values extracts their text.
+        groups = f'{{{cmp.group!r}: this}}' if cmp.group else '{}'
+        if cmp.fuzzy:
+            bound = f'({_dict(params, "this.word[0]")} if this.word else {{}})' if params else '{}'
+            body += [f'    return {bound}, {groups}']
+            self._functions.append('\n'.join(body))
+            return
+
+        # Sentence rolegroups are paired with template rolegroups whose roles they contain, sentence first.
+        if cmp.group:
+            body.append(f'    own_groups = {groups}')
+            groups = 'own_groups'
+        body.append('    for rg in this.roles:')
+        if len(cmp.roles) > 1:
+            body.append('        keys = rg.keys()')
+        for i, rg in enumerate(cmp.roles):
+            pair = f'{name}_{i}'
+            self._pair(pair, cmp, rg)
+            args = 'this, rg, own_groups' if cmp.group else 'this, rg'
+            if len(cmp.roles) > 1:
+                self._constants.append(f'{pair.upper()}_KEYS = {_frozenset(rg.keys())}')
+                body += [f'        if {pair.upper()}_KEYS <= keys:',
+                         f'            result = {pair}({args})',
+                         '            if result is not None:',
+                         '                return result']
+            else:
+                body += [f'        if {_subset(rg)}:',
+                         f'            result = {pair}({args})',
+                         '            if result is not None:',
+                         '                return result']
+        body.append('    return None')
+        self._functions.append('\n'.join(body))
+
+    def _pair(self, pair: str, cmp: LogicalForm.Component, rg: Dict[str, List[LogicalForm.Component]]):
+        """
+        Write the function matching a sentence rolegroup against one template rolegroup. Every role takes the first
+        template candidate that matches the first sentence value.
+        """
+        body = [f'def {pair}(this, rg{", own_groups" if cmp.group else ""}):']
+        results = []
+        for i, (role, candidates) in enumerate(rg.items()):
+            if not candidates:
+                # A role without template options never matches.
+                body.append('    return None')
+                self._functions.append('\n'.join(body))
+                return
+            matchers = ' or '.join(f'{self._name(c)}(value)' for c in candidates)
+            body += [f'    value = rg[{role!r}][0]',
+                     f'    r_{i} = {matchers}',
+                     f'    if r_{i} is None:',
+                     '        return None']
+            results.append((role, f'r_{i}'))
+
+        params = list(cmp.param_mapping.keys())
+        if params:
+            body.append('    mapped = this.word[0] if this.word else None')
+        own_params = _dict(params, 'mapped')
+        own_groups = 'own_groups' if cmp.group else '{}'
+
+        if _disjoint(rg):
+            # No two roles bind the same name, so the merge order does not matter. Own bindings go last to win.
+            params = [f'**{r}[0]' for _, r in results] + [f'{p!r}: mapped' for p in params]
+            groups = [f'**{r}[1]' for _, r in results] + (['**own_groups'] if cmp.group else [])
+            body.append(f'    return {{{", ".join(params)}}}, {{{", ".join(groups)}}}')
+        else:
+            body.append(f'    return merge_bindings({own_params}, dict({own_groups}), rg, '
+                        f'{{{", ".join(f"{role!r}: {r}" for role, r in results)}}})')
+        self._functions.append('\n'.join(body))
+
+
+def _dict(keys: List[str], value: str) -> str:
+    """
+    :return: The source of a dict literal mapping every key to the same value expression.
+    """
+    return '{' + ', '.join(f'{k!r}: {value}' for k in keys) + '}'
+
+
+def _frozenset(values: Iterable[str]) -> str:
+    """
+    :return: The source of a frozenset of strings, in a stable order so that the generated code is reproducible.
+    """
+    return f'frozenset({sorted(set(values))!r})'
+
+
+def _subset(rg: Dict[str, List]) -> str:
+    """
+    :return: The source of a check that the sentence rolegroup 'rg' has every role of a template rolegroup.
+    """
+    return ' and '.join(f'{role!r} in rg' for role in rg) or 'True'
+
+
+def _disjoint(rg: Dict[str, List[LogicalForm.Component]]) -> bool:
+    """
+    Check if the parameters and groups that different roles of a template rolegroup may bind never collide.
+    """
+    seen_params, seen_groups = set(), set()
+    for candidates in rg.values():
+        params = set().union(*(c.bound_params for c in candidates))
+        groups = set().union(*(c.groups for c in candidates))
+        if params & seen_params or groups & seen_groups:
+            return False
+        seen_params |= params
+        seen_groups |= groups
+    return True
+
+
+def generate(templates: List[LogicalForm]) -> str:
+    """
+    Generate the source of a matcher module for a template library.
+    :param templates: Resolved templates, in matching order.
+    :return: Python source defining TEMPLATES, a list of matchers parallel to the templates. A matcher takes the root
+        of a sentence LF and returns the bound (params, groups), or None if the template does not match. Groups map
+        to sentence components, as in LogicalForm._compare.
+    """
+    return _Generator().generate(templates)
+
+
+def library_key(source_files: List[str]) -> str:
+    """
+    Identify a version of a template library for caching.
+    :param source_files: The template files of the library.
+    :return: A hexadecimal digest of the file contents and the generator version.
+    """
+    digest = blake2b(str(GENERATOR_VERSION).encode('utf-8'), digest_size=16)
+    for path in sorted(source_files):
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def cache_path(template_source: str, key: str, cache_dir: str = None) -> str:
+    """
+    Get the location of the cached matcher module of a library.
+    :param template_source: The template file or directory.
+    :param key: The library key.
+    :param cache_dir: The cache directory. By default, CACHE_DIR in the home directory of the user.
+    :return:
+    """
+    source = template_source.rstrip('/\\')
+    return join(cache_dir or CACHE_DIR, f'{basename(source)}.{key}.py')
+
+
+def source_digest(source: str) -> str:
+    """
+    Fingerprint generated matcher code, so that a cached module that was corrupted or only partly written is not run.
+    The digest is not keyed, so it does not stop anyone who can write to the cache directory from replacing both.
+    :param source: Generated source.
+    :return: A hexadecimal digest of the source and the generator version.
+    """
+    digest = blake2b(str(GENERATOR_VERSION).encode('utf-8'), digest_size=32)
+    digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _read_cached(path: str) -> Optional[str]:
+    """
+    Read a cached matcher module, provided it still has the digest recorded next to it when it was written. This only
+    detects damage: the permissions of the cache directory are what protect the module from tampering.
+    :param path: The cached module.
+    :return: Its source, or None if there is none or it does not match its digest.
+    """
+    try:
+        with open(path, 'r') as fp:
+            source = fp.read()
+        with open(path + DIGEST_SUFFIX, 'r') as fp:
+            digest = fp.read().strip()
+    except OSError:
+        return None
+
+    if digest != source_digest(source):
+        debug(f'Compiled templates at {path} do not match their digest, regenerating.')
+        return None
+    debug(f'Loaded compiled templates from {path}')
+    return source
+
+
+def _write_cached(path: str, source: str) -> NoReturn:
+    """
+    Cache a matcher module along with its digest. The digest goes last, so a partly written cache entry is never
+    trusted.
+    :param path: Where to cache the module.
+    :param source: Generated source.
+    :return: None
+    """
+    # Failing to write the cache only costs the generation next time, as with __pycache__.
+    try:
+        if not isdir(dirname(path)):
+            makedirs(dirname(path), mode=0o700)
+        for target, text in ((path, source), (path + DIGEST_SUFFIX, source_digest(source))):
+            with open(target + '.tmp', 'w') as fp:
+                fp.write(text)
+            replace(target + '.tmp', target)
+    except OSError as e:
+        debug(f'Could not cache compiled templates at {path}: {e}')
+
+
+def load_matchers(templates: List[LogicalForm], path: Optional[str] = None) -> List[Matcher]:
+    """
+    Compile the matchers of a library, reusing the cached source if there is one.
+    :param templates: Resolved templates, in matching order.
+    :param path: Where the generated source is cached. If None, nothing is cached. Cached source is only run if it
+        matches the digest stored next to it, and is regenerated otherwise.
+    :return: The matcher of each template.
+    """
+    source = None if path is None else _read_cached(path)
+    if source is None:
+        source = generate(templates)
+        if path is not None:
+            _write_cached(path, source)
+
+    namespace = dict(RUNTIME)
+    exec(compile(source, path or '<templates>', 'exec'), namespace)
+    matchers = namespace['TEMPLATES']
+    if len(matchers) != len(templates):
+        raise ValueError(f'Compiled templates {path} do not fit the library.')
+    return matchers
@@ -0,0 +1,226 @@
+"""
+A persistent cache of TRIPS replies, shared by every process that parses sentences on the same machine.
+"""
+
+import argparse
+import sqlite3
+import zlib
+from typing import *
+from threading import Lock
+from time import time
+from os import makedirs, environ
+from os.path import join, expanduser, dirname, isdir
+
+# The per-user directory every cache of the framework lives in.
+CACHE_ROOT = join(environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache'), 'vcf')
+
+DEFAULT_PATH = join(CACHE_ROOT, 'trips_cache.sqlite3')
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_EVICT_EVERY = 100  # Replies stored between two checks of the size limit.
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60  # 30 days, in seconds.
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replies (
+    endpoint TEXT NOT NULL,
+    sentence TEXT NOT NULL,
+    reply BLOB NOT NULL,     -- zlib-compressed reply XML
+    created REAL NOT NULL,   -- When the reply was received, in seconds since the epoch.
+    used REAL NOT NULL,      -- When the reply was last read, for LRU eviction.
+    PRIMARY KEY (endpoint, sentence)
+);
+CREATE INDEX IF NOT EXISTS replies_used ON replies (used);
+"""
+
+
+def normalize(sentence: str) -> str:
+    """
+    Reduce a sentence to the form it is cached under. Only whitespace is normalized: TRIPS tells proper names apart by
+    their case, and punctuation changes the speech act.
+    :param sentence: A sentence.
+    :return:
+    """
+    return ' '.join(sentence.split())
+
+
+class ParseCache:
+    """
+    TRIPS replies stored in a single SQLite file, keyed by the normalized sentence and the parser endpoint. A parse is
+    deterministic for a given parser version, so replies only go stale when the parser is updated; the age limit
+    bounds how long that can go unnoticed. The size limit evicts the least recently used replies.
+    A cache may be shared by several threads.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_age: float = DEFAULT_MAX_AGE, clock: Callable[[], float] = time,
+                 evict_every: int = DEFAULT_EVICT_EVERY):
+        """
+        Open a cache, creating it if necessary.
+        :param path: The cache file. ':memory:' keeps the cache in memory for the lifetime of this object.
+        :param max_entries: How many replies to keep. None for no limit.
+        :param max_age: How many seconds a reply stays valid. None for no limit.
+        :param clock: Gives the current time in seconds since the epoch. Replies are aged and evicted by it.
+        :param evict_every: How many replies are stored between two checks of the size limit. Counting the replies
+            scans the whole table, so the cache may hold up to this many replies too many in between.
+        """
+        if path != ':memory:' and dirname(path) and not isdir(dirname(path)):
+            makedirs(dirname(path), mode=0o700)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._clock = clock
+        self.evict_every = evict_every
+        self._stored = 0  # Replies stored since the size limit was last checked.
+        self.hits = 0
+        self.misses = 0
+
+        # Every call holds the lock, so one connection is enough for all threads.
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            if version not in (0, SCHEMA_VERSION):
+                raise ValueError(f'{path} is a parse cache of unsupported version {version}.')
+            self._db.executescript(_SCHEMA)
+            self._db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def get(self, sentence: str, endpoint: str) -> Optional[str]:
+        """
+        Look up the reply of the parser to a sentence.
+        :param sentence: A sentence.
+        :param endpoint: The parser endpoint.
+        :return: The reply XML, or None if it is not cached or too old.
+        """
+        now = self._clock()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT reply, created FROM replies WHERE endpoint = ? AND sentence = ?',
+                                   (endpoint, normalize(sentence))).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE replies SET used = ? WHERE endpoint = ? AND sentence = ?',
+                             (now, endpoint, normalize(sentence)))
+            self.hits += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, sentence: str, endpoint: str, reply: str) -> NoReturn:
+        """
+        Store the reply of the parser to a sentence, replacing an older one.
+        :param sentence: A sentence.
+        :param endpoint: The parser endpoint.
+        :param reply: The reply XML.
+        :return: None
+        """
+        now = self._clock()
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?)',
+                             (endpoint, normalize(sentence), zlib.compress(reply.encode('utf-8')), now, now))
+            self._stored += 1
+            if self.max_entries is not None and self._stored >= self.evict_every:
+                # Other processes may write to the same file, so the size is counted rather than tracked.
+                self._stored = 0
+                excess = self._db.execute('SELECT COUNT(*) FROM replies').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self._db.execute('DELETE FROM replies WHERE rowid IN '
+                                     '(SELECT rowid FROM replies ORDER BY used LIMIT ?)', (excess,))
+
+    def purge(self, max_age: float = None, endpoint: str = None) -> int:
+        """
+        Delete cached replies.
+        :param max_age: Only delete replies older than this many seconds. None deletes them regardless of age.
+        :param endpoint: Only delete the replies of this endpoint. None deletes the replies of all endpoints.
+        :return: The number of deleted replies.
+        """
+        conditions, values = [], []
+        if max_age is not None:
+            conditions.append('created < ?')
+            values.append(self._clock() - max_age)
+        if endpoint is not None:
+            conditions.append('endpoint = ?')
+            values.append(endpoint)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+        with self._lock, self._db:
+            deleted = self._db.execute(f'DELETE FROM replies{where}', values).rowcount
+        if max_age is None and endpoint is None:
+            # Give the space back after a full purge.
+            with self._lock:
+                self._db.execute('VACUUM')
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: The number of cached replies, their compressed size, and the age of the oldest one, overall and for
+            every endpoint, along with the hits and misses of this object.
+        """
+        now = self._clock()
+        with self._lock:
+            rows = self._db.execute('SELECT endpoint, COUNT(*), SUM(LENGTH(reply)), MIN(created) FROM replies '
+                                    'GROUP BY endpoint ORDER BY endpoint').fetchall()
+        endpoints = {endpoint: {'entries': count, 'bytes': size, 'oldest': now - oldest}
+                     for endpoint, count, size, oldest in rows}
+        return {
+            'path': self.path,
+            'entries': sum(e['entries'] for e in endpoints.values()),
+            'bytes': sum(e['bytes'] for e in endpoints.values()),
+            'oldest': max((e['oldest'] for e in endpoints.values()), default=None),
+            'endpoints': endpoints,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def close(self) -> NoReturn:
+        """
+        Close the cache file.
+        :return: None
+        """
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM replies').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _format_age(seconds: Optional[float]) -> str:
+    """
+    :return: A duration in the largest unit that fits.
+    """
+    if seconds is None:
+        return '-'
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return f'{seconds / size:.1f}{unit}'
+    return f'{seconds:.0f}s'
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Inspect or purge the TRIPS parse cache.")
+    arg_parser.add_argument("action", choices=['stats', 'purge'],
+                            help="'stats' summarizes the cached replies of every endpoint. 'purge' deletes replies.")
+    arg_parser.add_argument("-p", "--path", type=str, default=DEFAULT_PATH, help="The cache file.")
+    arg_parser.add_argument("-a", "--older-than", type=float, default=None,
+                            help="Only purge replies older than this many days.")
+    arg_parser.add_argument("-e", "--endpoint", type=str, default=None,
+                            help="Only purge the replies of this parser endpoint.")
+    args = arg_parser.parse_args()
+
+    with ParseCache(args.path, max_entries=None, max_age=None) as cache:
+        if args.action == 'purge':
+            max_age = None if args.older_than is None else args.older_than * 86400
+            print(f'Purged {cache.purge(max_age, args.endpoint)} replies from {args.path}.')
+        else:
+            summary = cache.stats()
+            print(f'{summary["path"]}: {summary["entries"]} replies, {summary["bytes"] / 1024:.1f} KiB, '
+                  f'oldest {_format_age(summary["oldest"])}')
+            for endpoint, e in summary['endpoints'].items():
+                print(f'\t{endpoint}: {e["entries"]} replies, {e["bytes"] / 1024:.1f} KiB, '
+                      f'oldest {_format_age(e["oldest"])}')
@@ -0,0 +1,98 @@
+"""
+Recognition of commands straight from the text of an utterance, for utterances whose match is already known.
+"""
+
+from typing import *
+from collections import OrderedDict
+from threading import Lock
+
+from framework.semantic_tools.parse_cache import normalize
+
+# What an utterance is recognized as: a command name and its bound parameters, or None for no command.
+Outcome = Optional[Tuple[str, Tuple[Tuple[str, str], ...]]]
+
+DEFAULT_MAX_ENTRIES = 10000  # Confirmed utterances kept.
+
+_AMBIGUOUS = object()  # Stands in for the outcome of an utterance with conflicting confirmed outcomes.
+
+
+class PhraseIndex:
+    """
+    A table of utterances whose command is known without parsing them. Utterances are looked up whole, normalized the
+    way the parse cache normalizes them, since any extra word may change the meaning, and case and punctuation change
+    the parse.
+
+    An outcome is either provisional, i.e. claimed by the template library, or confirmed, i.e. observed by parsing the
+    utterance and matching its LF. A confirmed outcome replaces a provisional one, and provisional outcomes are only
+    recognized on request. An utterance with conflicting outcomes of the same kind is ambiguous and never recognized,
+    so it always goes through the parser.
+
+    Every utterance the pipeline hears may be confirmed, so only the most recently used confirmed utterances are kept.
+    An index may be shared by any number of threads.
+    """
+
+    def __init__(self, max_entries: Optional[int] = DEFAULT_MAX_ENTRIES):
+        """
+        :param max_entries: How many confirmed utterances to keep. None for no limit.
+        """
+        self.max_entries = max_entries
+        self._provisional = {}  # type: Dict[str, Outcome]
+        self._confirmed = OrderedDict()  # type: Dict[str, Outcome]  # Least recently used first.
+        self._ambiguous = set()  # type: Set[str]  # Provisional utterances only.
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._provisional.keys() | self._confirmed.keys())
+
+    def add(self, utterance: str, name: Optional[str], params: Dict[str, str] = None, confirmed: bool = True) \
+            -> NoReturn:
+        """
+        Record what an utterance is recognized as.
+        :param utterance: An utterance.
+        :param name: The name of its command, or None if it matches no command.
+        :param params: The parameters the command binds.
+        :param confirmed: Whether the outcome was observed by parsing the utterance, as opposed to claimed.
+        :return: None
+        """
+        key = normalize(utterance)
+        outcome = None if name is None else (name, tuple(sorted((params or {}).items())))
+        with self._lock:
+            if not confirmed:
+                if key in self._provisional and self._provisional[key] != outcome:
+                    self._ambiguous.add(key)
+                self._provisional[key] = outcome
+                return
+
+            if key in self._confirmed and self._confirmed[key] != outcome:
+                outcome = _AMBIGUOUS
+            self._confirmed[key] = outcome
+            self._confirmed.move_to_end(key)
+            if self.max_entries is not None and len(self._confirmed) > self.max_entries:
+                self._confirmed.popitem(last=False)
+
+    def lookup(self, utterance: str, provisional: bool = False) -> Optional[Tuple[str, Dict[str, str]]]:
+        """
+        Recognize an utterance.
+        :param utterance: An utterance.
+        :param provisional: Whether an utterance that was only claimed is recognized too. A claim is only as good as
+            the library it comes from, so by default only utterances that were parsed are recognized.
+        :return: The name of its command and the parameters it binds, or None if the utterance has to be parsed.
+        """
+        key = normalize(utterance)
+        with self._lock:
+            outcome = None
+            if key in self._confirmed:
+                self._confirmed.move_to_end(key)
+                if self._confirmed[key] is not _AMBIGUOUS:
+                    outcome = self._confirmed[key]
+            elif provisional and key in self._provisional and key not in self._ambiguous:
+                outcome = self._provisional[key]
+
+            if outcome is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return outcome[0], dict(outcome[1])
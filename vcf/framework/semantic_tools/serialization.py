@@ -0,0 +1,223 @@
+"""
+Streaming serializers for Logical Forms and template libraries: the pretty_format text dump, compact JSON, and the
+binary container of flat_form.py. Everything is written to a file handle piece by piece, so even very large libraries
+are never held in memory as a single string.
+"""
+
+import argparse
+import json
+from collections import deque
+from typing import *
+
+from framework.semantic_tools.logical_form import LogicalForm, write_lines
+from framework.semantic_tools.flat_form import FlatLogicalForm
+from framework.semantic_tools.template_manager import TemplateManager
+
+JSON_FORMAT_VERSION = 1
+
+_encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+
+"""
+JSON format:
+    An LF is {"version": 1, "from_xml": bool, "text": str|null, "root": int, "components": [...]}
+    A library is {"version": 1, "commands": [{"name": str, "roots": [int, ...], "examples": [str]}, ...],
+                  "components": [...]}
+    Components are numbered by their position in the components list, and every component is stored once however
+    many roles refer to it. A role value is the number of a component or a plain string. Fields at their default
+    value are left out:
+        {"id": str, "indicator": [str], "type": [str], "word": [str] (absent for None), "params": [str],
+         "group": str, "fuzzy": true, "unresolved": true, "start": int, "end": int,
+         "roles": [{name: [int|str, ...]}, ...]}
+    One component is written per line, which keeps the output friendly to line-based diffs.
+"""
+
+
+def _component_json(cmp: LogicalForm.Component, index_of: Callable[[LogicalForm.Component], int]) -> Dict[str, Any]:
+    """
+    :param cmp: A component.
+    :param index_of: Numbers the components referenced by roles.
+    :return: The JSON object of a component.
+    """
+    data = {'id': cmp.comp_id}  # type: Dict[str, Any]
+    if cmp.indicator:
+        data['indicator'] = cmp.indicator
+    if cmp.comp_type:
+        data['type'] = cmp.comp_type
+    if cmp.word is not None:
+        data['word'] = cmp.word
+    if cmp.param_mapping:
+        data['params'] = list(cmp.param_mapping.keys())
+    if cmp.group:
+        data['group'] = cmp.group
+    if cmp.fuzzy:
+        data['fuzzy'] = True
+    if not cmp._resolved:
+        data['unresolved'] = True
+    if cmp.start is not None and cmp.end is not None:
+        data['start'], data['end'] = cmp.start, cmp.end
+    if cmp.roles != [{}]:
+        data['roles'] = [{name: [c if isinstance(c, str) else index_of(c) for c in values]
+                          for name, values in rg.items()}
+                         for rg in cmp.roles]
+    return data
+
+
+def _component_lines(roots: List[LogicalForm.Component]) -> Iterator[str]:
+    """
+    Generate the "components" list of everything reachable from a list of roots. The roots are numbered first, the
+    way _number_roots does, and the rest in breadth-first order as they are found.
+    :param roots: Root components.
+    :return:
+    """
+    numbers = {}  # type: Dict[int, int]  # id(Component) -> number
+    queue = deque()  # type: Deque[LogicalForm.Component]  # Numbered but not yet written, in number order.
+
+    def index_of(cmp: LogicalForm.Component) -> int:
+        number = numbers.get(id(cmp))
+        if number is None:
+            number = numbers[id(cmp)] = len(numbers)
+            queue.append(cmp)
+        return number
+
+    for root in roots:
+        index_of(root)
+
+    yield '"components":['
+    separator = '\n'
+    while queue:
+        yield separator
+        yield _encode(_component_json(queue.popleft(), index_of))
+        separator = ',\n'
+    yield '\n]'
+
+
+def _number_roots(roots: List[LogicalForm.Component]) -> List[int]:
+    """
+    :param roots: Root components, possibly repeated.
+    :return: The number _component_lines gives each root.
+    """
+    numbers = {}  # type: Dict[int, int]
+    return [numbers.setdefault(id(root), len(numbers)) for root in roots]
+
+
+def write_lf_json(lf: LogicalForm, fp: TextIO) -> NoReturn:
+    """
+    Write a LogicalForm as compact JSON.
+    :param lf: A LogicalForm.
+    :param fp: A file handle opened in text mode.
+    :return: None
+    """
+    if lf._root is None:
+        raise ValueError('Cannot serialize an empty LogicalForm.')
+
+    fp.write(f'{{"version":{JSON_FORMAT_VERSION},"from_xml":{_encode(lf.from_xml)},"text":{_encode(lf.text)},'
+             f'"root":0,')
+    write_lines(fp, _component_lines([lf._root]))
+    fp.write('}\n')
+
+
+def read_lf_json(fp: TextIO) -> LogicalForm:
+    """
+    Read a LogicalForm written by write_lf_json.
+    :param fp: A file handle opened in text mode.
+    :return:
+    """
+    data = json.load(fp)
+    if data.get('version') != JSON_FORMAT_VERSION:
+        raise ValueError(f'Unsupported LogicalForm JSON version {data.get("version")}.')
+
+    comps = []
+    for entry in data['components']:
+        cmp = LogicalForm.Component(entry['id'], resolved=not entry.get('unresolved', False))
+        cmp.indicator = entry.get('indicator', [])
+        cmp.comp_type = entry.get('type', [])
+        cmp.word = entry.get('word')
+        cmp.param_mapping = {p: None for p in entry.get('params', [])}
+        cmp.group = entry.get('group', '')
+        cmp.fuzzy = entry.get('fuzzy', False)
+        cmp.start, cmp.end = entry.get('start'), entry.get('end')
+        comps.append(cmp)
+
+    for cmp, entry in zip(comps, data['components']):
+        if 'roles' in entry:
+            cmp.roles = [{name: [c if isinstance(c, str) else comps[c] for c in values] for name, values in rg.items()}
+                         for rg in entry['roles']]
+
+    root = comps[data['root']]
+    if data['from_xml']:
+        LogicalForm._measure_depths(root)
+    return LogicalForm._from_root(root, data['from_xml'], data['text'])
+
+
+def write_library_json(tm: TemplateManager, fp: TextIO) -> NoReturn:
+    """
+    Write a template library as compact JSON. Subtrees shared by several commands are written once.
+    :param tm: A template library.
+    :param fp: A file handle opened in text mode.
+    :return: None
+    """
+    commands = list(tm)
+    roots = [lf._root for command in commands for lf in command.template]
+    numbers = iter(_number_roots(roots))
+
+    def lines() -> Iterator[str]:
+        yield f'{{"version":{JSON_FORMAT_VERSION},"commands":['
+        separator = '\n'
+        for command in commands:
+            yield separator
+            record = {'name': command.name, 'roots': [next(numbers) for _ in command.template]}
+            if command.examples:
+                record['examples'] = command.examples
+            yield _encode(record)
+            separator = ',\n'
+        yield '\n],'
+        yield from _component_lines(roots)
+        yield '}\n'
+
+    write_lines(fp, lines())
+
+
+def write_lf_binary(lf: LogicalForm, fp: BinaryIO) -> NoReturn:
+    """
+    Write a LogicalForm in the binary flat LF format. Load it with FlatLogicalForm.load.
+    :param lf: A LogicalForm.
+    :param fp: A file handle opened in binary mode.
+    :return: None
+    """
+    FlatLogicalForm.from_logical_form(lf).save(fp)
+
+
+def write_library_binary(tm: TemplateManager, fp: BinaryIO) -> NoReturn:
+    """
+    Write a template library in the binary flat LF format. Load it with TemplateManager.load_compiled.
+    :param tm: A template library.
+    :param fp: A file handle opened in binary mode.
+    :return: None
+    """
+    tm.save_compiled(fp)
+
+
+FORMATS = ('text', 'json', 'binary')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("templates", help="A file or directory with a series of <command> and <component> "
+                                              "definitions.")
+    arg_parser.add_argument("output", help="The file to write the library to.")
+    arg_parser.add_argument("-f", "--format", type=str, choices=FORMATS, default='text',
+                            help="'text' is the TemplateManager.dump() format, 'json' is compact JSON with one "
+                                 "component per line, and 'binary' is the flat LF container.")
+    args = arg_parser.parse_args()
+
+    library = TemplateManager(args.templates)
+    if args.format == 'binary':
+        with open(args.output, 'wb') as out:
+            write_library_binary(library, out)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as out:
+            if args.format == 'json':
+                write_library_json(library, out)
+            else:
+                library.write_dump(out)
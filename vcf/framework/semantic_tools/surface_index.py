@@ -0,0 +1,220 @@
+"""
+A vectorized pre-filter for matching many sentences against a template library at once.
+"""
+
+from typing import *
+
+import numpy as np
+
+from framework.semantic_tools.logical_form import LogicalForm
+
+# Surface feature kinds. A feature is a (kind, via, value) tuple. 'via' is the name of the role through which the
+# component was reached, or None for the root. A value of None stands for an empty list.
+INDICATOR = 'i'
+TYPE = 't'
+WORD = 'w'
+ROLE = 'r'
+
+Feature = Tuple[str, Optional[str], Optional[str]]
+Clause = FrozenSet[Feature]  # Satisfied if the sentence has at least one of the features.
+
+
+class SurfaceIndex:
+    """
+    Necessary conditions for a sentence to match each template of a library, evaluated for a whole batch of sentences
+    with a few boolean matrix products.
+
+    Every template is reduced to a set of clauses. A clause is a set of surface features, and it holds for a sentence
+    if the sentence has any of them. Root clauses are checked against the features of the sentence root. The rest
+    are checked against the features of every component that is the first value of some role, qualified by the name
+    of that role, since that is the only value of a role the matcher ever looks at. A clause is only derived where the
+    matcher could not succeed without it, so a template pruned by the index can never match, and the survivors go
+    through the exact matcher.
+    """
+
+    def __init__(self, templates: List[LogicalForm]):
+        """
+        Compile the clauses of a list of templates.
+        :param templates: Resolved templates, in matching order.
+        """
+        self.template_count = len(templates)
+        self.vocabulary = {}  # type: Dict[Feature, int]  # Feature -> matrix column
+
+        root_clauses, any_clauses = [], []  # type: List[List[Clause]]
+        for template in templates:
+            own, nested = [], []  # type: List[Clause]
+            if template._root is not None:
+                SurfaceIndex._clauses([template._root], None, set(), own, nested)
+            root_clauses.append(own)
+            any_clauses.append(nested)
+
+        root_clauses, root_incidence = self._compile(root_clauses)
+        any_clauses, any_incidence = self._compile(any_clauses)
+        self._root_clauses, self._root_incidence = self._matrices(root_clauses, root_incidence)
+        self._any_clauses, self._any_incidence = self._matrices(any_clauses, any_incidence)
+
+    @staticmethod
+    def _clauses(alternatives: List[LogicalForm.Component], via: Optional[str], on_path: Set[int],
+                 own: List[Clause], nested: List[Clause]) -> NoReturn:
+        """
+        Derive the clauses one of several template alternatives imposes on the sentence component matched against it.
+        :param alternatives: Template components, any one of which may match.
+        :param via: The role leading to the matched sentence component, None for the root.
+        :param on_path: IDs of the template components being processed above, to stop at cycles.
+        :param own: Receives the clauses on the matched sentence component.
+        :param nested: Receives the clauses on the components nested under it.
+        :return: None
+        """
+        # A field constrains the sentence only if every alternative constrains it. An empty sentence field is a
+        # wildcard, so it satisfies the clause as well.
+        for kind, field in ((INDICATOR, 'indicator'), (TYPE, 'comp_type'), (WORD, 'word')):
+            if all(getattr(alt, field) for alt in alternatives):
+                own.append(frozenset([(kind, via, None)] +
+                                     [(kind, via, v) for alt in alternatives for v in getattr(alt, field)]))
+
+        # Only follow roles when there is no choice to be made. A fuzzy component accepts any roles.
+        if len(alternatives) != 1:
+            return
+        cmp = alternatives[0]
+        if cmp.fuzzy or id(cmp) in on_path or not cmp.roles:
+            return
+
+        # A sentence component must have every role shared by all template rolegroups. The candidates for a role
+        # differ between rolegroups, so they are all alternatives.
+        required = set(cmp.roles[0].keys())
+        for rg in cmp.roles[1:]:
+            required &= rg.keys()
+
+        on_path.add(id(cmp))
+        for name in sorted(required):
+            own.append(frozenset([(ROLE, via, name)]))
+            candidates = list({id(c): c for rg in cmp.roles for c in rg[name]}.values())
+            SurfaceIndex._clauses(candidates, name, on_path, nested, nested)
+        on_path.discard(id(cmp))
+
+    def _compile(self, clauses: List[List[Clause]]) -> Tuple[List[Clause], List[Tuple[int, int]]]:
+        """
+        Number the distinct clauses of every template and register their features. Clauses shared between templates
+        are stored once.
+        :param clauses: The clauses of each template.
+        :return: The distinct clauses and the (clause, template) pairs that use them.
+        """
+        distinct = {}  # type: Dict[Clause, int]
+        incidence = []
+        for t, template_clauses in enumerate(clauses):
+            for clause in template_clauses:
+                incidence.append((distinct.setdefault(clause, len(distinct)), t))
+                for feature in clause:
+                    self.vocabulary.setdefault(feature, len(self.vocabulary))
+
+        return list(distinct.keys()), incidence
+
+    def _matrices(self, clauses: List[Clause], incidence: List[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Build the matrices for a list of clauses once the vocabulary is complete.
+        Matrices are float32 so that the products run through BLAS; every entry is 0 or 1.
+        :param clauses: Distinct clauses.
+        :param incidence: (clause, template) pairs.
+        :return: A (features x clauses) matrix and a (clauses x templates) incidence matrix.
+        """
+        clause_matrix = np.zeros((len(self.vocabulary), len(clauses)), dtype=np.float32)
+        for col, clause in enumerate(clauses):
+            clause_matrix[[self.vocabulary[f] for f in clause], col] = 1
+        incidence_matrix = np.zeros((len(clauses), self.template_count), dtype=np.float32)
+        for row, col in incidence:
+            incidence_matrix[row, col] = 1
+        return clause_matrix, incidence_matrix
+
+    def encode(self, lfs: List[LogicalForm]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode the surface features of a batch of sentences. Features that no template mentions are dropped.
+        :param lfs: Sentence LFs.
+        :return: 0/1 (sentences x features) matrices of the root features and of the features of all components.
+        """
+        # Look features up by kind and role to avoid building a tuple for every sentence feature.
+        columns = {}  # type: Dict[Tuple[str, Optional[str]], Dict[Optional[str], int]]
+        for (kind, via, value), col in self.vocabulary.items():
+            columns.setdefault((kind, via), {})[value] = col
+
+        root_rows, root_cols, rows, cols = [], [], [], []  # type: List[int]
+        for row, lf in enumerate(lfs):
+            if lf._root is None:
+                continue
+
+            found = set()  # type: Set[int]
+            SurfaceIndex._encode_component(lf._root, None, columns, found)
+            root_rows.extend([row] * len(found))
+            root_cols.extend(found)
+
+            # Walk every reachable component once, encoding the first value of each role.
+            found = set()
+            seen = {id(lf._root)}
+            stack = [lf._root]
+            while stack:
+                cmp = stack.pop()
+                for rg in cmp.roles:
+                    for name, children in rg.items():
+                        if children:
+                            SurfaceIndex._encode_component(children[0], name, columns, found)
+                        for c in children:
+                            if not isinstance(c, str) and id(c) not in seen:
+                                seen.add(id(c))
+                                stack.append(c)
+
+            rows.extend([row] * len(found))
+            cols.extend(found)
+
+        roots = np.zeros((len(lfs), len(self.vocabulary)), dtype=np.float32)
+        anywhere = np.zeros((len(lfs), len(self.vocabulary)), dtype=np.float32)
+        roots[root_rows, root_cols] = 1
+        anywhere[rows, cols] = 1
+        return roots, anywhere
+
+    @staticmethod
+    def _encode_component(cmp: Union[LogicalForm.Component, str], via: Optional[str],
+                          columns: Dict[Tuple[str, Optional[str]], Dict[Optional[str], int]], found: Set[int]):
+        """
+        Collect the matrix columns of the features of a sentence component.
+        :param cmp: Sentence component or plain string role value.
+        :param via: The role leading to the component.
+        :param columns: Feature columns by kind and role, then value.
+        :param found: Receives the columns.
+        """
+        if isinstance(cmp, str):
+            # A plain string is matched by its word alone, as if it were a component with nothing but a word.
+            fields = ((INDICATOR, None), (TYPE, None), (WORD, [cmp]))
+        else:
+            fields = ((INDICATOR, cmp.indicator), (TYPE, cmp.comp_type), (WORD, cmp.word))
+
+        for kind, values in fields:
+            lookup = columns.get((kind, via))
+            if lookup is None:
+                continue
+            if values:
+                for v in values:
+                    if v in lookup:
+                        found.add(lookup[v])
+            elif None in lookup:
+                found.add(lookup[None])
+
+        if isinstance(cmp, str):
+            return
+        lookup = columns.get((ROLE, via))
+        if lookup is not None:
+            for rg in cmp.roles:
+                for name in rg:
+                    if name in lookup:
+                        found.add(lookup[name])
+
+    def candidates(self, lfs: List[LogicalForm]) -> np.ndarray:
+        """
+        Find the templates each sentence of a batch may match.
+        :param lfs: Sentence LFs.
+        :return: A boolean (sentences x templates) matrix. False entries are guaranteed not to match.
+        """
+        roots, anywhere = self.encode(lfs)
+
+        # A template survives if none of its clauses is violated, i.e. shares no feature with the sentence.
+        violated = (roots @ self._root_clauses == 0).astype(np.float32) @ self._root_incidence
+        violated += (anywhere @ self._any_clauses == 0).astype(np.float32) @ self._any_incidence
+        return violated == 0
@@ -0,0 +1,77 @@
+"""
+String interning for the compact representations of Logical Forms.
+"""
+
+from typing import *
+
+
+class SymbolTable:
+    """
+    A bidirectional mapping between strings and dense integer IDs, assigned in order of first use.
+    A table is filled by a single thread. Once frozen, no symbols can be added, and it may be read by any number of
+    threads.
+    """
+
+    def __init__(self, symbols: Iterable[str] = ()):
+        """
+        Create a new table.
+        :param symbols: Initial symbols, which receive IDs 0, 1, 2...
+        """
+        self._symbols = []  # type: List[str]
+        self._ids = {}  # type: Dict[str, int]
+        self.frozen = False
+        for s in symbols:
+            self.intern(s)
+
+    def intern(self, symbol: str) -> int:
+        """
+        Get the ID of a symbol, assigning a new one if it has not been seen before.
+        :param symbol: A string.
+        :return: The symbol ID.
+        :raises ValueError: If the symbol is new and the table is frozen.
+        """
+        sym_id = self._ids.get(symbol)
+        if sym_id is None:
+            if self.frozen:
+                raise ValueError(f'Cannot add {symbol!r} to a frozen symbol table.')
+            sym_id = len(self._symbols)
+            self._ids[symbol] = sym_id
+            self._symbols.append(symbol)
+        return sym_id
+
+    def get(self, symbol: str) -> Optional[int]:
+        """
+        Get the ID of a symbol without interning it.
+        :param symbol: A string.
+        :return: The symbol ID, or None if the symbol is unknown.
+        """
+        return self._ids.get(symbol)
+
+    def freeze(self) -> 'SymbolTable':
+        """
+        Stop accepting new symbols.
+        :return: This table.
+        """
+        self.frozen = True
+        return self
+
+    def __getitem__(self, sym_id: int) -> str:
+        return self._symbols[sym_id]
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __iter__(self):
+        return iter(self._symbols)
+
+    def __contains__(self, symbol: str):
+        return symbol in self._ids
+
+    def __getstate__(self):
+        # The reverse mapping is cheap to rebuild, so only the symbols themselves are pickled.
+        return self._symbols, self.frozen
+
+    def __setstate__(self, state):
+        symbols, self.frozen = state
+        self._symbols = list(symbols)
+        self._ids = {s: i for i, s in enumerate(self._symbols)}
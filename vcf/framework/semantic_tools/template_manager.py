@@ -6,11 +6,22 @@ Contains functionality related to user-defined Command Templates.
 """
 
 import argparse
+from copy import copy
+from itertools import islice, chain
 from typing import *
 from os.path import isfile, join, isdir
 from os import listdir
+from logging import debug
 
-from framework.semantic_tools.logical_form import LogicalForm, CommandTemplateError
+import numpy as np
+
+from framework.semantic_tools.logical_form import LogicalForm, CommandTemplateError, MatchMemo, write_lines, \
+    surface_masks, UNKNOWN_SYMBOL
+from framework.semantic_tools.flat_form import FlatLogicalForm, write_container, read_container
+from framework.semantic_tools.symbols import SymbolTable
+from framework.semantic_tools.surface_index import SurfaceIndex
+from framework.semantic_tools.phrase_index import PhraseIndex
+from framework.semantic_tools.matcher_codegen import library_key, cache_path, load_matchers, Matcher
 from bs4 import BeautifulSoup, Tag
 
 
@@ -31,6 +42,8 @@ class Command:
         self.template = []  # type: List[LogicalForm]
         self.bound_params = {}  # type: Dict[str, str] # This will be populated with all params bound in the LF tree.
         self.groups = {}  # type: Dict[str, str]
+        self.specificity = 0  # type: int  # Set by TemplateManager.match_all.
+        self.examples = []  # type: List[str]  # Utterances this command is meant to match, from <example> tags.
 
     @property
     def signature(self) -> Optional[Tuple[str, Set[str], Set[str]]]:
@@ -50,6 +63,15 @@ class Command:
 
         return self.name, params, groups
 
+    @property
+    def fixed(self) -> bool:
+        """
+        A fixed command binds no parameters or groups, so recognizing it is all there is to matching it.
+        :return:
+        """
+        signature = self.signature
+        return signature is not None and not signature[1] and not signature[2]
+
     def __str__(self):
         return f'<command {self.name} -> {self.bound_params}/>'
 
@@ -60,11 +82,20 @@ class Command:
         """
         :return: A string representation of the underlying templates.
         """
-        result = f'<command {self.name}>\n'
-        for t in self.template:
-            result += t.pretty_format()
+        return ''.join(self.dump_lines())
+
+    def dump_lines(self) -> Iterator[str]:
+        """
+        Generate the pieces of dump() in order.
+        :return:
+        """
+        return chain((f'<command {self.name}>\n',), (f'<example>{e}</example>\n' for e in self.examples),
+                     *(t.format_lines() for t in self.template), ('</command>',))
 
-        return result + '</command>'
+
+# The kind and version of compiled libraries in the flat LF container.
+LIBRARY_KIND = 'template_library'
+LIBRARY_VERSION = 1
 
 
 class TemplateManager:
@@ -75,17 +106,22 @@ class TemplateManager:
     # TODO: nothing stopping an expansion to a directory with multiple files for ultimate modularity.
     # TODO: Gotta look into that if I get the time.
 
-    def __init__(self, template_source: str):
+    def __init__(self, template_source: str, compiled: bool = False, cache_dir: str = None):
         """
         Initialize this manager with a file of Templates.
         :param template_source: A file or directory containing a series of command template definitions.
+        :param compiled: If true, every template is compiled into a dedicated Python match function. The generated
+            code is cached on disk and reused for as long as the templates do not change.
+        :param cache_dir: Where to cache compiled templates. Defaults to a per-user cache directory, see
+            matcher_codegen.CACHE_DIR.
         """
         source_files = []
         if isfile(template_source):
             source_files.append(template_source)
         elif isdir(template_source):
-            # Supply the directory name as a prefix
-            source_files.extend(join(template_source, f) for f in listdir(template_source))
+            # Supply the directory name as a prefix. Subdirectories are skipped.
+            source_files.extend(join(template_source, f) for f in sorted(listdir(template_source))
+                                if isfile(join(template_source, f)))
         else:
             raise ValueError(f'Invalid template source {template_source}')
 
@@ -122,9 +158,13 @@ class TemplateManager:
 
                     children = list(filter(lambda c: isinstance(c, Tag), elem.children))
                     for c_comp in children:
+                        if c_comp.name == 'example':
+                            # An utterance the command should match. Used to warm up the pipeline.
+                            cmd.examples.append(' '.join(c_comp.get_text().split()))
+                            continue
                         if c_comp.name != 'component':
                             raise CommandTemplateError(f'Unexpected top-level tag under <command>: {c_comp.name}. Only '
-                                                       f'<component> allowed.')
+                                                       f'<component> and <example> allowed.')
                         comp_lf = LogicalForm(template=c_comp)
                         cmd.template.append(comp_lf)
                 else:
@@ -142,6 +182,181 @@ class TemplateManager:
                 if not lf.resolved:
                     lf.resolve(self._unresolved_comps)
 
+        # Template authors tend to repeat the same structures across commands. Collapse all structurally identical
+        # subtrees into one shared instance, which saves memory and lets match() compare each of them only once.
+        self._canonical = {}  # type: Dict[str, LogicalForm.Component]
+        for command in self._parsed_commands.values():
+            for lf in command.template:
+                lf._root = self._canonicalize(lf._root)
+        # Encode the surface features of every component, and find the role names and group components.
+        symbols = SymbolTable([UNKNOWN_SYMBOL])
+        for cmp in self._canonical.values():
+            cmp._masks = surface_masks(cmp, symbols, intern=True)
+        role_candidates = []  # type: List[Tuple[str, LogicalForm.Component]]
+        for cmp in self._canonical.values():
+            role_candidates.extend((name, c) for rg in cmp.roles for name, candidates in rg.items() for c in candidates
+                                   if not isinstance(c, str))
+        self._setup(symbols, role_candidates)
+        debug(f'Template library {template_source}: {len(self._parsed_commands)} commands, '
+              f'{len(self._canonical)} distinct components.')
+
+        if compiled:
+            path = cache_path(template_source, library_key(source_files), cache_dir)
+            self._matchers = load_matchers([lf for _, lf in self._templates], path)
+
+    def _setup(self, symbols: SymbolTable, role_candidates: Iterable[Tuple[str, LogicalForm.Component]]) \
+            -> NoReturn:
+        """
+        Set up everything derived from the resolved commands of the library. Shared by __init__ and load_compiled,
+        which find the surface vocabulary and the role candidates in their own ways.
+        :param symbols: The vocabulary of the library, with every template component already encoded over it. It is
+            complete and read-only from now on.
+        :param role_candidates: Every (role name, template candidate) pair of the library.
+        :return: None
+        """
+        self._symbols = symbols.freeze()
+        roots = [lf._root for command in self for lf in command.template]
+
+        # Which parts of a sentence matching can ever look at: the roles the templates use, the components that could
+        # bind a group, and the surface features each role accepts. All by role name, with None for the root.
+        self._role_names = set()  # type: Set[str]
+        self._group_comps = {None: [root for root in roots if root.group]}  # type: Dict[Optional[str], List]
+        self._role_masks = {}  # type: Dict[Optional[str], Tuple[int, int, int]]  # Unions of the candidate masks
+        for name, cmp in chain(role_candidates, ((None, root) for root in roots)):
+            if name is not None:
+                self._role_names.add(name)
+                if cmp.group:
+                    self._group_comps.setdefault(name, []).append(cmp)
+            ind, comp_type, word = self._role_masks.get(name, (0, 0, 0))
+            masks = cmp._masks
+            self._role_masks[name] = (ind | masks[0], comp_type | masks[1], word | masks[2])
+
+        self._surface_index = None  # type: Optional[SurfaceIndex]  # Built on the first batch match.
+        self._phrases = TemplateManager._known_phrases(self)
+
+        # Every candidate root of every command, in matching order.
+        self._templates = [(command, lf) for command in self for lf in command.template]
+        self._matchers = None  # type: Optional[List[Matcher]]
+
+    def _canonicalize(self, root: LogicalForm.Component) -> LogicalForm.Component:
+        """
+        Replace a template subtree and everything nested under it with their shared canonical instances.
+        :param root: Root of a resolved template subtree.
+        :return: The canonical instance of the root.
+        """
+        canonical = self._canonical.setdefault(root.fingerprint, root)
+        if canonical is not root:
+            return canonical
+
+        # Walk every role list of each newly registered component and swap its children for the canonical ones.
+        # Children that are already shared were processed when they were registered.
+        stack = [root]
+        while stack:
+            cmp = stack.pop()
+            for rg in cmp.roles:
+                for candidates in rg.values():
+                    for i, c in enumerate(candidates):
+                        canonical = self._canonical.setdefault(c.fingerprint, c)
+                        if canonical is c:
+                            stack.append(c)
+                        candidates[i] = canonical
+
+        return root
+
+    def __iter__(self):
+        """
+        An iterator over the commands in this library, in definition order.
+        :return:
+        """
+        for command in self._parsed_commands.values():
+            yield command
+
+    def compile_flat(self, symbols: SymbolTable = None) -> Tuple[FlatLogicalForm, List[str]]:
+        """
+        Compile the whole library into a single FlatLogicalForm. Every candidate root of every command becomes one
+        entry of the roots array, and subtrees shared between commands are stored once.
+        :param symbols: An optional table to intern strings into, i.e. one shared with flattened sentences.
+        :return: The flat library and the command name of each root.
+        """
+        roots = []
+        names = []
+        for command in self:
+            for lf in command.template:
+                roots.append(lf._root)
+                names.append(command.name)
+
+        return FlatLogicalForm.from_components(roots, symbols), names
+
+    def save_compiled(self, fp: BinaryIO) -> NoReturn:
+        """
+        Write the resolved library in the binary flat LF format: a string table, the node and role arrays of
+        compile_flat(), and an index of the commands in the header. Load it with load_compiled().
+        :param fp: A file handle opened in binary mode.
+        :return: None
+        """
+        flat, _ = self.compile_flat()
+        commands = [[command.name, len(command.template)] for command in self]
+        examples = {command.name: command.examples for command in self if command.examples}
+        write_container(fp, {'kind': LIBRARY_KIND, 'version': LIBRARY_VERSION, 'commands': commands,
+                             'examples': examples}, flat.symbols, flat.arrays)
+
+    @staticmethod
+    def load_compiled(path: str, mmap: bool = True) -> 'TemplateManager':
+        """
+        Load a library written by save_compiled(). Matching gives the same results as with the library it was saved
+        from. No templates are parsed and no component graph is built: templates are views of the arrays, and only
+        the nodes that matching visits are ever decoded.
+        :param path: File path.
+        :param mmap: If true, the arrays are read-only views of a memory mapping of the file. All processes that
+            load the same file then share its pages instead of each holding a copy of the library.
+        :return:
+        """
+        header, symbols, arrays = read_container(path, mmap)
+        if header.get('kind') != LIBRARY_KIND or header.get('version') != LIBRARY_VERSION:
+            raise ValueError(f'{path} does not contain a compiled template library.')
+        flat = FlatLogicalForm(symbols, arrays)
+
+        # There are no template files to parse, so __init__ is skipped. _setup derives everything else.
+        tm = TemplateManager.__new__(TemplateManager)
+        tm._unresolved_comps = {}
+        tm._parsed_commands = {}
+        tm._canonical = {}
+        roots = iter(flat.roots.tolist())
+        for name, count in header['commands']:
+            command = Command(name)
+            command.template = [LogicalForm._from_root(flat.view(next(roots)), False) for _ in range(count)]
+            command.examples = header.get('examples', {}).get(name, [])
+            tm._parsed_commands[name] = command
+
+        # Encode the surface features and find the role candidates straight from the arrays. Only the candidates
+        # themselves are viewed, and views decode nothing up front.
+        surface_symbols = SymbolTable([UNKNOWN_SYMBOL])
+        flat.encode_surface(surface_symbols)
+        role_names = flat.role_names.tolist()
+        slot_roles = np.repeat(np.arange(len(role_names)), np.diff(flat.child_offsets))
+        nodes = flat.children >= 0
+        tm._setup(surface_symbols, ((symbols[role_names[role]], flat.view(child))
+                                    for role, child in zip(slot_roles[nodes].tolist(), flat.children[nodes].tolist())))
+        debug(f'Compiled template library {path}: {len(tm._parsed_commands)} commands, {flat.node_count} '
+              f'distinct components.')
+        return tm
+
+    @staticmethod
+    def _known_phrases(tm: 'TemplateManager') -> PhraseIndex:
+        """
+        Claim the examples of every fixed command as utterances of that command. The words of a template are the
+        lemmas of a parse, so they tell neither the order nor the form of the words actually spoken, and examples are
+        the only surface forms a library spells out.
+        :param tm: A template library.
+        :return: The provisional phrases of the library.
+        """
+        phrases = PhraseIndex()
+        for command in tm:
+            if command.fixed:
+                for example in command.examples:
+                    phrases.add(example, command.name, confirmed=False)
+        return phrases
+
     @property
     def command_signatures(self) -> Dict[str, Tuple[Set[str], Set[str]]]:
         """
@@ -150,6 +365,14 @@ class TemplateManager:
         """
         return {comm.name: (comm.signature[1], comm.signature[2]) for comm in self._parsed_commands.values()}
 
+    @property
+    def examples(self) -> List[str]:
+        """
+        Get the example utterances of every command, in definition order.
+        :return:
+        """
+        return [e for command in self._parsed_commands.values() for e in command.examples]
+
     def match(self, lf: LogicalForm) -> Optional[Command]:
         """
         Given a Logical Form of a sentence, match it against this manager's template library. If a command is matched
@@ -160,25 +383,165 @@ class TemplateManager:
         """
         # In essence, a LogicalForm is a tree. Each Component node may have N rolegroup children, each one represening
         # a set of AND clauses. Each role node must contain at leas one component, all components being an OR clause.
-        for _, c in self._parsed_commands.items():
-            for c_lf in c.template:
-                is_match, params, groups = lf.match_template(c_lf)
-                if is_match:
-                    c.bound_params = params
-                    c.groups = groups
-                    return c
+        # Templates share canonical subtrees, so a memo of the comparisons made so far lets every command reuse them.
+        memo = MatchMemo(self._symbols)
+        for t, (c, _) in enumerate(self._templates):
+            is_match, params, groups = self._match_template(t, lf, memo)
+            if is_match:
+                c.bound_params = params
+                c.groups = groups
+                return c
 
         # If we checked all the options under this command and nothing matched, then there is no match.
         return None
 
+    def match_text(self, utterance: str, claimed: bool = False) -> Optional[Command]:
+        """
+        Recognize an utterance from its text alone, without parsing it. This works for every utterance whose match
+        was learned, unless the utterance is ambiguous.
+        :param utterance: A transcribed utterance.
+        :param claimed: Whether the examples of fixed commands are recognized before they are learned too. Nothing
+            checks that an example actually matches its command until it is parsed, so they are not by default.
+        :return: A separate Command with its bound parameters, or None if the utterance has to be parsed and matched.
+        """
+        known = self._phrases.lookup(utterance, claimed)
+        if known is None:
+            return None
+        matched = copy(self._parsed_commands[known[0]])
+        matched.bound_params = known[1]
+        matched.groups = {}
+        return matched
+
+    def learn(self, utterance: str, command: Optional[Command]) -> NoReturn:
+        """
+        Remember the outcome of matching the LF of an utterance, so that match_text recognizes the utterance from now
+        on. The outcome takes precedence over the examples of the library. Nothing is remembered for a command that
+        bound groups, since groups are parts of the LF, so the utterance keeps being parsed.
+        :param utterance: A transcribed utterance.
+        :param command: The command its LF matched, or None.
+        :return: None
+        """
+        if command is None:
+            self._phrases.add(utterance, None)
+        elif not command.groups:
+            self._phrases.add(utterance, command.name, command.bound_params)
+
+    @property
+    def phrase_stats(self) -> Dict[str, int]:
+        """
+        :return: The number of utterances match_text knows, and how many utterances it did and did not recognize.
+        """
+        return {'phrases': len(self._phrases), 'hits': self._phrases.hits, 'misses': self._phrases.misses}
+
+    def match_all(self, lf: LogicalForm) -> List[Command]:
+        """
+        Find every command of this library that matches a sentence, not only the first one match() would return.
+        All templates are evaluated in one pass over the library with a shared memo, so a subtree common to several
+        commands is only compared to the sentence once. Compiled matchers are not used, since they do not report
+        which parts of a template were matched.
+        :param lf: The LogicalForm of a sentence.
+        :return: A separate Command for every match, with its bindings and specificity (see
+            LogicalForm._specificity), most specific first. A command with several matching templates is reported once,
+            with its most specific match. Ties keep the library order.
+        """
+        memo = MatchMemo(self._symbols)
+        best = {}  # type: Dict[str, Command]
+        for c, template in self._templates:
+            is_match, params, groups, specificity = lf.match_ranked(template, memo)
+            if is_match and (c.name not in best or specificity > best[c.name].specificity):
+                matched = copy(c)
+                matched.bound_params = params
+                matched.groups = groups
+                matched.specificity = specificity
+                best[c.name] = matched
+
+        # Dicts keep the order commands were first matched in, which is the library order. The sort is stable.
+        return sorted(best.values(), key=lambda m: -m.specificity)
+
+    def _match_template(self, t: int, lf: LogicalForm, memo: Dict) -> Tuple[bool, Dict[str, str], Dict[str, str]]:
+        """
+        Match a sentence against a single template, using its compiled matcher if there is one.
+        :param t: Index of the template.
+        :param lf: The LogicalForm of a sentence.
+        :param memo: The MatchMemo of the interpreter, shared by all templates matched against the sentence.
+        :return: Match success/failure, bound params, bound groups.
+        """
+        if self._matchers is None:
+            return lf.match_template(self._templates[t][1], memo)
+
+        result = None if lf._root is None else self._matchers[t](lf._root)
+        if result is None:
+            return False, {}, {}
+        return True, result[0], lf.group_values(result[1])
+
+    def prune(self, lf: LogicalForm) -> LogicalForm:
+        """
+        Reduce a sentence LF to the parts this library can match against, dropping the roles no template uses.
+        Components that could be matched against a template with a group keep their entire subtree, since all of its
+        words go into the group. A sentence component is only ever matched against the candidates of the role that
+        leads to it, so one whose indicator, type, or word appears in none of them is collapsed to its surface.
+        :param lf: The LogicalForm of a sentence.
+        :return: An LF that matches exactly like the given one against this library.
+        """
+        group_comps, role_masks, memo = self._group_comps, self._role_masks, MatchMemo(self._symbols)
+        return lf.pruned(self._role_names,
+                         lambda c, via: any(LogicalForm._surface_match(c, g, memo) for g in group_comps.get(via, ())),
+                         lambda c, via: not LogicalForm._surface_overlap(c, role_masks.get(via, (0, 0, 0)), memo))
+
+    def match_batch(self, lfs: Iterable[LogicalForm], batch_size: int = 4096) -> List[Optional[Command]]:
+        """
+        Match many sentences against this library. The result is the same as calling match() on each sentence, but
+        the surface features of a whole batch are checked against every template at once, and only the pairs that
+        pass go through the structural matcher.
+        :param lfs: Logical Forms of the sentences.
+        :param batch_size: Number of sentences encoded at once. Bounds the size of the feature matrices.
+        :return: For each sentence, the matched Command or None. Every match is a separate Command object, so the
+            bound parameters of one sentence are not overwritten by the next.
+        """
+        if self._surface_index is None:
+            self._surface_index = SurfaceIndex([lf for _, lf in self._templates])
+
+        result = []  # type: List[Optional[Command]]
+        lfs = iter(lfs)
+        while True:
+            batch = list(islice(lfs, batch_size))
+            if not batch:
+                break
+            candidates = self._surface_index.candidates(batch)
+            for lf, row in zip(batch, candidates):
+                result.append(None)
+                memo = MatchMemo(self._symbols)
+                for t in row.nonzero()[0]:
+                    is_match, params, groups = self._match_template(t, lf, memo)
+                    if is_match:
+                        matched = copy(self._templates[t][0])
+                        matched.bound_params = params
+                        matched.groups = groups
+                        result[-1] = matched
+                        break
+
+        return result
+
     def dump(self) -> str:
         """
         :return: Return a string representation of this library.
         """
-        result = ''
-        for c in self._parsed_commands.values():
-            result += c.dump()
-        return result
+        return ''.join(self.dump_lines())
+
+    def dump_lines(self) -> Iterator[str]:
+        """
+        Generate the pieces of dump() in order, without holding the whole dump in memory.
+        :return:
+        """
+        return chain.from_iterable(c.dump_lines() for c in self._parsed_commands.values())
+
+    def write_dump(self, fp: TextIO) -> NoReturn:
+        """
+        Stream dump() to a text file handle.
+        :param fp: A file handle opened in text mode.
+        :return: None
+        """
+        write_lines(fp, self.dump_lines())
 
 
 # If running in script mode, get the source file as command line arg.
@@ -187,6 +550,8 @@ if __name__ == '__main__':
     arg_parser.add_argument("templates", help="A file or directory with a series of <command> and <component> definitions.")
     arg_parser.add_argument("sentence", help="A sentence to be matched against the templates.")
     arg_parser.add_argument("-v", "--verbose", action="store_true", help="Enables additional output.")
+    arg_parser.add_argument("-a", "--all", action="store_true",
+                            help="List every matching command, most specific first.")
     args = arg_parser.parse_args()
 
     # This is not meant to be a dependency of TemplateManager for the sake of decoupling, but it is useful to be able to
@@ -200,6 +565,17 @@ if __name__ == '__main__':
     if args.verbose:
         print(f'Input sentence parses to:\n{result.pretty_format()}')
 
+    if args.all:
+        print('\nTemplate matching results:')
+        matches = tm.match_all(result)
+        if not matches:
+            print('\tNO MATCH')
+        for match in matches:
+            print(f'\t{match.name} (specificity {match.specificity})')
+            if args.verbose:
+                print(match.bound_params)
+        exit(0)
+
     # Check if any template from the library matches this command.
     match = tm.match(result)
 
@@ -0,0 +1,280 @@
+"""
+Recorded TRIPS replies, and a local stand-in for the TRIPS parser that replays them, so that everything exercising the
+parser can run offline and reproducibly.
+"""
+
+import argparse
+import json
+from sys import exc_info
+from typing import *
+from os import makedirs, replace
+from os.path import join, isfile, isdir
+from random import uniform, random
+from threading import Lock, Thread
+from time import sleep
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+from framework.semantic_tools.parse_cache import normalize
+
+INDEX = 'cassette.json'
+PACKET = 1024  # Bytes written at a time when the bandwidth of a ReplayServer is limited.
+
+
+class Cassette:
+    """
+    A directory of recorded TRIPS replies. The directory contains a cassette.json index of {"sentence", "reply"}
+    records, each naming a reply XML file in the same directory. Sentences are looked up the way the parse cache
+    normalizes them.
+    A cassette may be recorded to from several threads.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open a cassette, or start a new one if the directory has no index yet.
+        :param path: The cassette directory.
+        """
+        self.path = path
+        self._lock = Lock()
+        self._records = []  # type: List[Dict[str, str]]
+        self._files = {}  # type: Dict[str, str]  # Normalized sentence -> reply file
+        if isfile(join(path, INDEX)):
+            with open(join(path, INDEX), 'r') as fp:
+                self._records = json.load(fp)
+            self._files = {normalize(r['sentence']): r['reply'] for r in self._records}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, sentence: str):
+        return normalize(sentence) in self._files
+
+    def get(self, sentence: str) -> Optional[str]:
+        """
+        :param sentence: A sentence.
+        :return: The recorded reply XML, or None if the sentence was not recorded.
+        """
+        file = self._files.get(normalize(sentence))
+        if file is None:
+            return None
+        with open(join(self.path, file), 'r', encoding='utf-8') as fp:
+            return fp.read()
+
+    def replies(self) -> Dict[str, str]:
+        """
+        :return: A mapping of every recorded sentence, as it was recorded, to its reply XML.
+        """
+        replies = {}
+        for record in self._records:
+            with open(join(self.path, record['reply']), 'r', encoding='utf-8') as fp:
+                replies[record['sentence']] = fp.read()
+        return replies
+
+    def record(self, sentence: str, reply: str) -> NoReturn:
+        """
+        Record the reply to a sentence, replacing an earlier one. Nothing is written if the same reply is already
+        recorded, so replaying through a recording client leaves the cassette untouched.
+        :param sentence: A sentence.
+        :param reply: The reply XML.
+        :return: None
+        """
+        with self._lock:
+            if self.get(sentence) == reply:
+                return
+
+            if not isdir(self.path):
+                makedirs(self.path)
+            file = self._files.get(normalize(sentence))
+            if file is None:
+                file = f'reply_{len(self._records) + 1:03d}.xml'
+                self._files[normalize(sentence)] = file
+                self._records.append({'sentence': sentence, 'reply': file})
+
+            with open(join(self.path, file), 'w', encoding='utf-8') as fp:
+                fp.write(reply)
+            # The index is replaced as a whole, so a reader never sees it half written.
+            with open(join(self.path, INDEX + '.tmp'), 'w') as fp:
+                json.dump(self._records, fp, indent=2)
+            replace(join(self.path, INDEX + '.tmp'), join(self.path, INDEX))
+
+
+def load_cassette(cassette: str) -> Dict[str, str]:
+    """
+    Load a directory of recorded TRIPS replies.
+    :param cassette: Path to the cassette directory.
+    :return: A mapping of sentences to raw TRIPS XML replies.
+    """
+    return Cassette(cassette).replies()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop idle kept-alive connections whenever they like.
+        if not isinstance(exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class ReplayServer:
+    """
+    A local HTTP stand-in for the TRIPS parser that answers from a cassette. Point TripsAPI at its url to use it.
+    Sentences missing from the cassette get a 404 reply. Every request is answered on its own thread after the
+    configured latency, so concurrent clients see the same overlap they would with the real parser. A fraction of the
+    replies can be made much slower than the rest, to reproduce the latency tail of a loaded parser, and the bandwidth
+    of replies can be limited, to reproduce a slow link.
+    """
+
+    def __init__(self, cassette: Union[Cassette, str], latency: float = 0.0, jitter: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0, tail: float = 0.0, tail_latency: float = 0.0,
+                 bandwidth: float = None):
+        """
+        Create a server. It does not listen until started.
+        :param cassette: A Cassette, or the path of one.
+        :param latency: Seconds to wait before every reply.
+        :param jitter: Up to this many more seconds are added to the latency of every reply at random.
+        :param host: The interface to listen on.
+        :param port: The port to listen on. 0 picks a free one.
+        :param tail: The probability of a reply being slow.
+        :param tail_latency: Seconds added to the latency of a slow reply.
+        :param bandwidth: Bytes per second every reply is sent at. None sends replies as fast as possible.
+        """
+        if isinstance(cassette, str):
+            cassette = Cassette(cassette)
+        # Replies are served from memory, so that the configured latency is all the server adds.
+        self._replies = {normalize(s): xml.encode('utf-8') for s, xml in cassette.replies().items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.tail = tail
+        self.tail_latency = tail_latency
+        self.bandwidth = bandwidth
+        self.served = 0
+        self.missed = 0
+        self._counts = Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep connections alive, like the real parser.
+            # Headers and body go out in separate writes. With Nagle's algorithm, the body of a reply on a kept-alive
+            # connection would wait for the client's delayed ACK.
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                sentence = parse_qs(body).get('input', [''])[0]
+                delay = server.latency + (uniform(0, server.jitter) if server.jitter else 0)
+                if server.tail and random() < server.tail:
+                    delay += server.tail_latency
+                sleep(delay)
+
+                reply = server._replies.get(normalize(sentence))
+                with server._counts:
+                    if reply is None:
+                        server.missed += 1
+                    else:
+                        server.served += 1
+                if reply is None:
+                    reply = f'No recorded reply for "{sentence}"'.encode('utf-8')
+                    self.send_response(404)
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                if server.bandwidth is None:
+                    self.wfile.write(reply)
+                else:
+                    for i in range(0, len(reply), PACKET):
+                        sleep(len(reply[i:i + PACKET]) / server.bandwidth)
+                        self.wfile.write(reply[i:i + PACKET])
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = None  # type: Optional[Thread]
+
+    @property
+    def url(self) -> str:
+        """
+        :return: The parse endpoint of this server.
+        """
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/parser/cgi/parse'
+
+    def start(self) -> 'ReplayServer':
+        """
+        Start serving on a background thread.
+        :return: This server.
+        """
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> NoReturn:
+        """
+        Serve on the calling thread until interrupted.
+        :return: None
+        """
+        self._httpd.serve_forever()
+
+    def stop(self) -> NoReturn:
+        """
+        Stop serving and release the port.
+        :return: None
+        """
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Record TRIPS replies into a cassette, or replay them.")
+    arg_parser.add_argument("action", choices=['serve', 'record'],
+                            help="'serve' runs a local stand-in for the parser that answers from the cassette. "
+                                 "'record' parses every sentence of a file and records the replies.")
+    arg_parser.add_argument("cassette", help="The cassette directory.")
+    arg_parser.add_argument("sentences", nargs='?', help="For 'record', a file with one sentence per line.")
+    arg_parser.add_argument("-p", "--port", type=int, default=8000, help="For 'serve', the port to listen on.")
+    arg_parser.add_argument("-l", "--latency", type=float, default=0.0,
+                            help="For 'serve', seconds to wait before every reply.")
+    arg_parser.add_argument("-j", "--jitter", type=float, default=0.0,
+                            help="For 'serve', up to this many more seconds to wait at random.")
+    arg_parser.add_argument("-t", "--tail", type=float, nargs=2, default=(0.0, 0.0), metavar=('P', 'SECONDS'),
+                            help="For 'serve', make replies slower by SECONDS with probability P.")
+    arg_parser.add_argument("-b", "--bandwidth", type=float, default=None,
+                            help="For 'serve', the bytes per second to send replies at.")
+    arg_parser.add_argument("-u", "--url", type=str, default=None, help="For 'record', the TRIPS parse endpoint.")
+    args = arg_parser.parse_args()
+
+    if args.action == 'serve':
+        replay = ReplayServer(args.cassette, args.latency, args.jitter, host='', port=args.port,
+                              tail=args.tail[0], tail_latency=args.tail[1], bandwidth=args.bandwidth)
+        print(f'Replaying {args.cassette} on port {args.port}')
+        try:
+            replay.serve_forever()
+        except KeyboardInterrupt:
+            replay.stop()
+    else:
+        if args.sentences is None:
+            arg_parser.error("'record' needs a file of sentences.")
+        # Imported here to keep the server free of the client and its dependencies.
+        from framework.semantic_tools.lf_parser import TripsAPI
+
+        with open(args.sentences, 'r') as fp:
+            sentences = [line.strip() for line in fp if line.strip()]
+        with TripsAPI(args.url, record=args.cassette) as api:
+            failed = [r for r in api.parse_many(sentences) if r.error is not None]
+        for r in failed:
+            print(f'Failed to parse "{r.sentence}": {r.error}')
+        print(f'Recorded {len(sentences) - len(failed)} replies into {args.cassette}.')
@@ -0,0 +1,147 @@
+"""
+A streaming reader for TRIPS parser replies.
+"""
+
+from typing import *
+from xml.parsers import expat
+
+DESCRIPTION = 'rdf:Description'
+ID = 'rdf:ID'
+RESOURCE = 'rdf:resource'
+ROLE_PREFIX = 'role'
+UTTERANCE = 'text'
+
+
+class Description:
+    """
+    The data of a single rdf:Description element. Only the parts used by LogicalForm are kept.
+    """
+    __slots__ = ('comp_id', 'indicator', 'comp_type', 'word', 'start', 'end', 'roles')
+
+    def __init__(self, comp_id: str):
+        self.comp_id = comp_id
+        self.indicator = []  # type: List[str]
+        self.comp_type = []  # type: List[str]
+        self.word = None  # type: Optional[List[str]]
+        # Character offsets of the span of the utterance the component covers.
+        self.start = None  # type: Optional[int]
+        self.end = None  # type: Optional[int]
+        # Roles in document order. A role value is either a referenced component ID or a plain string.
+        self.roles = []  # type: List[Tuple[str, str, bool]]  # (name, value, is_reference)
+
+
+class TripsXmlReader:
+    """
+    An incremental TRIPS reply reader built on expat. The reply may be fed in arbitrary chunks, and every
+    rdf:Description is handed to a callback as soon as its closing tag has been read.
+    No document tree is built, and everything other than indicators, types, words, spans, and roles is skipped.
+    The text of the utterance is kept as well, so that spans can be resolved to the original words.
+    """
+
+    def __init__(self, on_description: Callable[[Description], Any]):
+        """
+        Create a new reader.
+        :param on_description: Called with each completed Description, in document order.
+        """
+        self._on_description = on_description
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+
+        self.root_id = None  # type: Optional[str]  # The ID of the first description in the reply.
+        self.text = None  # type: Optional[str]  # The utterance, once its <text> element has been read.
+        self._in_text = False
+        self._current = None  # type: Optional[Description]
+        self._depth = 0  # Element depth below the current description.
+        self._resource = None  # type: Optional[str]
+        self._text = []  # type: List[str]
+
+    def feed(self, data: Union[str, bytes]) -> NoReturn:
+        """
+        Read the next chunk of the reply.
+        :param data: A piece of the XML document.
+        :return: None
+        """
+        self._parser.Parse(data, False)
+
+    def close(self) -> NoReturn:
+        """
+        Signal the end of the reply. Raises expat.ExpatError if the document was incomplete.
+        :return: None
+        """
+        self._parser.Parse(b'', True)
+        # The parser and the callback both refer back to their owners. Drop them so that the whole reader is freed
+        # by reference counting instead of waiting for the cycle collector.
+        self._parser = None
+        self._on_description = None
+
+    def _start(self, name: str, attrs: Dict[str, str]):
+        if self._current is None:
+            if name == UTTERANCE and self.text is None:
+                self._in_text = True
+                self._text = []
+            elif name == DESCRIPTION:
+                self._current = Description(attrs[ID])
+                self._depth = 0
+                if self.root_id is None:
+                    self.root_id = self._current.comp_id
+            return
+
+        self._depth += 1
+        if self._depth == 1:
+            # Only the immediate children of a description carry data. Anything nested deeper only adds text.
+            self._resource = attrs.get(RESOURCE)
+            self._text = []
+
+    def _chars(self, data: str):
+        if (self._current is not None and self._depth > 0) or self._in_text:
+            self._text.append(data)
+
+    def _end(self, name: str):
+        if self._current is None:
+            if self._in_text:
+                self._in_text = False
+                self.text = ''.join(self._text)
+            return
+
+        if self._depth == 0:
+            # The description itself is complete.
+            description, self._current = self._current, None
+            self._on_description(description)
+            return
+
+        if self._depth == 1:
+            self._field(name)
+        self._depth -= 1
+
+    def _field(self, name: str):
+        """
+        Store the value of a completed child element of the current description.
+        :param name: The qualified element name, i.e. LF:indicator or role:AGENT
+        """
+        prefix, _, local = name.rpartition(':')
+        text = ''.join(self._text)
+        description = self._current
+
+        if local == 'indicator':
+            description.indicator.append(text)
+        elif local == 'type':
+            description.comp_type.append(text)
+        elif local == 'word':
+            if description.word is None:
+                description.word = [text]
+            else:
+                description.word.append(text)
+        elif local == 'start':
+            description.start = int(text)
+        elif local == 'end':
+            description.end = int(text)
+        elif prefix == ROLE_PREFIX:
+            if self._resource is not None:
+                # Skip the '#' prefix of the reference.
+                description.roles.append((local, self._resource[1:], True))
+            else:
+                # Some roles are basic strings.
+                description.roles.append((local, text, False))
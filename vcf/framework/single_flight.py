@@ -0,0 +1,73 @@
+"""
+Coalescing of identical concurrent calls: while a call with some key is in flight, later calls with the same key wait
+for its result instead of making their own.
+"""
+
+from typing import *
+from concurrent.futures import Future
+from threading import Lock
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. A call that arrives while another with the same key is in flight gets the
+    result of that call, or its exception. Nothing is remembered once a call completes, so a result is never older
+    than the calls it is handed to.
+    A SingleFlight may be shared by any number of threads.
+    """
+
+    def __init__(self):
+        self.calls = 0  # Calls made.
+        self.coalesced = 0  # Calls answered by a call already in flight.
+        self._lock = Lock()
+        self._in_flight = {}  # type: Dict[Hashable, Future]
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args) -> Any:
+        """
+        Call a function, unless a call with the same key is in flight, in which case wait for its result.
+        :param key: Identifies calls that are interchangeable.
+        :param func: The function to call.
+        :param args: Arguments to the function.
+        :return: The result of the call.
+        :raises Exception: Whatever the call raised.
+        """
+        with self._lock:
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = self._in_flight[key] = Future()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            return flight.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self._land(key)
+            flight.set_exception(e)
+            raise
+        self._land(key)
+        flight.set_result(result)
+        return result
+
+    def _land(self, key: Hashable) -> NoReturn:
+        """
+        Let calls that arrive from now on make their own call.
+        :param key: The key of a call that completed.
+        :return: None
+        """
+        with self._lock:
+            del self._in_flight[key]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The number of calls made, the number of calls answered by another call, and the number of calls in
+            flight.
+        """
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
@@ -12,6 +12,7 @@ import os
 import os.path
 from io import open
 import uuid
+from typing import *
 from time import time
 from shutil import rmtree
 import keyboard
@@ -22,6 +23,7 @@ from logging import debug
 from os.path import dirname, join
 
 from framework.speech_recognition.until import Until, RecordStatus
+from framework.single_flight import SingleFlight
 from google.cloud.speech_v1 import enums
 
 import soundfile as sf
@@ -29,6 +31,7 @@ import sounddevice as sd
 
 import requests
 import base64
+from hashlib import sha1
 
 DEFAULT_CONFIG_NAME = join(dirname(__file__), 'configuration.json')
 
@@ -50,6 +53,8 @@ class SpeechTranscriber:
         """
         if configuration is None:
             configuration = DEFAULT_CONFIG_NAME
+        # Transcriptions of the same audio that run at the same time share one request.
+        self._flights = SingleFlight()
         try:
             with open(configuration, 'r') as config_fp:
                 conf_obj = json.loads(config_fp.read())
@@ -75,8 +80,11 @@ class SpeechTranscriber:
                 self._recording.wave_filename = conf_obj['recording']['wave_filename']
                 self._recording.buffer_name = conf_obj['recording']['buffer_name']
 
-                self._transcription = namedtuple('transcription', ['language', 'encoding', 'encoding_name'])
+                self._transcription = namedtuple('transcription', ['language', 'encoding', 'encoding_name',
+                                                                   'max_alternatives'])
                 self._transcription.language = conf_obj['transcription']['language']
+                # How many of the likeliest transcriptions to ask for. Older configurations only ask for one.
+                self._transcription.max_alternatives = conf_obj['transcription'].get('max_alternatives', 1)
                 self._transcription.encoding_name = conf_obj['transcription']['encoding']
                 self._transcription.encoding = SpeechTranscriber.__audio_encodings[conf_obj['transcription']['encoding']]
 
@@ -100,6 +108,15 @@ class SpeechTranscriber:
         :param until: A function that takes no arguments and returns a boolean.
         :return: (str) A transcription of the audio.
         """
+        return self.listen_alternatives(until)[0]
+
+    def listen_alternatives(self, until: Until) -> List[str]:
+        """
+        Record the system's audio until a condition is met and transcribe the voice, keeping the alternative
+        transcriptions of the speech API.
+        :param until: A function that takes no arguments and returns a boolean.
+        :return: Up to max_alternatives transcriptions of the audio, likeliest first.
+        """
         debug('Awaiting recording.')
         start_time = time()  # Default timeout timer
 
@@ -141,14 +158,43 @@ class SpeechTranscriber:
             raise SystemError('Failed to generate a unique work directory.')
         debug('Recording over!')
 
+        with open(full_path, "rb") as f:
+            content = f.read()
+
+        # Finally, clean up the temp directory.
+        rmtree(tmp_dir_name)
+
+        return self.transcribe_alternatives(content)
+
+    def transcribe(self, content: bytes) -> str:
+        """
+        Transcribe recorded audio.
+        :param content: The contents of a WAV file in the configured recording format.
+        :return: (str) A transcription of the audio.
+        """
+        return self.transcribe_alternatives(content)[0]
+
+    def transcribe_alternatives(self, content: bytes) -> List[str]:
+        """
+        Transcribe recorded audio. A transcription of the same audio that is already under way is waited for
+        instead of being requested again.
+        :param content: The contents of a WAV file in the configured recording format.
+        :return: Up to max_alternatives transcriptions of the audio, likeliest first.
+        """
+        return self._flights.do(sha1(content).digest(), self._request_transcripts, content)
+
+    def _request_transcripts(self, content: bytes) -> List[str]:
+        """
+        Send recorded audio to the speech API.
+        :param content: The contents of a WAV file in the configured recording format.
+        :return: Up to max_alternatives transcriptions of the audio, likeliest first.
+        """
         config = {
             "language_code": self._transcription.language,
             "sample_rate_hertz": self._recording.rate,
             "encoding": self._transcription.encoding,
+            "max_alternatives": self._transcription.max_alternatives,
         }
-        with open(full_path, "rb") as f:
-            content = f.read()
-
         content_str = base64.b64encode(content).decode('utf-8')
         data = {'config': config, 'audio': {'content': content_str}}
 
@@ -157,11 +203,15 @@ class SpeechTranscriber:
 
         # TODO: Check that response was not an error.
 
-        # Finally, clean up the temp directory.
-        del config
-        rmtree(tmp_dir_name)
+        return [alternative['transcript'] for alternative in result['results'][0]['alternatives']]
 
-        return result['results'][0]['alternatives'][0]['transcript']
+    @property
+    def coalesce_stats(self) -> Dict[str, int]:
+        """
+        :return: The number of transcription requests sent, the number of transcriptions that waited for a request
+            of the same audio instead, and the number of requests in flight.
+        """
+        return self._flights.stats
 
 
 if __name__ == '__main__':
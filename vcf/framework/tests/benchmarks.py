@@ -0,0 +1,633 @@
+"""
+Micro-benchmarks for the semantic tools. Each benchmark compares an implementation against the one it replaced.
+"""
+
+import argparse
+import re
+from typing import *
+from timeit import Timer
+from time import perf_counter
+from tempfile import TemporaryDirectory
+import tracemalloc
+from os import listdir
+from os.path import abspath, dirname, join, splitext
+
+from framework.semantic_tools.logical_form import LogicalForm, MatchMemo
+from framework.semantic_tools.flat_form import FlatLogicalForm
+from framework.semantic_tools.symbols import SymbolTable
+from framework.semantic_tools.template_manager import TemplateManager
+from framework.semantic_tools.serialization import write_library_json, write_library_binary
+from framework.semantic_tools.lf_parser import TripsAPI
+from framework.semantic_tools.trips_cassette import Cassette, ReplayServer, load_cassette
+from template_manager_tests import DEFAULT_CASSETTE
+from reference_lf import compare, pretty_format_concat, process_xml_soup
+import requests
+
+REPEAT = 5
+
+LIBRARIES = join(dirname(abspath(__file__)), 'tm_match_data')  # Template libraries to match against.
+
+
+def best_time(func: Callable[[], Any], number: int) -> float:
+    """
+    Time a function, taking the best of several runs to reduce noise.
+    :param func: The function to time.
+    :param number: Number of calls per run.
+    :return: Best time per call, in seconds.
+    """
+    return min(Timer(func).repeat(repeat=REPEAT, number=number)) / number
+
+
+def report(name: str, baseline: float, candidate: float):
+    """
+    Print a single benchmark line.
+    :param name: Benchmark name.
+    :param baseline: Time per call of the original implementation, in seconds.
+    :param candidate: Time per call of the new implementation, in seconds.
+    """
+    print(f'{name:<32} baseline {baseline * 1e6:10.1f}us    new {candidate * 1e6:10.1f}us    '
+          f'speed-up {baseline / candidate:5.1f}x')
+
+
+def synthetic_reply(size: int) -> str:
+    """
+    Generate a TRIPS-like reply for a long utterance: a chain of modifiers, each pointing back at its owner.
+    Every component spans the rest of the utterance from its own word on.
+    :param size: Number of components.
+    :return: XML reply string.
+    """
+    words = [f'word{i}' for i in range(size)]
+    text = ' '.join(words)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<trips-parser-output><utt>\n'
+             f'<text>{text}</text>\n<terms>\n'
+             '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+             'xmlns:role="http://www.cs.rochester.edu/research/trips/role#" '
+             'xmlns:LF="http://www.cs.rochester.edu/research/trips/LF#">\n']
+    start = 0
+    for i in range(size):
+        parts.append(f'<rdf:Description rdf:ID="V{i}">\n<LF:indicator>F</LF:indicator>\n'
+                     f'<LF:type>TYPE-{i % 17}</LF:type>\n<LF:word>WORD{i}</LF:word>\n')
+        if i + 1 < size:
+            parts.append(f'<role:MOD rdf:resource="#V{i + 1}" />\n')
+        if i > 0:
+            parts.append(f'<role:FIGURE rdf:resource="#V{i - 1}" />\n')
+        parts.append(f'<role:TENSE>PRES</role:TENSE>\n<LF:start>{start}</LF:start>\n<LF:end>{len(text)}</LF:end>\n'
+                     '</rdf:Description>\n')
+        start += len(words[i]) + 1
+    parts.append('</rdf:RDF>\n</terms></utt></trips-parser-output>\n')
+    return ''.join(parts)
+
+
+def bench_xml(replies: Dict[str, str]):
+    """
+    Compare the streaming TRIPS reply reader with the BeautifulSoup one.
+    :param replies: Recorded replies.
+    """
+    docs = list(replies.values())
+    report(f'trips xml: corpus ({len(docs)} replies)',
+           best_time(lambda: [process_xml_soup(d) for d in docs], 20) / len(docs),
+           best_time(lambda: [LogicalForm._process_xml(d) for d in docs], 20) / len(docs))
+
+    long_reply = synthetic_reply(200)
+    report('trips xml: 200 components',
+           best_time(lambda: process_xml_soup(long_reply), 10),
+           best_time(lambda: LogicalForm._process_xml(long_reply), 10))
+
+
+def allocated(func: Callable[[], Any]) -> int:
+    """
+    Measure the memory retained by the result of a function.
+    :param func: The function to measure.
+    :return: Bytes still allocated once the function returns, while its result is alive.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def peak_allocated(func: Callable[[], Any]) -> int:
+    """
+    Measure the most memory a function has allocated at once, including temporaries it has freed since.
+    :param func: The function to measure.
+    :return: Peak bytes allocated while the function ran.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peak
+
+
+def report_memory(name: str, baseline: int, candidate: int):
+    """
+    Print a single memory benchmark line.
+    :param name: Benchmark name.
+    :param baseline: Bytes used by the original representation.
+    :param candidate: Bytes used by the new representation.
+    """
+    print(f'{name:<32} baseline {baseline / 1024:9.1f}KiB    new {candidate / 1024:9.1f}KiB    '
+          f'ratio {candidate / baseline:5.2f}')
+
+
+def bench_flat(replies: Dict[str, str]):
+    """
+    Compare the memory used by LogicalForm object graphs and by their flat counterparts.
+    :param replies: Recorded replies.
+    """
+    docs = list(replies.values())
+
+    def flatten_all():
+        # A batch of flat LFs shares a single symbol table.
+        symbols = SymbolTable()
+        return [FlatLogicalForm.from_xml(d, symbols) for d in docs]
+
+    report_memory(f'flat lf: corpus ({len(docs)} replies)',
+                  allocated(lambda: [LogicalForm(d) for d in docs]),
+                  allocated(flatten_all))
+
+    long_reply = synthetic_reply(200)
+    report_memory('flat lf: 200 components',
+                  allocated(lambda: LogicalForm(long_reply)),
+                  allocated(lambda: FlatLogicalForm.from_xml(long_reply)))
+    report('flat lf: build 200 components',
+           best_time(lambda: LogicalForm(long_reply), 10),
+           best_time(lambda: FlatLogicalForm.from_xml(long_reply), 10))
+
+
+def libraries(**kwargs) -> Iterator[Tuple[str, TemplateManager]]:
+    """
+    Load every template library of the matching tests.
+    :param kwargs: TemplateManager options.
+    :return: (name, manager) pairs.
+    """
+    for file in sorted(listdir(LIBRARIES)):
+        name, ext = splitext(file)
+        if ext == '.xml':
+            yield name, TemplateManager(join(LIBRARIES, file), **kwargs)
+
+
+def synthetic_library(size: int) -> str:
+    """
+    Generate a library the size of a real application: many requests that differ in their verb and object.
+    :param size: Number of commands.
+    :return: Template XML string.
+    """
+    parts = ['<commands>\n']
+    for i in range(size):
+        parts.append(f'<command name="COMMAND_{i}">\n<component indicator="SPEECHACT" type="SA_REQUEST">\n'
+                     f'<role name="CONTENT">\n<component indicator="F" type="VERB-{i % 40}" map_param="verb">\n'
+                     f'<role name="AFFECTED">\n<component word="OBJECT{i}" map_param="object"/>\n</role>\n'
+                     f'</component>\n</role>\n</component>\n</command>\n')
+    parts.append('</commands>\n')
+    return ''.join(parts)
+
+
+def near_miss_library(size: int) -> str:
+    """
+    Generate a library of commands that all match most of a sentence about eating, binding parameters and groups on
+    the way, and then fail on the last role.
+    :param size: Number of commands.
+    :return: Template XML string.
+    """
+    parts = ['<commands>\n']
+    for i in range(size):
+        parts.append(f'<command name="NEAR_MISS_{i}">\n<component indicator="SPEECHACT">\n<role name="CONTENT">\n'
+                     f'<component indicator="F" type="EAT" map_param="verb_{i}" group="sentence_{i}">\n'
+                     f'<role name="AGENT">\n<component map_param="agent_{i}" group="agent_{i}"/>\n</role>\n'
+                     f'<role name="AFFECTED">\n<component word="OBJECT{i}" map_param="object"/>\n</role>\n'
+                     f'</component>\n</role>\n</component>\n</command>\n')
+    parts.append('</commands>\n')
+    return ''.join(parts)
+
+
+def overlapping_library(size: int) -> str:
+    """
+    Generate a library of commands that all match any sentence about eating. They differ only in what they bind at
+    the root, so the rest of their templates is shared.
+    :param size: Number of commands.
+    :return: Template XML string.
+    """
+    parts = ['<commands>\n']
+    for i in range(size):
+        parts.append(f'<command name="OVERLAP_{i}">\n<component indicator="SPEECHACT" map_param="act_{i}">\n'
+                     f'<role name="CONTENT">\n<component indicator="F" type="EAT" map_param="verb">\n'
+                     f'<role name="AGENT">\n<component map_param="agent"/>\n</role>\n'
+                     f'<role name="AFFECTED">\n<component map_param="object"/>\n</role>\n'
+                     f'</component>\n</role>\n</component>\n</command>\n')
+    parts.append('</commands>\n')
+    return ''.join(parts)
+
+
+def bench_batch(replies: Dict[str, str]):
+    """
+    Compare matching a large batch of sentences one by one and with match_batch.
+    :param replies: Recorded replies.
+    """
+    lfs = [LogicalForm(d) for d in replies.values()] * 64
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, 'synthetic.xml')
+        with open(path, 'w') as fp:
+            fp.write(synthetic_library(200))
+        synthetic = TemplateManager(path)
+
+    for name, tm in [*libraries(), ('synthetic (200 commands)', synthetic)]:
+        tm.match_batch(lfs[:1])  # Build the surface index up front.
+        baseline = best_time(lambda: [tm.match(lf) for lf in lfs], 1)
+        candidate = best_time(lambda: tm.match_batch(lfs), 1)
+        report(f'batch: {name} ({len(lfs)})', baseline, candidate)
+
+
+def surface_match_sets(this: LogicalForm.Component, other: LogicalForm.Component) -> bool:
+    """
+    The surface check as written in reference_lf.compare, building a set for each list.
+    """
+    lst_common = lambda lst_t: bool(set(lst_t[0]).intersection(set(lst_t[1])))
+    match = not (this.indicator and other.indicator) or lst_common((this.indicator, other.indicator))
+    match = match and (not (this.comp_type and other.comp_type) or lst_common((this.comp_type, other.comp_type)))
+    return match and (not (this.word and other.word) or lst_common((this.word, other.word)))
+
+
+def bench_surface(replies: Dict[str, str]):
+    """
+    Compare the surface checks on every pair of sentence and template components.
+    :param replies: Recorded replies.
+    """
+    sentence_comps = [c for d in replies.values() for c in LogicalForm._iterate(LogicalForm(d)._root)]
+    pairs = []  # type: List[Tuple[LogicalForm.Component, LogicalForm.Component, MatchMemo]]
+    for _, tm in libraries():
+        memo = MatchMemo(tm._symbols)
+        pairs.extend((this, other, memo) for command in tm for t in command.template
+                     for other in LogicalForm._iterate(t._root) for this in sentence_comps)
+
+    bitmask = LogicalForm._surface_match
+    for this, other, memo in pairs:
+        bitmask(this, other, memo)  # Encode the sentences up front, as the first comparisons of a match would.
+
+    new = best_time(lambda: [bitmask(this, other, memo) for this, other, memo in pairs], 10) / len(pairs)
+    report(f'surface: sets ({len(pairs)} pairs)', best_time(
+        lambda: [surface_match_sets(this, other) for this, other, _ in pairs], 10) / len(pairs), new)
+    lists = LogicalForm._surface_match_lists
+    report(f'surface: lists ({len(pairs)} pairs)', best_time(
+        lambda: [lists(this, other) for this, other, _ in pairs], 10) / len(pairs), new)
+
+
+def bench_prune(replies: Dict[str, str]):
+    """
+    Compare matching sentences as parsed and after pruning them against the library.
+    :param replies: Recorded replies.
+    """
+    lfs = [LogicalForm(d) for d in replies.values()] * 64
+    for name, tm in libraries():
+        pruned = [tm.prune(lf) for lf in lfs]
+        before = sum(1 for lf in lfs for _ in LogicalForm._iterate(lf._root))
+        after = sum(1 for lf in pruned for _ in LogicalForm._iterate(lf._root))
+        cost = best_time(lambda: [tm.prune(lf) for lf in lfs], 5) / len(lfs)
+        print(f'prune: {name} keeps {after}/{before} components, {cost * 1e6:.1f}us per sentence')
+
+        report(f'prune: {name} match', best_time(lambda: [tm.match(lf) for lf in lfs], 5),
+               best_time(lambda: [tm.match(lf) for lf in pruned], 5))
+        report(f'prune: {name} match_batch', best_time(lambda: tm.match_batch(lfs), 5),
+               best_time(lambda: tm.match_batch(pruned), 5))
+
+
+def bench_compiled(replies: Dict[str, str]):
+    """
+    Compare matching with the interpreter and with compiled templates.
+    :param replies: Recorded replies.
+    """
+    lfs = [LogicalForm(d) for d in replies.values()] * 64
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, 'synthetic.xml')
+        with open(path, 'w') as fp:
+            fp.write(synthetic_library(200))
+        managers = [(name, tm, TemplateManager(join(LIBRARIES, f'{name}.xml'), compiled=True, cache_dir=tmp))
+                    for name, tm in libraries()]
+        managers.append(('synthetic (200 commands)', TemplateManager(path),
+                         TemplateManager(path, compiled=True, cache_dir=tmp)))
+
+    for name, tm, compiled in managers:
+        report(f'compiled: {name} ({len(lfs)})', best_time(lambda: [tm.match(lf) for lf in lfs], 5),
+               best_time(lambda: [compiled.match(lf) for lf in lfs], 5))
+
+
+def bench_group(replies: Dict[str, str]):
+    """
+    Compare joining the words of a grouped subtree with slicing the span of the utterance it covers.
+    :param replies: Recorded replies.
+    """
+    for size in (10, 100, 1000):
+        lf = LogicalForm(synthetic_reply(size))
+        report(f'group: {size} components', best_time(lambda: LogicalForm._group_words(lf._root), 100),
+               best_time(lambda: lf.group_values({'query': lf._root}), 100))
+
+    # End to end, on a library whose templates bind groups. Without the utterance, groups fall back to the words.
+    tm = TemplateManager(join(LIBRARIES, 'group_query.xml'))
+    lfs = [LogicalForm(xml_str) for xml_str in replies.values()]
+    words = [LogicalForm._from_root(lf._root, lf.from_xml) for lf in lfs]
+    report(f'group: group_query ({len(lfs)})', best_time(lambda: [tm.match(lf) for lf in words], 20),
+           best_time(lambda: [tm.match(lf) for lf in lfs], 20))
+
+
+def bench_bindings(replies: Dict[str, str]):
+    """
+    Compare the original matcher, which builds the bindings of every branch it tries, with recording bindings as
+    references and building them for the final match only. Near misses bind a lot before they fail.
+    :param replies: Recorded replies.
+    """
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, 'near_miss.xml')
+        with open(path, 'w') as fp:
+            fp.write(near_miss_library(200))
+        managers = [*libraries(), ('near misses (200)', TemplateManager(path))]
+
+    # Outcomes are dropped right away and no memo is kept, so the peak only counts what matching allocates.
+    lfs = [LogicalForm(xml_str) for xml_str in replies.values()]
+    for name, tm in managers:
+        templates = [t for _, t in tm._templates]
+
+        def eager():
+            for lf in lfs:
+                for t in templates:
+                    compare(lf._root, t._root)
+
+        def deferred():
+            for lf in lfs:
+                for t in templates:
+                    lf.match_template(t)
+
+        report(f'bindings: {name}', best_time(eager, 5), best_time(deferred, 5))
+        report_memory(f'bindings: {name} peak', peak_allocated(eager), peak_allocated(deferred))
+
+
+def match_repeatedly(tm: TemplateManager, lf: LogicalForm) -> List[str]:
+    """
+    Find every command matching a sentence the way it had to be done before match_all: match, take the matched
+    command out of the library, and match again until nothing matches.
+    :param tm: A template library. Restored before returning.
+    :param lf: A sentence LF.
+    :return: Names of the matched commands.
+    """
+    templates = tm._templates
+    found = []
+    try:
+        while True:
+            matched = tm.match(lf)
+            if matched is None:
+                return found
+            found.append(matched.name)
+            tm._templates = [(c, t) for c, t in tm._templates if c.name != matched.name]
+    finally:
+        tm._templates = templates
+
+
+def bench_ranked(replies: Dict[str, str]):
+    """
+    Compare finding every matching command by matching repeatedly on a shrinking library with match_all.
+    :param replies: Recorded replies.
+    """
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, 'near_miss.xml')
+        with open(path, 'w') as fp:
+            fp.write(near_miss_library(200))
+        managers = [*libraries(), ('near misses (200)', TemplateManager(path))]
+        with open(path, 'w') as fp:
+            fp.write(overlapping_library(50))
+        managers.append(('overlapping (50)', TemplateManager(path)))
+
+    lfs = [LogicalForm(xml_str) for xml_str in replies.values()]
+    for name, tm in managers:
+        report(f'ranked: {name} ({len(lfs)})', best_time(lambda: [match_repeatedly(tm, lf) for lf in lfs], 5),
+               best_time(lambda: [tm.match_all(lf) for lf in lfs], 5))
+
+
+def dump_concat(tm: TemplateManager) -> str:
+    """
+    TemplateManager.dump as originally written, concatenating the dump of every command.
+    """
+    result = ''
+    for c in tm._parsed_commands.values():
+        command = f'<command {c.name}>\n'
+        for t in c.template:
+            command += pretty_format_concat(t)
+        result += command + '</command>'
+    return result
+
+
+def bench_dump(replies: Dict[str, str]):
+    """
+    Compare building a library dump in memory with streaming it, and with the JSON and binary forms.
+    :param replies: Recorded replies.
+    """
+    with TemporaryDirectory() as tmp:
+        path = join(tmp, 'synthetic.xml')
+        with open(path, 'w') as fp:
+            fp.write(synthetic_library(5000))
+        tm = TemplateManager(path)
+
+        def write_concat():
+            with open(join(tmp, 'dump.txt'), 'w') as out:
+                out.write(dump_concat(tm))
+
+        def write_text():
+            with open(join(tmp, 'dump.txt'), 'w') as out:
+                tm.write_dump(out)
+
+        def write_json():
+            with open(join(tmp, 'dump.json'), 'w') as out:
+                write_library_json(tm, out)
+
+        def write_binary():
+            with open(join(tmp, 'dump.flat'), 'wb') as out:
+                write_library_binary(tm, out)
+
+        baseline = best_time(write_concat, 1)
+        report('dump: text (5000 commands)', baseline, best_time(write_text, 1))
+        report('dump: json (5000 commands)', baseline, best_time(write_json, 1))
+        report('dump: binary (5000 commands)', baseline, best_time(write_binary, 1))
+        report_memory('dump: text peak', peak_allocated(write_concat), peak_allocated(write_text))
+        report_memory('dump: json peak', peak_allocated(write_concat), peak_allocated(write_json))
+
+
+def bench_library(replies: Dict[str, str]):
+    """
+    Compare parsing a template library with loading its compiled, memory-mapped form. tracemalloc only sees the
+    Python heap, which is exactly the part that every process holds a private copy of.
+    :param replies: Recorded replies.
+    """
+    lfs = [LogicalForm(xml_str) for xml_str in replies.values()]
+    with TemporaryDirectory() as tmp:
+        path, compiled_path = join(tmp, 'synthetic.xml'), join(tmp, 'synthetic.flat')
+        with open(path, 'w') as fp:
+            fp.write(synthetic_library(5000))
+        with open(compiled_path, 'wb') as fp:
+            TemplateManager(path).save_compiled(fp)
+
+        report('library: load (5000 commands)', best_time(lambda: TemplateManager(path), 1),
+               best_time(lambda: TemplateManager.load_compiled(compiled_path), 1))
+        report_memory('library: load (5000 commands)', allocated(lambda: TemplateManager(path)),
+                      allocated(lambda: TemplateManager.load_compiled(compiled_path)))
+
+        def load_and_match(load: Callable[[], TemplateManager]) -> TemplateManager:
+            tm = load()
+            for lf in lfs:
+                tm.match(lf)
+            return tm
+
+        report_memory(f'library: after {len(lfs)} matches',
+                      allocated(lambda: load_and_match(lambda: TemplateManager(path))),
+                      allocated(lambda: load_and_match(lambda: TemplateManager.load_compiled(compiled_path))))
+
+        tm, loaded = TemplateManager(path), load_and_match(lambda: TemplateManager.load_compiled(compiled_path))
+        report(f'library: match ({len(lfs)})', best_time(lambda: [tm.match(lf) for lf in lfs], 5),
+               best_time(lambda: [loaded.match(lf) for lf in lfs], 5))
+        del tm, loaded
+
+
+def bench_parse(replies: Dict[str, str]):
+    """
+    Against a local replay of the recorded replies, compare a new connection for every parse with the pooled client,
+    and parsing one sentence at a time with parse_many.
+    :param replies: Recorded replies.
+    """
+    sentences = list(replies.keys())
+    with TemporaryDirectory() as tmp:
+        cassette = Cassette(tmp)
+        for sentence, xml_str in replies.items():
+            cassette.record(sentence, xml_str)
+
+        with ReplayServer(cassette) as replay, TripsAPI(replay.url) as api:
+            report(f'parse: keep-alive ({len(sentences)})',
+                   best_time(lambda: [LogicalForm(requests.post(replay.url, {'input': s}).text) for s in sentences], 5),
+                   best_time(lambda: [api.parse(s) for s in sentences], 5))
+
+        # With the latency of a real parser, the time goes into waiting for replies.
+        with ReplayServer(cassette, latency=0.05) as replay, TripsAPI(replay.url, pool_size=8) as api:
+            report(f'parse: 50ms parser ({len(sentences)})', best_time(lambda: [api.parse(s) for s in sentences], 1),
+                   best_time(lambda: api.parse_many(sentences), 1))
+
+
+def bench_hedge(replies: Dict[str, str]):
+    """
+    Against a local replay where one reply in twenty is half a second slower, compare the tail latency of sequential
+    parsing with and without hedging at the 90th percentile.
+    :param replies: Recorded replies.
+    """
+    sentences = list(replies.keys()) * max(1, 200 // len(replies))
+    with TemporaryDirectory() as tmp:
+        cassette = Cassette(tmp)
+        for sentence, xml_str in replies.items():
+            cassette.record(sentence, xml_str)
+
+        with ReplayServer(cassette, latency=0.01, tail=0.05, tail_latency=0.5) as replay:
+            for label, options in (('plain', {}), ('hedged', {'hedge_percentile': 90, 'hedge_rate': 0.15})):
+                with TripsAPI(replay.url, **options) as api:
+                    start = perf_counter()
+                    latencies = sorted(api.parse_many([s])[0].latency for s in sentences)
+                    total = perf_counter() - start
+                    print(f'hedge: {label:<8} p50 {latencies[len(latencies) // 2] * 1000:7.1f}ms  '
+                          f'p99 {latencies[len(latencies) * 99 // 100] * 1000:7.1f}ms  total {total:6.2f}s  '
+                          f'{api.hedge_stats}')
+
+
+def long_reply(replies: Dict[str, str], copies: int) -> str:
+    """
+    Make up the reply to a very long utterance, by putting copies of the descriptions of every recorded reply into
+    one document. Component IDs are renamed to keep them unique.
+    :param replies: Recorded replies.
+    :param copies: Copies of every reply to make.
+    :return: The reply XML.
+    """
+    first = next(iter(replies.values()))
+    head, tail = first[:first.index('<rdf:Description')], first[first.rindex('</rdf:Description>') + 18:]
+    descriptions = []
+    for k in range(copies):
+        for i, xml_str in enumerate(replies.values()):
+            body = xml_str[xml_str.index('<rdf:Description'):xml_str.rindex('</rdf:Description>') + 18]
+            descriptions.append(re.sub(r'(rdf:ID="|rdf:resource="#)(\w+)"', rf'\1C{k}R{i}_\2"', body))
+    return head.replace('root="#', 'root="#C0R0_') + '\n'.join(descriptions) + tail
+
+
+def bench_stream(replies: Dict[str, str]):
+    """
+    Against a local replay sending replies at 1 MiB/s, compare building the LF of a long reply once it is complete
+    with building it while the reply streams in.
+    :param replies: Recorded replies.
+    """
+    sentence, xml_str = 'A very long utterance', long_reply(replies, 20)
+    with TemporaryDirectory() as tmp:
+        cassette = Cassette(tmp)
+        cassette.record(sentence, xml_str)
+
+        with ReplayServer(cassette, bandwidth=1024 * 1024) as replay, TripsAPI(replay.url, stream=False) as whole, \
+                TripsAPI(replay.url) as streamed:
+            report(f'parse: streamed ({len(xml_str) // 1024} KiB)',
+                   best_time(lambda: whole.parse(sentence), 1), best_time(lambda: streamed.parse(sentence), 1))
+
+def bench_fast_path(replies: Dict[str, str]):
+    """
+    Against a local replay without added latency, compare parsing and matching the sentences a library recognizes
+    with recognizing them from their text once their matches have been learned.
+    :param replies: Recorded replies.
+    """
+    sentences = list(replies.keys())
+    with TemporaryDirectory() as tmp:
+        cassette = Cassette(tmp)
+        for sentence, xml_str in replies.items():
+            cassette.record(sentence, xml_str)
+
+        with ReplayServer(cassette) as replay, TripsAPI(replay.url) as api:
+            for library in sorted(listdir(LIBRARIES)):
+                name, ext = splitext(library)
+                if ext != '.xml':
+                    continue
+                tm = TemplateManager(join(LIBRARIES, library))
+                for sentence in sentences:
+                    tm.learn(sentence, tm.match(api.parse(sentence)))
+                known = [s for s in sentences if tm.match_text(s) is not None]
+                if not known:
+                    continue
+                report(f'fast path: {name} ({len(known)})',
+                       best_time(lambda: [tm.match(api.parse(s)) for s in known], 10),
+                       best_time(lambda: [tm.match_text(s) or tm.match(api.parse(s)) for s in known], 10))
+
+
+BENCHMARKS = {
+    'xml': bench_xml,
+    'flat': bench_flat,
+    'batch': bench_batch,
+    'surface': bench_surface,
+    'prune': bench_prune,
+    'compiled': bench_compiled,
+    'group': bench_group,
+    'bindings': bench_bindings,
+    'ranked': bench_ranked,
+    'dump': bench_dump,
+    'library': bench_library,
+    'parse': bench_parse,
+    'hedge': bench_hedge,
+    'stream': bench_stream,
+    'fast_path': bench_fast_path,
+}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("benchmarks", nargs='*',
+                            help=f"Benchmarks to run, out of: {', '.join(BENCHMARKS.keys())}. Runs all by default.")
+    arg_parser.add_argument("-c", "--cassette", type=str, default=DEFAULT_CASSETTE,
+                            help="A directory of recorded TRIPS replies.")
+    args = arg_parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            print(f'Error: Unknown benchmark {name}')
+            exit(1)
+
+    corpus = load_cassette(abspath(args.cassette))
+    for name in args.benchmarks or BENCHMARKS.keys():
+        BENCHMARKS[name](corpus)
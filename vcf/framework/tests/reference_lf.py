@@ -0,0 +1,275 @@
+"""
+The original, recursive implementations of parts of LogicalForm. The tests check the current implementations against
+them, and the benchmarks measure what replacing them gained.
+"""
+
+from typing import *
+from bs4 import BeautifulSoup, NavigableString
+
+from framework.semantic_tools.logical_form import LogicalForm
+
+Component = LogicalForm.Component
+
+
+def compare(this, other) -> Tuple[bool, Dict[str, str], Dict[str, str]]:
+    """
+    The original recursive LF comparison, which LogicalForm._compare has to agree with.
+    Parameters will be extracted from 'this' using the mappings of 'other'
+    :param this: Compared instance.
+    :param other: Instance compared to.
+    :return: Tuple[Match success/failure, bound params, bound groups]
+    """
+    # this and other are expected to be Components at the same level of the tree.
+    # Components match if all the following are true:
+    # 1) There is overlap between indicator sets
+    # 2) There is overlap between type sets
+    # 3) There is overlap between word sets
+    # 4) There is an exact match within a rolegroup by name
+    # 5) There is matching overlap between child components within the matched rolegroup.
+
+    # A role parsed form XML might be a simple string.
+    # An equivalent element parsed from a template is a component, since there could be multiple string options
+    if isinstance(this, str):
+        match = this in other.word
+        return match, {p_name: this for p_name in other.param_mapping.keys()}, {}
+
+    # Lists share a common element if their intersection iss a nonempty set.
+    lst_common = lambda lst_t: bool(set(lst_t[0]).intersection(set(lst_t[1])))
+
+    # Indicators match if any of them are wildcards (empty lists) or if the intersection of sets is nonempty
+    match = not (this.indicator and other.indicator) or lst_common((this.indicator, other.indicator))
+    # Same for types
+    match = match and (not (this.comp_type and other.comp_type) or lst_common((this.comp_type, other.comp_type)))
+    # Same for words
+    match = match and (not (this.word and other.word) or lst_common((this.word, other.word)))
+
+    if not match:
+        # No surface-level match means no need to recurse further.
+        # Also no need to return any parameters from this branch.
+        return False, {}, {}
+
+    # If the template specifies a group at this component, gather all explicit words from the sentence subtree.
+    group_data = {}
+    extractor = lambda cmp: cmp if isinstance(cmp, str) else (None if not cmp.word else cmp.word[0])
+    if other.group:
+        group_list = [extractor(cmp) for cmp in LogicalForm._iterate(this, forward=True)]
+        group_str = ' '.join(list(filter(lambda x: x is not None, group_list)))
+        group_data[other.group] = group_str
+
+    # If the components match and the template one is marked 'fuzzy', then everything nested under this component
+    # is to be accepted 'as-is'.
+    if other.fuzzy:
+        # Return only the parameters bound by this component, if applicable.
+        # Since there can be no structure below, no bindings could be made.
+        binding = {} if not this.word else {k: this.word[0] for k in other.param_mapping.keys()}
+        groups = {} if not other.group else group_data
+        return True, binding, groups
+
+    # TODO: Do we need a warning if there were multiple candidate words? Shouldn't be possible.
+    # Map the word value stored in this component to parameter names specified by the template.
+    mapped_val = this.word[0] if this.word else None
+    param_map = {k: mapped_val for k in other.param_mapping.keys()}
+
+    # Find all the rolegroups that match between this and other.
+    check_q = []
+    for rg in this.roles:
+        for rg_other in other.roles:
+            command_roles = set(rg.keys())
+            template_roles = set(rg_other.keys())
+
+            # The roles of the template must be a subset of the roles of the command.
+            # i.e. If the command has roles A, B, and C, and the template has role B, then the template matches.
+            # However, template with B and D is NOT a match to command A, B, C
+            if all(r in command_roles for r in template_roles):
+                # The rolegroups match roles
+                check_q.append((rg, rg_other))
+
+    # For each pair of matching rolegroups, recurse on all corresponding components.
+    # At least one rolegroup has to match in order for the whole template to match.
+    param_set = {}
+    group_set = {}
+    one_rg_match = False
+    for this_rg, other_rg in check_q:
+
+        # Every role must fully match within a rolegroup
+        all_match = True
+        rg_set = {}  # set of parameters from this set of roles
+        rg_groups = {}  # Set of groups from this set of roles
+        for name in this_rg.keys():
+            # Since this RG has been established as a superset of other RG, there may be roles not present
+            # in other. That simply means that the role is a match and no parameters are bound.
+            if name not in other_rg:
+                continue
+
+            to_match = this_rg[name][0]  # This is the component the template needs to match.
+            candidates = other_rg[name]  # This is the candidate components
+
+            # Recurse on all options from the template. At least one must match.
+            results = map(lambda x: compare(to_match, x), candidates)
+            results = list(filter(lambda x: x[0], results))
+            if not results:
+                all_match = False
+                break
+            for k, v in results[0][1].items():
+                if k not in rg_set:
+                    rg_set[k] = v
+            for k, v in results[0][2].items():
+                if k not in rg_groups:
+                    rg_groups[k] = v
+
+        # Stop comparing if we found a matching rolegroup.
+        if all_match:
+            one_rg_match = True
+            param_set = rg_set
+            group_set = rg_groups
+            break
+
+    # Not a single rolegroup matched from the template.
+    # This component is not a match
+    if not one_rg_match:
+        return False, {}, {}
+
+    # At least one rolegroup matched.
+    # Add the parameters extracted from the matched rolegroup to the set.
+    for k, v in param_set.items():
+        if k not in param_map:
+            param_map[k] = v
+
+    # Add the groups extracted from the matched rolegroup to the set.
+    for k, v in group_set.items():
+        if k not in group_data:
+            group_data[k] = v
+
+    return True, param_map, group_data
+
+
+def pretty_format_concat(lf: LogicalForm) -> str:
+    """
+    The original recursive pretty_format, which builds the result by string concatenation.
+    :param lf: A LogicalForm.
+    :return: What LogicalForm.pretty_format has to give.
+    """
+    return _format_component(lf._root, 0, set(), lf.from_xml)
+
+
+def _format_role(role: Tuple[str, List[Union[Component, str]]], depth: int, seen: Set[Component],
+                 back_refs: bool) -> str:
+    """
+    A helper function for pretty_format, mutually recursive with _format_component.
+    :param role: The role tuple being formatted.
+    :param depth: Nested depth level.
+    :param seen: Set of seen Components used to break potential infinite loops.
+    :param back_refs: See _format_component.
+    :return: String representation of the role.
+    """
+    role_name, role_comps = role
+    result = ('|  ' * depth) + f'<role {role_name}>\n'
+    for c in role_comps:
+        # Display all of the role's components
+        if isinstance(c, str):
+            result += ('|  ' * (depth + 1)) + c + '\n'
+        else:
+            result += _format_component(c, depth + 1, seen, back_refs)
+
+    return result
+
+
+def _format_component(comp: Component, depth: int, seen: Set[Component], back_refs: bool) -> str:
+    """
+    A helper function for pretty_format, mutually recursive with _format_role.
+    :param comp: The component being formatted.
+    :param depth: Nested depth level.
+    :param seen: Set of seen Components used to break potential infinite loops.
+    :param back_refs: Whether the component is part of a sentence. Seen sentence components are shown as a
+        reference to their ID. For templates, seen only holds the components on the path from the root, so
+        components shared by several branches are shown in full under each of them.
+    :return: String representation of the component.
+    """
+    if comp in seen:
+        return ('|  ' * depth) + f'<ref {comp.comp_id}>\n' if back_refs else ''
+
+    # First, get the base of the component.
+    result = ('|  ' * depth) + str(comp) + '\n'
+    seen.add(comp)
+    # Special case for 'closed' components with no child roles.
+    if len(comp.roles) == 1 and not comp.roles[0]:
+        if not back_refs:
+            seen.discard(comp)
+        return result
+
+    for rg in comp.roles:
+        # Mark the beginning of a rolegroup
+        result += ('|  ' * (depth + 1)) + '<rolegroup>\n'
+        # Now show all the roles.
+        for rtup in rg.items():
+            result += _format_role(rtup, depth + 2, seen, back_refs)
+
+        # Mark the end of a rolegroup
+        result += ('|  ' * (depth + 1)) + '</rolegroup>\n'
+    if not back_refs:
+        seen.discard(comp)
+
+    return result
+
+
+def process_xml_soup(xml_string) -> Component:
+    """
+    Convert an XML string to a Logical Form by building a complete BeautifulSoup tree of it.
+    This is the original reader, which LogicalForm._process_xml has to agree with.
+    :param xml_string: The LF encoded string.
+    :return: A root component of the hierarchy.
+    """
+    bs = BeautifulSoup(xml_string, 'xml')
+    components = {}  # type: Dict[str, Component]
+
+    comp_data = bs.findAll('rdf:Description')
+
+    # First, we need to build up a set of standalone elements with pending ID references.
+    # Then, a second pass "marries" the elements into a tree.
+    root_id = comp_data[0]['rdf:ID']
+
+    # For each component, extract its indicator, type, and -- if applicable -- word and roles.
+    for tags in comp_data:
+        component = Component(tags['rdf:ID'])
+        for c in tags.children:
+            # Skip meaningless entries.
+            if isinstance(c, NavigableString):
+                continue
+            if c.name == 'indicator':
+                component.indicator.append(c.text)
+            elif c.name == 'type':
+                component.comp_type.append(c.text)
+            elif c.name == 'word':
+                if component.word is None:
+                    component.word = [c.text]
+                else:
+                    component.word.append(c.text)
+            elif c.prefix == 'role':
+                # Initialize the list if necessary
+                if c.name not in component.roles[0]:
+                    component.roles[0][c.name] = []
+
+                if 'rdf:resource' in c.attrs:
+                    role_comp_id = c['rdf:resource']  # Skip the 'V' prefix if needed
+                    # Wrap in a list to allow isinstance() differentiation
+                    component.roles[0][c.name].append([role_comp_id])
+                else:
+                    # Some roles are basic strings and can be resolved on first pass.
+                    component.roles[0][c.name].append(c.text)
+        components[component.comp_id] = component
+
+    # All components have been processed. Now, they need to be connected into a tree.
+    for comp in components.values():
+        for rname, rval in comp.roles[0].items():
+            # Only resolve the roles that were left as references.
+            resolved_targets = []
+            for r_target in rval:
+                if isinstance(r_target, list):
+                    resolved_targets.append(components[r_target[0][1:]])
+                else:
+                    resolved_targets.append(r_target)
+            comp.roles[0][rname] = resolved_targets
+
+    # All components are now connected into a tree structure in memory.
+    # Returning a reference to the root component therefore extracts the whole structure.
+    return components[root_id]
@@ -7,15 +7,29 @@ A suite of unit tests for the TemplateManager class.
 
 
 import argparse
+import re
 from typing import *
 from os import listdir, chdir
-from os.path import isdir, splitext, isfile, join
+from os.path import isdir, splitext, isfile, join, abspath, dirname, basename
 from math import floor
 from enum import Enum
 from json import loads
+from io import StringIO
+from copy import copy
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
 
 from framework.semantic_tools.template_manager import TemplateManager
-from framework.semantic_tools.lf_parser import TripsAPI
+from framework.semantic_tools.phrase_index import PhraseIndex
+from framework.semantic_tools.lf_parser import TripsAPI, _HedgePolicy, HEDGE_WINDOW, HEDGE_MIN_SAMPLES
+from framework.semantic_tools.parse_cache import ParseCache
+from framework.semantic_tools.trips_cassette import Cassette, ReplayServer, load_cassette
+from framework.semantic_tools.logical_form import LogicalForm, MatchMemo
+from framework.semantic_tools.flat_form import FlatLogicalForm, read_container
+from framework.semantic_tools.matcher_codegen import DIGEST_SUFFIX
+from framework.semantic_tools.serialization import write_lf_json, read_lf_json, write_library_json, \
+    write_library_binary
+from reference_lf import compare, pretty_format_concat, process_xml_soup
 
 
 class TestMode(Enum):
@@ -23,7 +37,9 @@ class TestMode(Enum):
     An enumeration for the different kinds of test modes.
     """
     PARSE = 'PARSE',
-    MATCH = 'MATCH'
+    MATCH = 'MATCH',
+    FORMAT = 'FORMAT',
+    RECORDED = 'RECORDED'
 
 
 XML = '.xml'
@@ -32,6 +48,8 @@ DIR = ''
 
 TAB_COL = 12
 
+DEFAULT_CASSETTE = join(dirname(abspath(__file__)), 'trips_cassette')
+
 
 def run_parse_test(source: str, exp_out: str, exp_error: bool = False) -> Tuple[bool, str, str]:
     """
@@ -128,7 +146,7 @@ def run_parse_tests():
         exit(1)
 
     # Switch directory for easy file lookup
-    chdir('.\\' + args.test_data)
+    chdir(args.test_data)
 
     # Clear to begin testing
     print('BEGIN TESTING:')
@@ -160,6 +178,16 @@ def run_parse_tests():
     print(f'TESTING COMPLETE! Result: ({test_success}/{test_count}) {proportion:.1f}% correct.')
 
 
+def test_sentence(data: List[str]) -> str:
+    """
+    Get the utterance of a match subtest. Sentences are quoted and padded in the test files, but neither is part of
+    what was said, and the cassette and the expected group spans are recorded for the bare sentence.
+    :param data: A subtest, split at its separators.
+    :return:
+    """
+    return data[1].strip().strip('"')
+
+
 def run_match_tests():
     """
     Perform all the work related to running a TemplateManager matching tests.
@@ -180,10 +208,13 @@ def run_match_tests():
     print('BEGIN TESTING:')
     test_count, test_success = 0, 0
     completed = set()  # type: Set[str]
-    api = TripsAPI()
+    replay = None
+    if args.offline:
+        replay = ReplayServer(abspath(args.cassette)).start()
+    api = TripsAPI(replay.url if replay else None, pool_size=args.concurrency, cache=args.parse_cache)
 
     # Switch directory for easy file lookup
-    chdir('.\\' + libraries)
+    chdir(libraries)
 
     # For each pair of files, create a TemplateManager out of the XML library
     # Then, try to match all provided phrases in a .out file to expected outcomes
@@ -203,51 +234,851 @@ def run_match_tests():
         # Create a manager. Expected to succeed.
         tm = TemplateManager(source)
 
-        # Run all the subtests
+        # Parse the sentences of all the subtests up front, several at a time.
         with open(results, 'r') as rfp:
-            for test in rfp:
-                data = test.strip().split(';')  # [Test expectation, sentence, Optional param dictionary]
-                if len(data) <= 1 or len(data) >= 5:
-                    print(f'\tInvalid test: {data}')
-                    continue
-                print(f'\t{data[1]} \t\t--> ', end='')
+            tests = [test.strip().split(';') for test in rfp]  # [Test expectation, sentence, Optional param dictionary]
+        parsed_all = api.parse_many([test_sentence(data) for data in tests if 1 < len(data) < 5])
+        if parsed_all:
+            print(f'\tParsed {len(parsed_all)} sentences, slowest {max(p.latency for p in parsed_all):.2f}s, '
+                  f'{sum(p.error is not None for p in parsed_all)} failed.')
+        parses = iter(parsed_all)
 
-                result = tm.match(api.parse(data[1]))
+        # Run all the subtests
+        for data in tests:
+            if len(data) <= 1 or len(data) >= 5:
+                print(f'\tInvalid test: {data}')
+                continue
+            print(f'\t"{test_sentence(data)}" \t\t--> ', end='')
 
-                # If we expect no match, i.e. the flag is FALSE, the result must be None
-                if (data[0].upper() == 'FALSE') and (result is None):
+            parsed = next(parses)
+            if parsed.error is not None:
+                print(f'Parse failed after {parsed.latency:.2f}s: {parsed.error}')
+            result = tm.match(parsed.lf)
+
+            # If we expect no match, i.e. the flag is FALSE, the result must be None
+            if (data[0].upper() == 'FALSE') and (result is None):
+                test_success += 1
+                print('Correct')
+            elif data[0].upper() == 'FALSE':
+                print(f'\nEXPECTED:\n NO MATCH\n\nGOT:\n{result}')
+            elif data[0].upper() == 'TRUE' and (result is None):
+                print('\nEXPECTED:\n MATCH\n\nGOT:\nNO MATCH')
+            else:
+                # Expected and got a match. Must validate the argument dictionary if applicable.
+                got_params = result.bound_params
+                exp_params = loads(data[2])
+
+                got_groups = result.groups
+                exp_groups = loads(data[3])
+                if got_params == exp_params and got_groups == exp_groups:
+                    print('Correct.')
                     test_success += 1
-                    print('Correct')
-                elif data[0].upper() == 'FALSE':
-                    print(f'\nEXPECTED:\n NO MATCH\n\nGOT:\n{result}')
-                elif data[0].upper() == 'TRUE' and (result is None):
-                    print('\nEXPECTED:\n MATCH\n\nGOT:\nNO MATCH')
                 else:
-                    # Expected and got a match. Must validate the argument dictionary if applicable.
-                    got_params = result.bound_params
-                    exp_params = loads(data[2])
-
-                    got_groups = result.groups
-                    exp_groups = loads(data[3])
-                    if got_params == exp_params and got_groups == exp_groups:
-                        print('Correct.')
-                        test_success += 1
-                    else:
-                        print(f'\nEXPECTED:\n{exp_params, exp_groups}\nGOT:\n{got_params, got_groups}')
+                    print(f'\nEXPECTED:\n{exp_params, exp_groups}\nGOT:\n{got_params, got_groups}')
 
-                test_count += 1
+            test_count += 1
+
+    api.close()
+    if replay is not None:
+        replay.stop()
     proportion = (test_success / test_count) * 100
     print(f'TESTING COMPLETE! Result: ({test_success}/{test_count}) {proportion:.1f}% correct.')
 
 
+def run_format_tests():
+    """
+    Print the Logical Forms of TRIPS replies and compare them with expected output.
+    :return:
+    """
+    # Test if the provided test files are correct.
+    valid, errors = all_valid(args.test_data)
+    if not valid:
+        print(f'Found {len(errors)} errors with supplied files:')
+        for e in errors:
+            print('\t' + e)
+        exit(1)
+
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for name in sorted({splitext(item)[0] for item in listdir(args.test_data)}):
+        with open(join(args.test_data, name + XML), 'r') as fp:
+            lf = LogicalForm(fp.read())
+        with open(join(args.test_data, name + OUT), 'r') as fp:
+            want = fp.read()
+
+        msg = f'Running test {name} ...'
+        print(msg, '\t' * (TAB_COL - floor(len(msg) / 4)), end='')
+        text = StringIO()
+        lf.write_pretty(text)
+        got = lf.pretty_format()
+        if want == got == text.getvalue() == pretty_format_concat(lf):
+            print('Success.')
+            test_success += 1
+        else:
+            print(f'Failure.\n\nEXPECTED:\n{want}\n\nGOT:\n{got}')
+        test_count += 1
+
+    proportion = (test_success / test_count) * 100
+    print(f'TESTING COMPLETE! Result: ({test_success}/{test_count}) {proportion:.1f}% correct.')
+
+
+def lf_structure(root: LogicalForm.Component) -> List[Tuple]:
+    """
+    Flatten the structure reachable from a component into comparable tuples.
+    :param root: A root component.
+    :return: A list of (ID, indicators, types, words, roles) tuples, where role values are component IDs or strings.
+    """
+    result = []
+    for cmp in LogicalForm._iterate(root):
+        roles = [[(name, [c if isinstance(c, str) else ('#' + c.comp_id) for c in cs]) for name, cs in rg.items()]
+                 for rg in cmp.roles]
+        result.append((cmp.comp_id, cmp.indicator, cmp.comp_type, cmp.word, roles))
+    return result
+
+
+def lf_spans(lf: LogicalForm) -> Tuple[Optional[str], List[Tuple[str, Optional[int], Optional[int]]]]:
+    """
+    :param lf: A sentence LogicalForm.
+    :return: The utterance and the (ID, start, end) span of every component.
+    """
+    return lf.text, [(cmp.comp_id, cmp.start, cmp.end) for cmp in LogicalForm._iterate(lf._root)]
+
+
+def report(test_count: int, test_success: int) -> Tuple[int, int]:
+    """
+    Print the outcome of a test mode.
+    :param test_count: Number of tests run.
+    :param test_success: Number of tests passed.
+    :return: The two counts, so that runs of several modes can be totalled.
+    """
+    proportion = (test_success / test_count) * 100 if test_count else 100.0
+    print(f'TESTING COMPLETE! Result: ({test_success}/{test_count}) {proportion:.1f}% correct.')
+    return test_count, test_success
+
+
+def library_files() -> List[str]:
+    """
+    :return: Paths to the template libraries of the test directory.
+    """
+    return [join(args.test_data, file) for file in sorted(listdir(args.test_data)) if splitext(file)[1] != OUT]
+
+
+def run_reader_tests() -> Tuple[int, int]:
+    """
+    Check the streaming TRIPS reply reader against the original BeautifulSoup one on every recorded reply.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for sentence, xml_str in replies.items():
+        want = lf_structure(process_xml_soup(xml_str))
+        got = lf_structure(LogicalForm._process_xml(xml_str))
+
+        test_count += 1
+        if want == got:
+            test_success += 1
+        else:
+            print(f'\t{sentence}\nEXPECTED:\n{want}\nGOT:\n{got}')
+
+    return report(test_count, test_success)
+
+
+def run_fingerprint_tests() -> Tuple[int, int]:
+    """
+    Check that LF fingerprints ignore component IDs and tell apart every recorded reply.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    fingerprints = {}  # type: Dict[str, str]
+    for sentence, xml_str in replies.items():
+        # Renaming every component must not change the fingerprint, but any other difference must.
+        lf = LogicalForm(xml_str)
+        renamed = LogicalForm(re.sub(r'"(#?)V(\d+)"', r'"\1X\2"', xml_str))
+
+        test_count += 1
+        if lf.same_structure(renamed) and lf.fingerprint not in fingerprints:
+            test_success += 1
+        else:
+            print(f'\t{sentence}\nFingerprint {lf.fingerprint} vs {renamed.fingerprint}, '
+                  f'also used by: {fingerprints.get(lf.fingerprint)}')
+        fingerprints[lf.fingerprint] = sentence
+
+    return report(test_count, test_success)
+
+
+def run_flat_tests() -> Tuple[int, int]:
+    """
+    Check that every recorded reply survives conversion to and from a FlatLogicalForm.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    with TemporaryDirectory() as tmp:
+        for i, (sentence, xml_str) in enumerate(replies.items()):
+            # Built straight from XML, from a LogicalForm, and loaded back from a file, the flat form must convert
+            # back to the same structure.
+            lf = LogicalForm(xml_str)
+            path = join(tmp, f'{i}.flat')
+            with open(path, 'wb') as fp:
+                FlatLogicalForm.from_xml(xml_str).save(fp)
+
+            want = (lf_structure(lf._root), lf.fingerprint, lf_spans(lf))
+            for flat in (FlatLogicalForm.from_xml(xml_str), FlatLogicalForm.from_logical_form(lf),
+                         FlatLogicalForm.load(path)):
+                got_lf = flat.to_logical_form()
+                got = (lf_structure(got_lf._root), got_lf.fingerprint, lf_spans(got_lf))
+
+                test_count += 1
+                if want == got:
+                    test_success += 1
+                else:
+                    print(f'\t{sentence}\nEXPECTED:\n{want}\nGOT:\n{got}')
+
+    return report(test_count, test_success)
+
+
+def run_serialization_tests() -> Tuple[int, int]:
+    """
+    Check the streamed text dump and the JSON form of every recorded reply.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for sentence, xml_str in replies.items():
+        # The streamed text dump must be the same as the original one, and JSON must round trip.
+        lf = LogicalForm(xml_str)
+        text = StringIO()
+        lf.write_pretty(text)
+        json_text = StringIO()
+        write_lf_json(lf, json_text)
+        json_text.seek(0)
+        got_lf = read_lf_json(json_text)
+
+        test_count += 1
+        want = (pretty_format_concat(lf), lf_structure(lf._root), lf.fingerprint, lf_spans(lf))
+        got = (text.getvalue(), lf_structure(got_lf._root), got_lf.fingerprint, lf_spans(got_lf))
+        if want == got and lf.pretty_format() == want[0]:
+            test_success += 1
+        else:
+            print(f'\t{sentence}\nEXPECTED:\n{want}\nGOT:\n{got}')
+
+    return report(test_count, test_success)
+
+
+def run_cache_tests() -> Tuple[int, int]:
+    """
+    Check lookups, eviction, and expiry of the TRIPS parse cache.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    with TemporaryDirectory() as tmp:
+        # Replies come back from a reopened cache, under any spacing of the sentence, and only for their endpoint.
+        with ParseCache(join(tmp, 'cache.sqlite3')) as cache:
+            for sentence, xml_str in replies.items():
+                cache.put(sentence, 'a', xml_str)
+        with ParseCache(join(tmp, 'cache.sqlite3')) as cache:
+            for sentence, xml_str in replies.items():
+                got = cache.get(f'  {sentence.replace(" ", "   ")} ', 'a')
+                test_count += 1
+                if got == xml_str and cache.get(sentence, 'b') is None:
+                    test_success += 1
+                else:
+                    print(f'\tParse cache <- {sentence}\nEXPECTED:\n{xml_str}\nGOT:\n{got}')
+
+    # The least recently used replies are evicted first, and old ones expire. Every reading of the clock is a second
+    # later than the last one, so no two replies are ever used at the same time.
+    sentences, now = list(replies.keys()), [0.0]
+
+    def tick() -> float:
+        now[0] += 1
+        return now[0]
+
+    with ParseCache(':memory:', max_entries=3, max_age=60, clock=tick, evict_every=1) as cache:
+        for sentence in sentences[:3]:
+            cache.put(sentence, 'a', replies[sentence])
+        cache.get(sentences[0], 'a')
+        cache.put(sentences[3], 'a', replies[sentences[3]])
+        kept = [cache.get(sentence, 'a') is not None for sentence in sentences[:4]]
+        now[0] += 60
+        expired = cache.get(sentences[0], 'a')
+        purged = cache.purge()
+
+        test_count += 1
+        if kept == [True, False, True, True] and expired is None and purged == 3 and not len(cache):
+            test_success += 1
+        else:
+            print(f'\tParse cache eviction: kept {kept}, expired {expired is None}, purged {purged}')
+
+    # A reply that is not a Logical Form, e.g. a page from an overloaded proxy, is neither cached nor recorded, whether
+    # it is streamed or not.
+    with TemporaryDirectory() as served, TemporaryDirectory() as recorded:
+        busy = Cassette(served)
+        busy.record(sentences[0], '<html>Service busy</html>')
+        with ReplayServer(busy) as replay:
+            for stream in (True, False):
+                with ParseCache(':memory:') as cache, \
+                        TripsAPI(replay.url, retries=0, cache=cache, record=recorded, stream=stream) as api:
+                    try:
+                        api.parse(sentences[0])
+                        error = None
+                    except ValueError as e:
+                        error = e
+                    kept = cache.get(sentences[0], replay.url)
+
+                test_count += 1
+                if error is not None and kept is None and not load_cassette(recorded):
+                    test_success += 1
+                else:
+                    print(f'\tNon-LF reply, streamed {stream}: raised {error}, cached {kept}')
+
+    return report(test_count, test_success)
+
+
+def run_replay_tests() -> Tuple[int, int]:
+    """
+    Check that the local stand-in for the TRIPS parser replays the cassette, and that replies can be recorded.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    with ReplayServer(Cassette(abspath(args.cassette))) as replay, TemporaryDirectory() as tmp:
+        # Parsing through the stand-in gives the recorded replies, and recording them again gives the same cassette.
+        sentences = list(replies.keys())
+        with TripsAPI(replay.url, retries=0, record=tmp) as api:
+            parsed = api.parse_many(sentences + ['A sentence nobody recorded'])
+        recorded = load_cassette(tmp)
+
+        for sentence, result in zip(sentences, parsed):
+            test_count += 1
+            if result.error is None and result.lf.fingerprint == LogicalForm(replies[sentence]).fingerprint and \
+                    recorded.get(sentence) == replies[sentence]:
+                test_success += 1
+            else:
+                print(f'\tReplay <- {sentence}\nGOT:\n{result}\nRECORDED:\n{recorded.get(sentence)}')
+
+        test_count += 1
+        if parsed[-1].error is not None and parsed[-1].lf._root is None and len(recorded) == len(sentences) and \
+                (replay.served, replay.missed) == (len(sentences), 1):
+            test_success += 1
+        else:
+            print(f'\tReplay of an unknown sentence: {parsed[-1]}, served {replay.served}, missed {replay.missed}')
+
+    # A reply that is not a Logical Form fails its own parse only.
+    with TemporaryDirectory() as tmp:
+        cassette = Cassette(tmp)
+        cassette.record(sentences[0], '<html>Service busy</html>')
+        cassette.record(sentences[1], replies[sentences[1]])
+        with ReplayServer(cassette) as replay, TripsAPI(replay.url, retries=0) as api:
+            parsed = api.parse_many(sentences[:2])
+
+        test_count += 1
+        if parsed[0].error is not None and parsed[0].lf._root is None and parsed[1].error is None and \
+                parsed[1].lf.fingerprint == LogicalForm(replies[sentences[1]]).fingerprint:
+            test_success += 1
+        else:
+            print(f'\tReplay of a reply that is not an LF: {parsed}')
+
+    return report(test_count, test_success)
+
+
+def run_hedge_tests() -> Tuple[int, int]:
+    """
+    Check that slow TRIPS requests are hedged against the secondary endpoint.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    # The hedge delay is a percentile of the recent latencies, measured by the clock of the policy, and is only
+    # known once there are enough of them.
+    now = [0.0]
+    policy = _HedgePolicy(90, 0.1, clock=lambda: now[0])
+    delays = []
+    for latency in range(1, HEDGE_MIN_SAMPLES + 1):
+        delays.append(policy.delay())
+        started = policy.clock()
+        now[0] += latency
+        policy.observe(started)
+    test_count += 1
+    if delays == [None] * HEDGE_MIN_SAMPLES and policy.delay() == sorted(range(1, HEDGE_MIN_SAMPLES + 1))[
+            int(HEDGE_MIN_SAMPLES * 0.9)]:
+        test_success += 1
+    else:
+        print(f'\tHedge delays: {delays}, then {policy.delay()}')
+
+    # Late requests are hedged until the rate is used up, and requests on time never are.
+    on_time = policy.decide(False)
+    hedges = [policy.decide(True) for _ in range(HEDGE_WINDOW)]
+    allowed = int(0.1 * HEDGE_WINDOW)
+    test_count += 1
+    if not on_time and hedges == [True] * allowed + [False] * (HEDGE_WINDOW - allowed) and policy.hedged == allowed:
+        test_success += 1
+    else:
+        print(f'\tHedge decisions: on time {on_time}, late {hedges}, hedged {policy.hedged}')
+
+    # Wins may be recorded by any number of threads at once.
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: policy.record_win(), range(1000)))
+    test_count += 1
+    if policy.won == 1000:
+        test_success += 1
+    else:
+        print(f'\tHedge wins: {policy.won}')
+
+    with ReplayServer(Cassette(abspath(args.cassette))) as primary, \
+            ReplayServer(Cassette(abspath(args.cassette))) as secondary:
+        # Latencies are learned while the primary is fast. Once it slows down, a late request is answered by the
+        # secondary, unless no requests may be hedged at all. Which reply came first shows in the counters, so
+        # nothing here depends on how long the requests took.
+        sentence = next(iter(replies.keys()))
+        for rate in (1.0, 0.0):
+            primary.latency, served = 0.0, secondary.served
+            with TripsAPI(primary.url, retries=0, hedge_percentile=50, hedge_url=secondary.url, hedge_rate=rate) as api:
+                for _ in range(20):
+                    api.parse(sentence)
+                primary.latency = 0.5
+                parsed = api.parse_many([sentence])[0]
+                stats = api.hedge_stats
+
+            test_count += 1
+            if parsed.error is None and parsed.lf.fingerprint == LogicalForm(replies[sentence]).fingerprint and \
+                    (stats['hedged'], stats['won'], secondary.served - served) == ((1, 1, 1) if rate else (0, 0, 0)):
+                test_success += 1
+            else:
+                print(f'\tHedge at rate {rate}: {parsed}, {stats}, secondary served {secondary.served - served}')
+
+        # Parsing more sentences than the pool holds leaves the pools in place for the parses using them.
+        primary.latency = 0.0
+        with TripsAPI(primary.url, retries=0, pool_size=2, hedge_percentile=50) as api:
+            pool = api._hedge_pool
+            parsed_all = api.parse_many([sentence] * 4)
+        test_count += 1
+        if api._hedge_pool is pool and api.pool_size == 2 and all(p.error is None for p in parsed_all):
+            test_success += 1
+        else:
+            print(f'\tParsing past the pool size: {parsed_all}, pool size {api.pool_size}')
+
+    return report(test_count, test_success)
+
+
+def run_coalesce_tests() -> Tuple[int, int]:
+    """
+    Check that concurrent parses of the same sentence share one TRIPS request.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    with ReplayServer(Cassette(abspath(args.cassette)), latency=0.2) as replay:
+        # Parses of a sentence that is already being parsed share its request, and its failure.
+        sentence = next(iter(replies.keys()))
+        for coalesce in (True, False):
+            for text in (sentence, 'A sentence nobody recorded'):
+                served, missed = replay.served, replay.missed
+                with TripsAPI(replay.url, retries=0, pool_size=8, coalesce=coalesce) as api:
+                    parsed = api.parse_many([text] * 8)
+                    stats = api.coalesce_stats
+                requests_sent = replay.served - served + replay.missed - missed
+                known = text in replies
+
+                test_count += 1
+                correct = all((r.error is None and r.lf.fingerprint == LogicalForm(replies[text]).fingerprint)
+                              if known else (r.error is not None and r.lf._root is None) for r in parsed)
+                if correct and requests_sent == (1 if coalesce else 8) and \
+                        (stats['calls'], stats['coalesced']) == ((1, 7) if coalesce else (0, 0)):
+                    test_success += 1
+                else:
+                    print(f'\tCoalesce {coalesce} <- {text}: {requests_sent} requests, {stats}, {parsed}')
+
+    return report(test_count, test_success)
+
+
+def run_stream_tests() -> Tuple[int, int]:
+    """
+    Check that TRIPS replies read in pieces give the same LFs as whole replies.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    with ReplayServer(Cassette(abspath(args.cassette)), bandwidth=200000) as replay, TemporaryDirectory() as tmp:
+        # A reply read in pieces, even ones that split a character, gives the same LF as the whole reply, and a
+        # streamed reply is kept exactly as received.
+        with TripsAPI(replay.url, retries=0, record=tmp) as api:
+            streamed = api.parse_many(list(replies.keys()))
+        recorded = load_cassette(tmp)
+
+        for (sentence, xml_str), result in zip(replies.items(), streamed):
+            whole = LogicalForm(xml_str)
+            data = xml_str.encode('utf-8')
+            pieces = LogicalForm.from_chunks(data[i:i + 7] for i in range(0, len(data), 7))
+
+            test_count += 1
+            if all(lf.fingerprint == whole.fingerprint and lf_spans(lf) == lf_spans(whole) and
+                   lf_structure(lf._root) == lf_structure(whole._root) for lf in (pieces, result.lf)) and \
+                    recorded.get(sentence) == xml_str:
+                test_success += 1
+            else:
+                print(f'\tStream <- {sentence}\nWHOLE:\n{whole.pretty_format()}\nPIECES:\n{pieces.pretty_format()}\n'
+                      f'STREAMED:\n{result}')
+
+    return report(test_count, test_success)
+
+
+def run_library_tests() -> Tuple[int, int]:
+    """
+    Check the flat, dumped, JSON, and binary forms of every template library in the test directory, and that a library
+    loaded from its binary form behaves exactly like the original.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    lfs = [LogicalForm(xml_str) for xml_str in replies.values()]
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for file in library_files():
+        print(f'Running test group {splitext(basename(file))[0]}:')
+        tm = TemplateManager(file)
+        flat, names = tm.compile_flat()
+        templates = [(command.name, t) for command in tm for t in command.template]
+        for (name, template), flat_name, flat_root in zip(templates, names, flat.to_components()):
+            test_count += 1
+            if name == flat_name and template._root.same_structure(flat_root):
+                test_success += 1
+            else:
+                print(f'\tCompiled {flat_name} differs from {name}:\n{template.pretty_format()}')
+
+        # Streamed dumps must match the original formatting, and the JSON and binary forms must describe the same
+        # commands and shared components as the flat library.
+        text, json_text = StringIO(), StringIO()
+        tm.write_dump(text)
+        write_library_json(tm, json_text)
+        library = loads(json_text.getvalue())
+
+        # A library loaded from its binary form must dump and match exactly like the original.
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'library.flat')
+            with open(path, 'wb') as fp:
+                write_library_binary(tm, fp)
+            header, _, arrays = read_container(path, mmap=False)
+            loaded = TemplateManager.load_compiled(path)
+            matches_loaded = all(tm._match_template(t, lf, MatchMemo(tm._symbols)) ==
+                                 loaded._match_template(t, lf, MatchMemo(loaded._symbols))
+                                 for lf in lfs for t in range(len(tm._templates)))
+            dump_loaded = loaded.dump()
+            batch_loaded = [None if c is None else (c.name, c.bound_params, c.groups)
+                            for c in loaded.match_batch(lfs)]
+            prune_loaded = [loaded.prune(lf).fingerprint for lf in lfs]
+            del loaded
+
+        test_count += 1
+        if text.getvalue() == tm.dump() and \
+                all(t.pretty_format() == pretty_format_concat(t) for _, t in templates) and \
+                [c['name'] for c in library['commands'] for _ in c['roots']] == names and \
+                len(library['components']) == flat.node_count and \
+                header['commands'] == [[command.name, len(command.template)] for command in tm] and \
+                all((arrays[k] == v).all() for k, v in flat.arrays.items()):
+            test_success += 1
+        else:
+            print(f'\tSerialized forms of {file} differ.')
+
+        test_count += 1
+        want_batch = [None if c is None else (c.name, c.bound_params, c.groups) for c in map(tm.match, lfs)]
+        if matches_loaded and dump_loaded == tm.dump() and batch_loaded == want_batch and \
+                prune_loaded == [tm.prune(lf).fingerprint for lf in lfs]:
+            test_success += 1
+        else:
+            print(f'\tCompiled library {file} differs:\n{dump_loaded}\n{batch_loaded}\n{want_batch}')
+
+    return report(test_count, test_success)
+
+
+def run_fast_path_tests() -> Tuple[int, int]:
+    """
+    Check the example utterances of every template library in the test directory, and the recognition of utterances
+    from their text alone.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for file in library_files():
+        print(f'Running test group {splitext(basename(file))[0]}:')
+        tm = TemplateManager(file)
+        lfs = {sentence: LogicalForm(xml_str) for sentence, xml_str in replies.items()}
+        json_text = StringIO()
+        write_library_json(tm, json_text)
+        library = loads(json_text.getvalue())
+
+        # Every recorded example utterance must match its own command.
+        for command in tm:
+            for example in command.examples:
+                matched = tm.match(lfs[example]) if example in lfs else None
+
+                test_count += 1
+                if matched is not None and matched.name == command.name and \
+                        [c.get('examples', []) for c in library['commands']] == [c.examples for c in tm]:
+                    test_success += 1
+                else:
+                    print(f'\tExample "{example}" of {command.name} matched {matched}')
+
+        # The examples of fixed commands are only recognized from their text alone on request until they are parsed.
+        # Once learned, every sentence whose match binds no groups is recognized as exactly what its LF matches, and
+        # no other sentence is recognized.
+        claimed = {e: (c.name, {}) for c in tm if c.fixed for e in c.examples}
+        recognized = {s: tm.match_text(s, claimed=True) for s in lfs}
+        before = {s: (c.name, c.bound_params) for s, c in recognized.items() if c is not None}
+        unconfirmed = [s for s in lfs if tm.match_text(s) is not None]
+        for sentence, lf in lfs.items():
+            tm.learn(sentence, tm.match(lf))
+        want, got = {}, {}
+        for sentence, lf in lfs.items():
+            matched, known = tm.match(lf), tm.match_text(sentence)
+            if matched is not None and not matched.groups:
+                want[sentence] = (matched.name, matched.bound_params)
+            if known is not None:
+                got[sentence] = (known.name, known.bound_params)
+        tm.learn('Some sentence', next(iter(tm)))
+        tm.learn('Some  sentence', None)
+        # A match that bound groups is not an outcome of the utterance alone, so it is not learned at all.
+        grouped, known = copy(next(iter(tm))), len(tm._phrases)
+        grouped.groups = {'what': 'something'}
+        tm.learn('A grouped sentence', grouped)
+
+        test_count += 1
+        if before == {s: o for s, o in claimed.items() if s in lfs} and not unconfirmed and got == want and \
+                tm.match_text('Some sentence') is None and len(tm._phrases) == known:
+            test_success += 1
+        else:
+            print(f'\tFast path of {file}: claimed {claimed}, recognized {before} and {unconfirmed} unasked, '
+                  f'learned {got}, want {want}')
+
+    # Only the most recently used utterances are kept.
+    phrases = PhraseIndex(max_entries=2)
+    for sentence in ('one', 'two', 'three'):
+        phrases.add(sentence, sentence)
+        phrases.lookup('one')
+    test_count += 1
+    if [phrases.lookup(s) for s in ('one', 'two', 'three')] == [('one', {}), None, ('three', {})] and \
+            len(phrases) == 2:
+        test_success += 1
+    else:
+        print(f'\tPhrase eviction: kept {len(phrases)} phrases')
+
+    return report(test_count, test_success)
+
+
+def run_surface_tests() -> Tuple[int, int]:
+    """
+    Check the bitmask surface check against the list-based one for every template library in the test directory.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    # Parsed once and matched against every library in turn. Each library encodes them over its own vocabulary.
+    lfs = {sentence: LogicalForm(xml_str) for sentence, xml_str in replies.items()}
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for file in library_files():
+        print(f'Running test group {splitext(basename(file))[0]}:')
+        tm = TemplateManager(file)
+
+        # The bitmask surface check must agree with the list-based one on every pair of components.
+        template_comps = [c for command in tm for t in command.template for c in LogicalForm._iterate(t._root)]
+        for sentence, lf in lfs.items():
+            memo = MatchMemo(tm._symbols)
+            mismatches = [(this, other) for this in LogicalForm._iterate(lf._root) for other in template_comps
+                          if LogicalForm._surface_match(this, other, memo) !=
+                          LogicalForm._surface_match_lists(this, other)]
+            # The sentence masks are only kept by the memo, and the vocabulary of the library is fixed.
+            untouched = all(c._masks is None for c in LogicalForm._iterate(lf._root)) and tm._symbols.frozen
+
+            test_count += 1
+            if not mismatches and untouched:
+                test_success += 1
+            else:
+                print(f'\tSurface <- {sentence}\nMISMATCHED:\n{mismatches}')
+
+    return report(test_count, test_success)
+
+
+def run_batch_tests() -> Tuple[int, int]:
+    """
+    Check batch and ranked matching against matching one sentence at a time for every template library in the test
+    directory.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for file in library_files():
+        print(f'Running test group {splitext(basename(file))[0]}:')
+        tm = TemplateManager(file)
+
+        # Batch matching must agree with matching one sentence at a time.
+        sentences = list(replies.keys())
+        lfs = [LogicalForm(replies[sentence]) for sentence in sentences]
+        for sentence, lf, batch_match in zip(sentences, lfs, tm.match_batch(lfs, batch_size=5)):
+            single = tm.match(lf)
+            want = None if single is None else (single.name, single.bound_params, single.groups)
+            got = None if batch_match is None else (batch_match.name, batch_match.bound_params, batch_match.groups)
+
+            test_count += 1
+            if want == got:
+                test_success += 1
+            else:
+                print(f'\tBatch <- {sentence}\nEXPECTED:\n{want}\nGOT:\n{got}')
+
+        # match_all must find exactly the commands with a matching template, and the one match() picks among them.
+        for sentence, lf in zip(sentences, lfs):
+            single = tm.match(lf)
+            ranked = tm.match_all(lf)
+            want_names = {c.name for c, t in tm._templates if lf.match_template(t)[0]}
+            names = [m.name for m in ranked]
+            scores = [m.specificity for m in ranked]
+
+            test_count += 1
+            if set(names) == want_names and len(names) == len(want_names) and \
+                    scores == sorted(scores, reverse=True) and all(s > 0 for s in scores) and \
+                    (single is None if not ranked else single.name in names):
+                test_success += 1
+            else:
+                print(f'\tRanked <- {sentence}\nEXPECTED:\n{want_names} / {single}\n'
+                      f'GOT:\n{[(m, m.specificity) for m in ranked]}')
+
+    return report(test_count, test_success)
+
+
+def run_parity_tests() -> Tuple[int, int]:
+    """
+    Check the matching engine, interpreted and compiled, against the reference matcher on a corpus of recorded TRIPS
+    replies. Every recorded sentence is compared with every command template of every library in the test directory.
+    :return: The number of tests run and passed.
+    """
+    replies = load_cassette(abspath(args.cassette))
+    print('BEGIN TESTING:')
+    test_count, test_success = 0, 0
+
+    for file in library_files():
+        print(f'Running test group {splitext(basename(file))[0]}:')
+        tm = TemplateManager(file)
+
+        # The compiled matchers are generated on the first load and read back from the cache on the second. A module
+        # that no longer matches its digest is never run, but generated again.
+        with TemporaryDirectory() as cache:
+            compiled = TemplateManager(file, compiled=True, cache_dir=cache)
+            module = [join(cache, f) for f in listdir(cache) if f.endswith('.py')]
+            with open(module[0], 'a') as fp:
+                fp.write('raise AssertionError("Tampered module was run")\n')
+            TemplateManager(file, compiled=True, cache_dir=cache)
+            cached = TemplateManager(file, compiled=True, cache_dir=cache)
+            test_count += 1
+            if len(module) == 1 and sorted(listdir(cache)) == [basename(module[0]),
+                                                               basename(module[0]) + DIGEST_SUFFIX]:
+                test_success += 1
+            else:
+                print(f'\tExpected one cached module and its digest, found {listdir(cache)}')
+
+        for sentence, xml_str in replies.items():
+            # Matching has no side effects, so one parsed sentence is shared by every comparison.
+            lf = LogicalForm(xml_str)
+            # Without the utterance, groups fall back to the words of the subtree, just like the reference matcher.
+            words = LogicalForm._from_root(lf._root, lf.from_xml)
+            pruned = tm.prune(words)
+            memo = MatchMemo(tm._symbols)
+            for t, (command, template) in enumerate(tm._templates):
+                want = compare(lf._root, template._root)
+                got = words.match_template(template, memo)
+                again = words.match_template(template)
+                got_pruned = pruned.match_template(template)
+                got_compiled = compiled._match_template(t, words, {})
+                got_cached = cached._match_template(t, words, {})
+
+                test_count += 1
+                if want == got == again == got_pruned == got_compiled == got_cached:
+                    test_success += 1
+                else:
+                    print(f'\t{command.name} <- {sentence}\nEXPECTED:\n{want}\nGOT:\n{got}\nTHEN:\n{again}\n'
+                          f'PRUNED:\n{got_pruned}\nCOMPILED:\n{got_compiled}\nCACHED:\n{got_cached}')
+
+                # With the utterance, the same groups are bound to spans of it instead.
+                spans = lf.match_template(template)
+                spans_pruned = tm.prune(lf).match_template(template)
+                spans_compiled = compiled._match_template(t, lf, {})
+
+                test_count += 1
+                if spans[:2] == want[:2] and spans[2].keys() == want[2].keys() and \
+                        all(v and v in lf.text for v in spans[2].values()) and \
+                        spans == spans_pruned == spans_compiled:
+                    test_success += 1
+                else:
+                    print(f'\tSpans {command.name} <- {sentence}\nEXPECTED:\n{want}\nGOT:\n{spans}\n'
+                          f'PRUNED:\n{spans_pruned}\nCOMPILED:\n{spans_compiled}')
+
+    return report(test_count, test_success)
+
+
+# Modes that check the semantic tools on the recorded TRIPS replies of the cassette.
+REPLAY_MODES = {
+    'reader': run_reader_tests,
+    'fingerprint': run_fingerprint_tests,
+    'flat': run_flat_tests,
+    'serialization': run_serialization_tests,
+    'cache': run_cache_tests,
+    'replay': run_replay_tests,
+    'hedge': run_hedge_tests,
+    'coalesce': run_coalesce_tests,
+    'stream': run_stream_tests,
+    'library': run_library_tests,
+    'fast_path': run_fast_path_tests,
+    'surface': run_surface_tests,
+    'batch': run_batch_tests,
+    'parity': run_parity_tests,
+}
+
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("test_data", help="A directory of (#.xml, #.out) or (#, #.out) pairs with test setup "
                                               "and expected results.")
-    arg_parser.add_argument("-m", "--mode", type=str, choices=['parse', 'match'],
+    arg_parser.add_argument("-m", "--mode", type=str, choices=['parse', 'match', 'format', 'recorded'] + list(REPLAY_MODES),
                             help="Use 'parse' mode to test the TemplateManager's parsing of template libraries.\n"
                                  "Use 'match' mode to test the TemplateManager's matching of sentences to templates.\n"
-                                 "Use 'all' to do both.")
+                                 "Use 'format' mode to test the printing of sentence Logical Forms.\n"
+                                 "Every other mode checks one feature against the recorded TRIPS replies, e.g. "
+                                 "'parity' checks the matching engine against the reference matcher.\n"
+                                 "Use 'recorded' to run all of those.")
+    arg_parser.add_argument("-p", "--parse-cache", type=str, default=None,
+                            help="A TRIPS parse cache file for 'match' mode. Sentences parsed by earlier runs are "
+                                 "not sent to the parser again.")
+    arg_parser.add_argument("-o", "--offline", action="store_true",
+                            help="In 'match' mode, parse with a local replay of the cassette instead of the TRIPS "
+                                 "parser.")
+    arg_parser.add_argument("-n", "--concurrency", type=int, default=8,
+                            help="Number of sentences parsed at once in 'match' mode.")
+    arg_parser.add_argument("-c", "--cassette", type=str, default=DEFAULT_CASSETTE,
+                            help="A directory of recorded TRIPS replies used by the recorded reply modes, and by "
+                                 "'match' mode when offline.")
     args = arg_parser.parse_args()
 
     if not isdir(args.test_data):
@@ -257,9 +1088,22 @@ if __name__ == '__main__':
     mode = TestMode.PARSE
     if (args.mode is not None) and (args.mode.upper() == TestMode.MATCH.name):
         mode = TestMode.MATCH
+    if (args.mode is not None) and (args.mode.upper() == TestMode.FORMAT.name):
+        mode = TestMode.FORMAT
+    if (args.mode is not None) and (args.mode in REPLAY_MODES or args.mode.upper() == TestMode.RECORDED.name):
+        mode = TestMode.RECORDED
 
     if mode == TestMode.PARSE:
         run_parse_tests()
 
     if mode == TestMode.MATCH:
         run_match_tests()
+
+    if mode == TestMode.FORMAT:
+        run_format_tests()
+
+    if mode == TestMode.RECORDED:
+        runs = [run() for name, run in REPLAY_MODES.items() if args.mode in (name, 'recorded')]
+        if len(runs) > 1:
+            print('ALL RECORDED REPLY TESTS:')
+            report(sum(count for count, _ in runs), sum(success for _, success in runs))
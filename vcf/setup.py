@@ -16,6 +16,7 @@ setuptools.setup(
     install_requires=[
         'bs4',                  # Used for all XML parsing.
         'requests',
+        'numpy',                # Array-backed Logical Forms.
         'keyboard',             # Until module support
         'google-cloud-speech',  # Used in speech recognition
         'soundfile',            # """